@@ -0,0 +1,87 @@
+"""Times how long the game boards take to render after each move.
+
+Plays full games of Connect Four and Tic-Tac-Toe, rendering the board into an embed
+after every move. Each one is timed with the cached rows the boards use now, and with
+the old way of rebuilding the whole board string and a new embed every time.
+
+Run from the repo root: python benchmarks/bench_board_render.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+
+from cogs import connectfour, tictactoe
+
+## How many full games are played for each timing, and how many timings the best is taken from.
+GAMES = 2000
+REPEATS = 5
+
+## Every column filled bottom to top, from left to right, which plays all 42 moves.
+CONNECT_FOUR_MOVES = [column for column in range(7) for _ in range(6)]
+## Every space, in an order where nobody wins until the board is full.
+TIC_TAC_TOE_MOVES = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 0), (1, 2), (2, 1), (2, 0), (2, 2)]
+
+def full_connect_four(board):
+    """The old Connect Four render, rebuilding every row on every call."""
+    rows = board.board
+    return "\n" + "\n".join(F" {rows[r][0]}{rows[r][1]}{rows[r][2]}{rows[r][3]}{rows[r][4]}{rows[r][5]}{rows[r][6]}"
+                            for r in range(5, -1, -1))
+
+def full_tic_tac_toe(board):
+    """The old Tic-Tac-Toe render, rebuilding every row on every call."""
+    rows = board.board
+    return "\n" + "\n".join(F"{rows[r][0]}{rows[r][1]}{rows[r][2]}" for r in range(3))
+
+def old_embed(text):
+    embed = discord.Embed(title="Connect Four", description=text)
+    embed.set_footer(text="Your turn")
+    return embed
+
+def play_connect_four(cached: bool):
+    board = connectfour.GameBoard("p1", "p2")
+    for column in CONNECT_FOUR_MOVES:
+        board.drop(column)
+        if cached:
+            board.to_embed("Connect Four", "Your turn")
+        else:
+            old_embed(full_connect_four(board))
+
+def play_tic_tac_toe(cached: bool):
+    board = tictactoe.GameBoard("p1", "p2")
+    for x, y in TIC_TAC_TOE_MOVES:
+        board.update_board(x, y)
+        if cached:
+            board.to_embed("Tic-Tac-Toe", "Your turn")
+        else:
+            old_embed(full_tic_tac_toe(board))
+
+def per_move(play, cached: bool, moves: int):
+    """Gets the best time for one move and its render, in microseconds."""
+    best = min(timeit.repeat(lambda: play(cached), number=GAMES, repeat=REPEATS))
+    return best / (GAMES * moves) * 1_000_000
+
+def main():
+    ## Both renders should show the same board.
+    board = connectfour.GameBoard("p1", "p2")
+    for column in CONNECT_FOUR_MOVES[:20]:
+        board.drop(column)
+    assert str(board) == full_connect_four(board)
+
+    for name, play, moves in (("Connect Four", play_connect_four, len(CONNECT_FOUR_MOVES)),
+                              ("Tic-Tac-Toe", play_tic_tac_toe, len(TIC_TAC_TOE_MOVES))):
+        old = per_move(play, False, moves)
+        new = per_move(play, True, moves)
+        print(F"{name:<13} full rebuild {old:6.2f} us/move | cached rows {new:6.2f} us/move | {old / new:4.2f}x")
+
+    ## Rendering a board that hasn't changed, e.g. when a move is rejected.
+    unchanged = min(timeit.repeat(lambda: str(board), number=100_000, repeat=REPEATS)) / 100_000 * 1_000_000
+    rebuilt = min(timeit.repeat(lambda: full_connect_four(board), number=100_000, repeat=REPEATS)) / 100_000 * 1_000_000
+    print(F"{'Unchanged':<13} full rebuild {rebuilt:6.2f} us      | cached rows {unchanged:6.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Measures the bot's memory use under each intents profile, at a simulated number of guilds.
+
+For each profile, a fresh process builds discord.py's ConnectionState with the options
+build_profile gives the bot, then feeds it GUILD_CREATE payloads and a stream of
+MESSAGE_CREATE events, the same way the gateway would. No connection to Discord is made.
+
+Each guild has text and voice channels and a few members in voice, which are what the
+gateway sends without the members intent. Its RSS is measured before and after.
+
+Run from the repo root: python benchmarks/bench_intents_memory.py --guilds 5000
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.diagnostics import read_rss
+from utils.intents import build_profile
+
+PROFILES = ("default", "lean")
+
+def user(user_id: int):
+    return {"id": str(user_id), "username": F"user{user_id}", "discriminator": "0001", "avatar": None}
+
+def guild_payload(guild_id: int, channels: int, voice_members: int):
+    """Builds a GUILD_CREATE payload, with some members sitting in the first voice channel."""
+    base = guild_id * 1000
+    text = [{"id": str(base + i), "type": 0, "name": F"text-{i}", "position": i,
+             "permission_overwrites": [], "topic": None, "nsfw": False, "last_message_id": None}
+            for i in range(1, channels + 1)]
+    voice = [{"id": str(base + 500 + i), "type": 2, "name": F"voice-{i}", "position": i,
+              "permission_overwrites": [], "bitrate": 64000, "user_limit": 0}
+             for i in range(1, 3)]
+    members = [{"user": user(base + 900 + i), "roles": [], "joined_at": "2021-01-01T00:00:00+00:00",
+                "deaf": False, "mute": False} for i in range(voice_members)]
+    voice_states = [{"user_id": member["user"]["id"], "channel_id": voice[0]["id"], "session_id": "x",
+                     "deaf": False, "mute": False, "self_deaf": False, "self_mute": False,
+                     "self_video": False, "suppress": False} for member in members]
+    return {
+        "id": str(guild_id), "name": F"guild-{guild_id}", "owner_id": str(base + 900),
+        "member_count": 5000, "large": True, "unavailable": False,
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0,
+                   "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+        "emojis": [], "features": [], "channels": text + voice,
+        "members": members, "voice_states": voice_states, "presences": [],
+        }
+
+def message_payload(message_id: int, guild_id: int, channel_id: int, author_id: int):
+    return {
+        "id": str(message_id), "channel_id": str(channel_id), "guild_id": str(guild_id),
+        "author": user(author_id), "content": "!roll 1d20+5", "timestamp": "2021-01-01T00:00:00+00:00",
+        "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [],
+        "mention_roles": [], "attachments": [], "embeds": [], "pinned": False, "type": 0,
+        }
+
+def measure(profile: str, guilds: int, channels: int, voice_members: int, messages: int):
+    """Builds the state for one profile, and gets its RSS at each step, in bytes."""
+    import discord
+    from discord.state import ConnectionState
+
+    cogs = [os.path.join(ROOT, "cogs", name) for name in os.listdir(os.path.join(ROOT, "cogs")) if name.endswith(".py")]
+    options = build_profile(cogs, profile)
+    loop = asyncio.new_event_loop()
+    state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, syncer=None,
+                            http=None, loop=loop, **options)
+
+    gc.collect()
+    rss = {"start": read_rss()}
+
+    for guild_id in range(1, guilds + 1):
+        state.parse_guild_create(guild_payload(guild_id, channels, voice_members))
+    gc.collect()
+    rss["guilds"] = read_rss()
+
+    ## Messages go round every guild's channels, from a different author each time.
+    for number in range(messages):
+        guild_id = number % guilds + 1
+        channel_id = guild_id * 1000 + number // guilds % channels + 1
+        state.parse_message_create(message_payload(10 ** 12 + number, guild_id, channel_id, 10 ** 9 + number))
+    gc.collect()
+    rss["messages"] = read_rss()
+
+    rss["cached_messages"] = len(state._messages or ())
+    rss["cached_members"] = sum(len(guild._members) for guild in state.guilds)
+    rss["intents"] = [name for name, enabled in options["intents"] if enabled]
+    return rss
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=5000)
+    parser.add_argument("--channels", type=int, default=10, help="text channels per guild")
+    parser.add_argument("--voice-members", type=int, default=5, help="members in voice per guild")
+    parser.add_argument("--messages", type=int, default=100_000, help="messages received in total")
+    parser.add_argument("--profile", choices=PROFILES, help="measure one profile, and print it as JSON")
+    args = parser.parse_args()
+
+    settings = (args.guilds, args.channels, args.voice_members, args.messages)
+    if args.profile:
+        print(json.dumps(measure(args.profile, *settings)))
+        return
+
+    ## Each profile gets its own process, so neither one's memory counts towards the other.
+    print(F"{args.guilds:,} guilds, {args.channels} text channels and {args.voice_members} voice members each, "
+          F"{args.messages:,} messages")
+    for profile in PROFILES:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--profile", profile, "--guilds", str(args.guilds),
+             "--channels", str(args.channels), "--voice-members", str(args.voice_members),
+             "--messages", str(args.messages)],
+            check=True, capture_output=True, text=True).stdout
+        rss = json.loads(output)
+        mb = {key: rss[key] / 2 ** 20 for key in ("start", "guilds", "messages")}
+        print(F"{profile:<8} start {mb['start']:7.1f} MB | after guilds {mb['guilds']:7.1f} MB | "
+              F"after messages {mb['messages']:7.1f} MB | {rss['cached_members']:,} members, "
+              F"{rss['cached_messages']:,} messages cached")
+        print(F"{'':<8} intents: {', '.join(rss['intents'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,30 +2,60 @@ import discord
 import os
 import traceback
 
-from asyncio import sleep
 from discord.ext import commands
 from dotenv import load_dotenv
 
+## Settings like the shard config are read as modules are imported, so load them first.
+load_dotenv()
+
 from constants import status
+from utils.history import history
+from utils.intents import build_profile
+from utils.leaderboard import leaderboards
+from utils.metrics import metrics
+from utils.scheduler import scheduler
+from utils.sharding import sharding
 
 ###---------------------------------------------------------------------###
-bot = commands.Bot(command_prefix="!")
+## Every cog in ./cogs gets loaded. They're found first, so the intents they need can be read.
+cog_files = [filename for filename in os.listdir("./cogs") if filename.endswith(".py")]
+profile = build_profile([os.path.join("cogs", filename) for filename in cog_files])
+
+## One websocket per shard once the bot is sharded, see ShardConfig for the settings.
+bot_class = commands.AutoShardedBot if sharding.sharded else commands.Bot
+bot = bot_class(command_prefix="!", **sharding.bot_kwargs(), **profile)
+
+## Time every command, and print the tracebacks of any that fail.
+metrics.install(bot)
+
+## The game cogs record into these whether or not the Records cog is loaded, and errors in
+## cog_unload are dropped while closing, so whatever's still waiting is written here too.
+close = bot.close
+async def close_and_flush():
+    await close()
+    history.flush_now()
+    leaderboards.flush_now()
+bot.close = close_and_flush
+
+async def rotate_presence():
+    """Changes the bot's status to a random game."""
+    game_status = await status.chooseGame()
+    await bot.change_presence(activity = discord.Game(name=game_status))
+
+## Change the bot's status every two hours, starting as soon as it's ready.
+scheduler.every("presence", 7200, rotate_presence, delay=0)
 
 @bot.event
 async def on_ready():
     print(F"{bot.user.name} is now online. Beep boop!")
-    # Change the bot"s status every two hours.
-    while True:
-        game_status = await status.chooseGame()
-        await bot.change_presence(activity = discord.Game(name=game_status))
-        await sleep(7200)   
+    ## on_ready fires again after every reconnect, but the scheduler only ever starts once.
+    scheduler.start()
         
 ## Try to load the bot's extensions.
 print("Loading...\n")
-for filename in os.listdir("./cogs"):
+for filename in cog_files:
     try:
-        if filename.endswith(".py"):
-            bot.load_extension(F"cogs.{filename[:-3]}")
+        bot.load_extension(F"cogs.{filename[:-3]}")
             
     except Exception:
         print(F"\nFailed to load {filename}.\n")
@@ -34,6 +64,5 @@ for filename in os.listdir("./cogs"):
         print(F"{filename} sucessfully loaded...")
 
 ## Get the bot's token.
-load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
 bot.run(TOKEN)
\ No newline at end of file
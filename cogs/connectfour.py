@@ -1,6 +1,13 @@
 import discord
-from random import SystemRandom
 from discord.ext import commands
+from utils.games import NUMBER_EMOJIS, BoardMessage, GameRegistry
+from utils.history import history
+from utils.leaderboard import leaderboards
+from utils.rng import rng
+
+## Gateway intents this cog needs on top of the bot's base ones, read by bot.py.
+## Reactions are used to play moves in react mode.
+REQUIRED_INTENTS = ("guild_reactions",)
 
 ## Discord's black circle emoji. Represents an open space.
 open = ":black_circle:"
@@ -16,12 +23,24 @@ class GameBoard:
                       [open, open, open, open, open, open, open]]
 
         ## Randomizes who goes first. Whoever gets ":red_circle:" goes first.
-        if SystemRandom().randint(0, 1):
+        if rng.randint(0, 1):
             self.players = {":red_circle:": p1, ":blue_circle:": p2}
         else:
             self.players = {":red_circle:": p2, ":blue_circle:": p1}
 
         self.red_turn = True
+        ## Set by the GameRegistry once the game is registered.
+        self.key = None
+        ## The message showing this game's board, set by the cog.
+        self.message = None
+        ## Every column played, one byte per move, for the game history.
+        self.moves = bytearray()
+
+        ## Cached string for each row, so a move only rebuilds the row the piece landed in.
+        self.rows = [F" {''.join(row)}" for row in self.board]
+        self.rendered = None
+        ## Reused for every message about this game, only the text gets swapped out.
+        self.embed = discord.Embed()
         
     def can_play(self, player):
         """Checks whose turn it is.
@@ -90,6 +109,11 @@ class GameBoard:
         else:
             return False
         
+        ## Only the row that the piece landed in needs to be rendered again.
+        self.rows[i] = F" {''.join(self.board[i])}"
+        self.rendered = None
+        self.moves.append(column)
+        
         ## If placing piece was sucessful, changes whose turn it is.
         self.red_turn = not self.red_turn
         return True
@@ -131,41 +155,127 @@ class GameBoard:
     
     def __str__(self):
         """Returns string representation of the current game board."""
-        ## Create the board, with open spaces denoted by a black circle.
-        _board = (
-        (F" {self.board[5][0]}{self.board[5][1]}{self.board[5][2]}{self.board[5][3]}{self.board[5][4]}{self.board[5][5]}{self.board[5][6]}\n") + 
-
-        (F" {self.board[4][0]}{self.board[4][1]}{self.board[4][2]}{self.board[4][3]}{self.board[4][4]}{self.board[4][5]}{self.board[4][6]}\n") +
+        ## Rows are stored bottom to top, so they're reversed to print the top row first.
+        if self.rendered is None:
+            self.rendered = "\n" + "\n".join(reversed(self.rows))
+        return self.rendered
 
-        (F" {self.board[3][0]}{self.board[3][1]}{self.board[3][2]}{self.board[3][3]}{self.board[3][4]}{self.board[3][5]}{self.board[3][6]}\n") +
-
-        (F" {self.board[2][0]}{self.board[2][1]}{self.board[2][2]}{self.board[2][3]}{self.board[2][4]}{self.board[2][5]}{self.board[2][6]}\n") + 
-
-        (F" {self.board[1][0]}{self.board[1][1]}{self.board[1][2]}{self.board[1][3]}{self.board[1][4]}{self.board[1][5]}{self.board[1][6]}\n") +
+    @classmethod
+    def from_moves(cls, first, second, moves):
+        """Rebuilds a board by playing back a recorded game.
+        
+        Args:
+            first: The player who went first, i.e. was red
+            second: The other player
+            moves (bytes): Every column played, in order
+            
+        Returns:
+            board (GameBoard): The board after the last move.
+        """
+        board = cls(first, second)
+        board.players = {":red_circle:": first, ":blue_circle:": second}
+        for column in moves:
+            board.drop(column)
+        return board
 
-        (F" {self.board[0][0]}{self.board[0][1]}{self.board[0][2]}{self.board[0][3]}{self.board[0][4]}{self.board[0][5]}{self.board[0][6]}"))
-        return (F"\n{_board}")
+    def to_embed(self, title, footer=None):
+        """Updates the board's embed with the current board.
+        
+        Args:
+            title (str): Title of the embed
+            footer (str): Footer of the embed, if any
+            
+        Returns:
+            embed (discord.Embed): The board's embed.
+        """
+        self.embed.title = title
+        self.embed.description = str(self)
+        if footer:
+            self.embed.set_footer(text=footer)
+        else:
+            self.embed.set_footer()
+        return self.embed
 
 class ConnectFour(commands.Cog):
-    ## Dictionary to store all running instances of the game, from different guilds.
-    boards = {}
+    ## Registry of all running instances of the game, from different guilds and channels.
+    boards = GameRegistry()
     
-    def create(self, server_id, p1, p2):
+    def __init__(self, bot):
+        self.bot = bot
+        self.boards.on_expire = self.game_timed_out
+    
+    def create(self, ctx, p1, p2):
         """Creates an instance of the GameBoard class.
         
         Args: 
-            server_id (int): ID of the guild that is running on
-            p1 (int): ID of player 1, who started the game
-            p2 (int): ID of player 2, who was challenged to play
+            ctx (commands.Context): Context of the command that started the game
+            p1 (discord.Member): Player 1, who started the game
+            p2 (discord.Member): Player 2, who was challenged to play
+            
+        Returns:
+            board: The new game board.
+        """
+        board = GameBoard(p1, p2)
+        board.message = BoardMessage(ctx.channel)
+        self.boards.add(ctx.guild.id, ctx.channel.id, p1, p2, board)
+        return board
+    
+    async def finish(self, board, winner):
+        """Ends a game, saving it to the game history and the guild's leaderboard.
+        
+        Args:
+            board (GameBoard): The board of the finished game
+            winner (discord.Member): The winner, or None for a tie
+            
+        Returns:
+            game_id (int): The game's number in the history.
+        """
+        self.boards.remove(board.key)
+        first, second = board.players[":red_circle:"], board.players[":blue_circle:"]
+        game_id = history.record("connectfour", board.key, first, second, winner, board.moves)
+        
+        guild_id = board.key[0]
+        if winner is None:
+            await leaderboards.record(guild_id, ties=[first.id, second.id])
+        else:
+            loser = second if winner == first else first
+            await leaderboards.record(guild_id, wins=[winner.id], losses=[loser.id])
+        return game_id
+    
+    def replay_embed(self, record, first, second, winner):
+        """Rebuilds a finished game from the history.
+        
+        Args:
+            record (GameRecord): The recorded game
+            first (str): Name of the player who went first
+            second (str): Name of the other player
+            winner (str): Name of the winner, or None for a tie
             
         Returns:
-            first_turn: The player whose letter will be "X". This player always goes first.
+            embed (discord.Embed): The final board and every column played.
         """
-        self.boards[server_id] = GameBoard(p1, p2)
-        ## Return who is "red", i.e. who is going first.
-        first_turn = self.boards[server_id].players[":red_circle:"]
-        return first_turn
+        board = GameBoard.from_moves(first, second, record.moves)
+        result = F"{winner} won" if winner else "A tie"
+        title = F"Game #{record.id}: {first} vs. {second} - {result}"
+        columns = " ".join(str(column + 1) for column in record.moves)
+        return board.to_embed(title, footer=F"Columns played: {columns}")
     
+    async def game_timed_out(self, key, board):
+        """Lets the players know that their game was stopped for going idle.
+        
+        Args:
+            key (tuple): The key of the game in the registry
+            board (GameBoard): The board of the game that timed out
+        """
+        channel = self.bot.get_channel(key[1])
+        if channel is None:
+            return
+        
+        p1, p2 = board.players.values()
+        minutes = round(self.boards.idle_timeout / 60)
+        await channel.send(F"The game of connect four between {p1.display_name} and {p2.display_name} "
+                           F"timed out after {minutes} minutes without a move.")
+
     @commands.group(aliases=["drop", "column"], invoke_without_command=True)
     @commands.guild_only()
     async def connect_four(self, ctx, *, column: int):
@@ -183,36 +293,48 @@ class ConnectFour(commands.Cog):
             None: If an occupied, or non-existent space is given.
         """
         player = ctx.message.author
-        board = self.boards.get(ctx.message.guild.id)
+        board = self.boards.find(ctx.guild.id, ctx.channel.id, player.id)
 
-        ## Make sure that the board exists, i.e. a game is running on that guild.
+        ## Make sure that the board exists, i.e. the player has a game running in this channel.
         if not board:
-            await ctx.send("There are currently no games running!")
+            await ctx.send("You don't have a game running here!")
             return
 
+        await self.play(board, ctx.channel, player, column)
+
+    async def play(self, board, channel, player, column):
+        """Plays a move, from either a command or a reaction on the board message.
+        
+        Args:
+            board (GameBoard): The board of the player's game
+            channel (discord.TextChannel): The channel the game is running in
+            player (discord.Member): The player making the move
+            column (int): Given column to drop a piece, from one to seven
+        """
         ## Make sure that it is that player's turn.
         ## Prevent player "X" from going during "O"s turn, and the reverse.
         ## Also stop any random member from messing with the game.
         if not board.can_play(player):
-            await ctx.send("You cannot play right now!")
+            await channel.send("You cannot play right now!")
             return
 
         ## Check to make sure that the column exists.
         if not 1 <= column <= 7:
-            await ctx.send("Column must be a number from one to seven!")
+            await channel.send("Column must be a number from one to seven!")
             return
         
         ## Check if the column is full. If so, then request a different column.
         column -= 1
         column_full = board.check_column(column)
         if column_full:
-            await ctx.send("That column is full. Please choose a different one.")
+            await channel.send("That column is full. Please choose a different one.")
             return
 
         ## Drop piece into the selected column.
         if not board.drop(column):
-            await ctx.send("That column is full. Please choose a different one.")
+            await channel.send("That column is full. Please choose a different one.")
             return
+        self.boards.touch(board.key)
 
         ## Check if there is a winner yet.
         winner = board.check_board()
@@ -224,26 +346,17 @@ class ConnectFour(commands.Cog):
                 loser = board.players[":blue_circle:"]
             
             win_msg = (F"{winner.display_name} has won! Sounds like {loser.display_name} has a skill issue.")
-            win_embed = discord.Embed(title=win_msg, description=str(board))
-            await ctx.send(embed=win_embed)
             ## End the game, so a new one can start.
-            try:
-                del self.boards[ctx.message.guild.id]
-            except KeyError:
-                pass
+            game_id = await self.finish(board, winner)
+            await board.message.update(board.to_embed(win_msg, footer=F"Game #{game_id}"))
             
         else:
             ## If all spaces are full, and there are no winning combinations, it's a tie.
             if board.check_spaces():
                 tie_msg = "A tie!\n"
-                tie_embed = discord.Embed(title=tie_msg, description=str(board))
-                tie_embed.set_footer(text="I suppose you both are equally bad.")
-                await ctx.send(embed=tie_embed)
-                
-                try:
-                    del self.boards[ctx.message.guild.id]
-                except KeyError:
-                    pass
+                game_id = await self.finish(board, None)
+                tie_embed = board.to_embed(tie_msg, footer=F"I suppose you both are equally bad. | Game #{game_id}")
+                await board.message.update(tie_embed)
             else:
                 ## If no one has won yet, then alert whose turn it is and keep going.
                 if board.red_turn:
@@ -252,16 +365,39 @@ class ConnectFour(commands.Cog):
                     player_turn = board.players.get(":blue_circle:")
                 
                 turn_msg = (F"{player_turn.display_name}, it's now your turn!\n")
-                turn_embed = discord.Embed(title=turn_msg, description=(F"{str(board)}"))
-                await ctx.send(embed=turn_embed)
+                await board.message.update(board.to_embed(turn_msg))
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        """Plays a move when a player reacts to their board message with a column number."""
+        board = self.boards.find_by_message(payload.message_id)
+        if board is None or payload.user_id == self.bot.user.id:
+            return
+
+        emoji = str(payload.emoji)
+        if emoji not in NUMBER_EMOJIS[:7]:
+            return
+
+        ## Take the reaction back off, so the same column can be picked again later.
+        message = board.message.message
+        try:
+            await message.remove_reaction(payload.emoji, payload.member)
+        except discord.HTTPException:
+            pass
+
+        await self.play(board, message.channel, payload.member, NUMBER_EMOJIS.index(emoji) + 1)
 
     @commands.command(name="connectfour")
     @commands.guild_only()
-    async def start_connect_four(self, ctx, p2: discord.Member):
+    async def start_connect_four(self, ctx, p2: discord.Member, mode: str=None):
         """Starts a game of Connect Four and prints the game board.
         
+        The board is kept in one message, which gets edited after every move.
+        
         Args:
             p2 [discord.Member]: The member of the guild who was challenged to play
+            mode [str]: "react" to play moves by reacting to the board with a column number,
+            instead of using the drop command
         
         Returns:
             None: If there is already a running game, or if there is an
@@ -269,10 +405,11 @@ class ConnectFour(commands.Cog):
         """
         p1 = ctx.message.author
         
-        ## Only one game per server, else things would get pretty complicated.
-        if self.boards.get(ctx.message.guild.id) is not None:
-            await ctx.send("Only one game can run at a time!")
-            return
+        ## Each player can only be in one game per channel, else things would get pretty complicated.
+        for player in (p1, p2):
+            if self.boards.find(ctx.guild.id, ctx.channel.id, player.id) is not None:
+                await ctx.send(F"{player.display_name} is already playing in this channel!")
+                return
 
         ## If the member challenges the bot. Very offensive.
         if p2 == ctx.message.guild.me:
@@ -285,24 +422,29 @@ class ConnectFour(commands.Cog):
         ##    return
 
         ## Create the board and return who is "red", and will go first.
-        red_player = self.create(ctx.message.guild.id, p1, p2)
+        board = self.create(ctx, p1, p2)
+        red_player = board.players[":red_circle:"]
         
         ## Announce that the game has started, print the board and who goes first.
         start_msg = (F"A game of connect four has started between {p1.display_name} and {p2.display_name}!\n")
-        start_board = str(self.boards[ctx.message.guild.id])
-        start_embed = discord.Embed(title=start_msg, description=start_board)
-        start_embed.set_footer(text=(F"\nBy pure skill, I have decided that {red_player.display_name} will go first!"))
-        await ctx.send(embed=start_embed)
+        start_footer = (F"\nBy pure skill, I have decided that {red_player.display_name} will go first!")
+        start_embed = board.to_embed(start_msg, footer=start_footer)
+        await board.message.update(start_embed)
+        
+        if mode == "react":
+            self.boards.bind_message(board.key, board.message.message.id)
+            await board.message.add_reactions(NUMBER_EMOJIS[:7])
         
     @commands.command(name="stopgame", aliases=["remove", "end"])
     @commands.guild_only()
     async def stop_game(self, ctx):
-        """Stops the currently running game, if there is one."""
-        if self.boards.get(ctx.message.guild.id) is None:
-            await ctx.send("There are no games running right now.")
+        """Stops the author's game in this channel, if there is one."""
+        board = self.boards.find(ctx.guild.id, ctx.channel.id, ctx.author.id)
+        if board is None:
+            await ctx.send("You don't have a game running here.")
             return
         
-        del self.boards[ctx.message.guild.id]
+        self.boards.remove(board.key)
         await ctx.send("Looks like connect four will connect no more.")
 
 ## Add cog to the bot.
@@ -1,113 +1,213 @@
-import re
+import typing
 
-from random import randint
 from discord import Embed
 from discord.ext import commands
 
+from utils.characters import parse_options, roll_arrays
+from utils.dice import OFFLOAD_THRESHOLD, DiceError, compile_expression, roll_dice
+from utils.odds import Odds
+
+## Gateway intents this cog needs on top of the bot's base ones, read by bot.py.
+REQUIRED_INTENTS = ()
+
+## Discord rejects embed titles longer than 256 characters, this leaves room for the bold marks.
+TITLE_LIMIT = 250
+
+def embed_title(text: str):
+    """Bolds text for an embed title, cutting long expressions short to fit."""
+    if len(text) > TITLE_LIMIT:
+        text = text[:TITLE_LIMIT - 3] + "..."
+    return F"**{text}**"
+
+class RollResult(typing.NamedTuple):
+    """The outcome of a single roll command.
+    
+    Each command makes its own result and hands it straight to print_roll, so rolls
+    running at the same time never share any state.
+    
+    Attributes:
+        type (str): The kind of roll, shown as the embed title.
+        results (str): Every die rolled.
+        final_roll (str): The final result of the roll.
+    """
+    type: str
+    results: str
+    final_roll: str
+
+
 class RollTypes(commands.Cog):
     """Roll some dice."""
     
     def __init__(self, bot):
         self.bot = bot
-        self.results = []
-        self.final_roll = 0
-        self.type = ""
-        
-    async def reset(self):
-        """Resets attributes to default values."""
-        self.results = []
-        self.final_roll = 0
-        self.type = ""
         
-    async def print_roll(self, ctx: commands.Context):
+    async def print_roll(self, ctx: commands.Context, roll: RollResult):
         """Prints the results of the roll command."""
         
-        embed = Embed(title=(F"**{self.type}**"), description=(F"**Rolled** `{self.results}` for `{self.final_roll}`!"))
+        embed = Embed(title=embed_title(roll.type), description=(F"**Rolled** {roll.results} for `{roll.final_roll}`!"))
         embed.set_footer(text=(F"Rolled by {ctx.message.author.display_name}"))
         await ctx.send(embed=embed)
         
-        ## Reset attributes.
-        await self.reset()
-        
     @commands.command(name = 'ability')
     async def ability_roll(self, ctx: commands.Context):
         """Rolls for ability."""
         times = 4
         sides = 6
-        self.type = 'Ability Roll' 
-        ab_list, temp = [], []
-        
-        ## Get random number and append lists.
-        for roll in range(times):
-            ab_roll = randint(1, sides)
-            ab_list.append(ab_roll)
-            temp.append(ab_roll)
+        
+        ## Roll all of the dice at once, and keep a copy of every roll.
+        ab_list = roll_dice(times, sides)
+        temp = list(ab_list)
 
         ## Remove the lowest roll and sum the remaining three.
         ab_list.remove(min(ab_list))
-        self.final_roll = sum(ab_list)
-        self.results = temp
         
-        await self.print_roll(ctx)
+        await self.print_roll(ctx, RollResult('Ability Roll', str(temp), str(sum(ab_list))))
         
     @commands.command(name = 'highroll')
     async def advantage_roll(self, ctx: commands.Context):
         """Rolls for advantage. The higher of the two rolls is the result."""
         times = 2
         sides = 20
-        self.type = 'Advantage Roll'
 
-        ## Get random number and append lists.
-        for roll in range(times):
-            new_roll = randint(1, sides)
-            self.results.append(new_roll)
+        ## Roll both dice at once.
+        results = roll_dice(times, sides)
         
         ## Gets the higher of the two rolls.
-        self.final_roll = max(self.results)
-        
-        await self.print_roll(ctx)
+        await self.print_roll(ctx, RollResult('Advantage Roll', str(results), str(max(results))))
     
     @commands.command(name = 'lowroll')
     async def disadvantage_roll(self, ctx: commands.Context):
         """Rolls for disadvantage. The lower of the two rolls is the result."""
         times = 2
         sides = 20
-        self.type = 'Disadvantage Roll'
 
-        ## Get random number and append lists.
-        for rolls in range(times):
-            new_roll = randint(1, sides)
-            self.results.append(new_roll)
+        ## Roll both dice at once.
+        results = roll_dice(times, sides)
         
         ## Get the lower of the two rolls.
-        self.final_roll = min(self.results)
-        
-        await self.print_roll(ctx)
+        await self.print_roll(ctx, RollResult('Disadvantage Roll', str(results), str(min(results))))
     
     @commands.command(name = 'roll')
-    async def standard_roll(self, ctx: commands.Context):
-        """Standard roll. Format message as xdy; where x = sides of the die and y = how many times to roll."""
-        roll_choice = ctx.message.content
-        
-        ## Check for the correct format.
-        if re.match("![a-z]+ [\d]+d[\d]+", roll_choice):
-            roll_numbers = re.findall(r'\d+', roll_choice)
-            times, sides = int(roll_numbers[0]), int(roll_numbers[1])
-            self.type = 'Standard Roll'
-
-            ## Get random number and append lists.
-            for roll_count in range(times):
-                dice_roll = randint(1, sides)
-                self.results.append(dice_roll)
-                
-            ## Get the highest of the rolls in results.
-            self.final_roll = max(self.results)
+    async def standard_roll(self, ctx: commands.Context, *, expression: str = ""):
+        """Standard roll, using dice expressions. e.g. !roll 1d20+5, !roll 4d6kh3, !roll 6#4d6kh3
+        
+        xdy rolls x dice with y sides, and adds them up. After the dice you can add:
+            kh/kl n: Keep the n highest or lowest dice. dh/dl n: Drop the n highest or lowest.
+            !: Roll dice that land on their highest side again, and add them on.
+        Dice and numbers can be combined with +, -, *, / and parentheses.
+        Starting with n# rolls the whole expression n times.
+        
+        Groups of more than 100 dice are shown as a histogram, instead of every roll.
+        """
+        try:
+            compiled = compile_expression(expression)
+            ## Big rolls are run in another thread, so they don't block the bot.
+            if compiled.dice_count > OFFLOAD_THRESHOLD:
+                rolls = await self.bot.loop.run_in_executor(None, compiled.roll)
+            else:
+                rolls = compiled.roll()
+        except DiceError as e:
+            await ctx.send(F"Invalid roll: {e} Try again, e.g. `!roll 1d20+5`.")
+            return
+        
+        if len(rolls) == 1:
+            final_roll, results = rolls[0]
+        else:
+            ## Put each repeat on its own line.
+            results = "".join(F"\n{breakdown} = `{total}`" for total, breakdown in rolls) + "\n"
+            final_roll = ", ".join(str(total) for total, _ in rolls)
+        
+        ## Keep the embed under Discord's description limit.
+        if len(results) > 1900:
+            results = results[:1900] + "..."
+        final_roll = str(final_roll)
+        if len(final_roll) > 100:
+            final_roll = final_roll[:100] + "..."
             
-            await self.print_roll(ctx)
+        await self.print_roll(ctx, RollResult(F'Standard Roll - {compiled}', results, final_roll))
             
-        ## Invalid input.
-        else:
-            await ctx.send("Invalid format for roll. Try again,.")
+    @commands.command(name = 'odds')
+    async def roll_odds(self, ctx: commands.Context, *, expression: str = ""):
+        """Shows the exact odds of a dice expression, e.g. !odds 8d6+4, !odds 4d6kh3
+        
+        Uses the same expressions as !roll, but works out every possible total
+        and its chance instead of rolling.
+        """
+        try:
+            compiled = compile_expression(expression)
+            ## Working out the odds can take a moment for big rolls, so it's done in another thread.
+            odds = await self.bot.loop.run_in_executor(None, Odds.of, compiled)
+        except DiceError as e:
+            await ctx.send(F"Invalid roll: {e} Try again, e.g. `!odds 4d6kh3`.")
+            return
+        
+        percentiles = " | ".join(F"{p}th `{odds.percentile(p)}`" for p in (5, 25, 50, 75, 95))
+        description = (F"**Mean** `{odds.mean:.2f}` | **Std. dev.** `{odds.stdev:.2f}` | "
+                       F"**Range** `{odds.lowest}` to `{odds.highest}`\n"
+                       F"**Percentiles** {percentiles}\n"
+                       F"```\n{odds.histogram()}\n```")
+        
+        embed = Embed(title=embed_title(F"Odds - {compiled.tree}"), description=description)
+        if compiled.repeats > 1:
+            embed.set_footer(text=F"Odds are for a single roll, out of the {compiled.repeats} repeats.")
+        await ctx.send(embed=embed)
+        
+    def roll_stat_arrays(self, options, default_count: int):
+        """Reads the count and options given to !statblock or !party, and rolls the arrays."""
+        count = default_count
+        if options and options[0].isdigit():
+            count, options = int(options[0]), options[1:]
+        return roll_arrays(count, **parse_options(options))
+            
+    @commands.command(name = 'statblock', aliases = ['stats'])
+    async def stat_block(self, ctx: commands.Context, *options: str):
+        """Rolls full six-stat arrays in one go. e.g. !statblock, !statblock 3 r1 min=70
+        
+        Options:
+            n: How many arrays to roll, up to 6.
+            4d6 or 3d6: Drop the lowest of 4d6 for each score (the default), or roll straight 3d6.
+            r1: Roll any 1s again, once.
+            min=n: Roll arrays again until their scores add up to at least n.
+        """
+        try:
+            if options and options[0].isdigit() and int(options[0]) > 6:
+                raise DiceError("Use `!party` for more than 6 arrays.")
+            arrays = self.roll_stat_arrays(options, 1)
+        except DiceError as e:
+            await ctx.send(F"Invalid stat block: {e}")
+            return
+        
+        embed = Embed(title="**Stat Block**" if len(arrays) == 1 else F"**{len(arrays)} Stat Blocks**")
+        for number, array in enumerate(arrays, start=1):
+            embed.add_field(
+                name=F"Array {number}",
+                value=(F"`{array}`\n**Total** `{array.total}` | **Modifiers** `{array.modifiers:+}` | "
+                       F"**Point-buy** `{array.point_buy}`"),
+                inline=False
+                )
+        embed.set_footer(text=(F"Rolled by {ctx.message.author.display_name}"))
+        await ctx.send(embed=embed)
+        
+    @commands.command(name = 'party')
+    async def party_roll(self, ctx: commands.Context, *options: str):
+        """Rolls stat arrays for a whole party at once. e.g. !party 5, !party 4 3d6 r1
+        
+        Takes the same options as !statblock, for up to 20 characters.
+        Defaults to 4 characters.
+        """
+        try:
+            arrays = self.roll_stat_arrays(options, 4)
+        except DiceError as e:
+            await ctx.send(F"Invalid party: {e}")
+            return
+        
+        ## One line per character, lined up in a code block.
+        lines = [F"#{number:<2} {str(array):<42} {array.total:>3} {array.modifiers:>+3} {array.point_buy:>3}"
+                 for number, array in enumerate(arrays, start=1)]
+        header = F"{'':3} {'Scores':<42} {'Tot':>3} {'Mod':>3} {'PB':>3}"
+        embed = Embed(title=F"**Party of {len(arrays)}**", description="```\n" + "\n".join([header] + lines) + "\n```")
+        embed.set_footer(text=(F"Rolled by {ctx.message.author.display_name}"))
+        await ctx.send(embed=embed)
 
 
 ## Adds cog to the bot.
@@ -1,33 +1,278 @@
 import discord
+import io
+import os
+import time
+import typing
+
 from discord.ext import commands
 
-PINS_CHANNEL = 1006788425350922311
+from utils.cache import LRUCache
+from utils.diagnostics import Sampler, percentile
+from utils.metrics import metrics
+from utils.pins import pins
+
+## Gateway intents this cog needs on top of the bot's base ones, read by bot.py.
+REQUIRED_INTENTS = ()
+
+## Attachments with these extensions are shown as the archived pin's image.
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+
+## Avatar images are kept in memory up to this many bytes. Can be changed in the .env file.
+AVATAR_CACHE_BYTES = int(os.getenv("AVATAR_CACHE_BYTES", 16 * 1024 * 1024))
+
+## Cogs whose running games are counted by !diag.
+GAME_COGS = ("ConnectFour", "TicTacToe")
+
+## Sizes and formats Discord can resize and convert avatars to.
+AVATAR_SIZES = [2 ** power for power in range(4, 13)]
+AVATAR_FORMATS = ("png", "jpg", "jpeg", "webp", "gif")
 
 class Utilities(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        ## Avatar image bytes, by (user ID, avatar hash, format, size).
+        self.avatars = LRUCache(AVATAR_CACHE_BYTES, sizeof=len)
+        self.sampler = Sampler(bot)
+        self.sampler.start()
+        
+    def cog_unload(self):
+        self.sampler.stop()
+        
+    def pin_embed(self, message: discord.Message):
+        """Makes the archive copy of a message, with its content, attachments and author."""
+        content = message.content
+        if len(content) > 2048:
+            content = content[:2045] + "..."
+        embed = discord.Embed(description=content, timestamp=message.created_at)
+        embed.set_author(name=message.author.display_name, icon_url=message.author.avatar_url)
+        
+        images = [attachment for attachment in message.attachments if attachment.filename.lower().endswith(IMAGE_EXTENSIONS)]
+        if images:
+            embed.set_image(url=images[0].url)
+        others = [attachment for attachment in message.attachments if attachment not in images[:1]]
+        if others:
+            links = "\n".join(F"[{attachment.filename}]({attachment.url})" for attachment in others)
+            embed.add_field(name="Attachments", value=links[:1024], inline=False)
+            
+        embed.add_field(name="Source", value=F"[Jump to message]({message.jump_url}) in {message.channel.mention}", inline=False)
+        return embed
+    
+    def pin_row(self, message: discord.Message):
+        """Gets a message's row for the pin archive."""
+        attachments = " ".join(attachment.url for attachment in message.attachments)
+        return (message.id, message.content, message.author.display_name, message.guild.id, message.channel.id,
+                message.author.id, attachments, message.jump_url, message.created_at.timestamp())
+    
+    def archive_channel(self, guild):
+        """Gets the channel a guild's pins are forwarded to, or None if it hasn't been set."""
+        channel_id = pins.get_channel_id(guild.id)
+        return guild.get_channel(channel_id) if channel_id else None
         
     @commands.command(name="pin")
+    @commands.guild_only()
     async def pin_msg(self, ctx):
-        message = await ctx.channel.fetch_message(ctx.message.reference.message_id)
-        channel = self.bot.get_channel(PINS_CHANNEL)
+        """Archives the message you reply to, forwarding it to the guild's pin channel."""
+        if ctx.message.reference is None:
+            return await ctx.send("Reply to the message you want to pin.")
+        
+        channel = self.archive_channel(ctx.guild)
+        if channel is None:
+            return await ctx.send("Set where pins go first, with `!pins channel #channel`.")
+        
+        ## The replied to message usually comes with the command, so there is no need to fetch it.
+        message = ctx.message.reference.resolved
+        if not isinstance(message, discord.Message):
+            message = await ctx.channel.fetch_message(ctx.message.reference.message_id)
+        if await pins.archived([message.id]):
+            return await ctx.send("That message is already archived.")
 
-        await channel.send(F"I have sent: {message}")
+        await channel.send(embed=self.pin_embed(message))
+        await pins.add([self.pin_row(message)])
+        await ctx.message.add_reaction("\U0001f4cc")
+        
+    @commands.group(name="pins", invoke_without_command=True)
+    @commands.guild_only()
+    async def pins_(self, ctx):
+        """Shows where pins are archived, and how many there are."""
+        channel = self.archive_channel(ctx.guild)
+        if channel is None:
+            return await ctx.send("Pins aren't being archived here yet. Set a channel with `!pins channel #channel`.")
+        await ctx.send(F"`{await pins.count(ctx.guild.id)}` pins are archived in {channel.mention}.")
+        
+    @pins_.command(name="channel")
+    @commands.has_permissions(manage_guild=True)
+    async def pins_channel(self, ctx, channel: discord.TextChannel):
+        """Sets the channel that pins get forwarded to."""
+        pins.set_channel(ctx.guild.id, channel.id)
+        await ctx.send(F"Pins will be archived in {channel.mention}.")
+        
+    @pins_.command(name="search")
+    async def pins_search(self, ctx, *, text: str):
+        """Searches the archived pins for every word given. e.g. !pins search dragon loot"""
+        results = await pins.search(ctx.guild.id, text)
+        if not results:
+            return await ctx.send("No archived pins match that.")
+        
+        lines = [F"**{author}**: {snippet} [Jump]({jump_url})" for author, snippet, jump_url in results]
+        await ctx.send(embed=discord.Embed(title=F"Pins matching \"{text[:200]}\"", description="\n".join(lines)[:2048]))
+        
+    @pins_.command(name="import")
+    @commands.has_permissions(manage_messages=True)
+    async def pins_import(self, ctx, source: discord.TextChannel=None):
+        """Archives every message pinned in a channel that isn't archived yet.
+        
+        Args:
+            source [discord.TextChannel]: The channel to import from, defaults to this one
+        """
+        source = source or ctx.channel
+        channel = self.archive_channel(ctx.guild)
+        if channel is None:
+            return await ctx.send("Set where pins go first, with `!pins channel #channel`.")
+        
+        ## All of a channel's pins come back from a single request, instead of a fetch for each one.
+        pinned = await source.pins()
+        archived = await pins.archived(message.id for message in pinned)
+        new = [message for message in reversed(pinned) if message.id not in archived]
+        if not new:
+            return await ctx.send(F"Every pin in {source.mention} is already archived.")
+        
+        async with ctx.typing():
+            for message in new:
+                await channel.send(embed=self.pin_embed(message))
+            await pins.add([self.pin_row(message) for message in new])
+        await ctx.send(F"Archived `{len(new)}` pins from {source.mention}.")
     
     @commands.command(name="ping")
     async def ping_bot(self, ctx):
         """Sends the bot's latency."""
         await ctx.reply(F"pewpew! {round(self.bot.latency * 1000)} ms")
         
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.guild is not None:
+            self.sampler.count_event(message.guild.id)
+            
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        if payload.guild_id is not None:
+            self.sampler.count_event(payload.guild_id)
+            
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        self.sampler.count_event(member.guild.id)
+        
+    @commands.command(name="diag")
+    async def diagnostics(self, ctx):
+        """Shows how the bot is doing: latencies, event loop lag, queues and resource use.
+        
+        Everything comes from the samples already taken in the background, over the last few minutes.
+        """
+        sampler = self.sampler
+        def ms(seconds):
+            return "n/a" if seconds is None else F"{seconds * 1000:.0f} ms"
+        
+        lag = " | ".join(F"p{p} `{ms(percentile(sampler.loop_lag, p))}`" for p in (50, 95, 99))
+        rest = sampler.rest[-1] if sampler.rest else None
+        lines = [
+            F"**Gateway** `{ms(self.bot.latency)}` | **REST** `{ms(rest)}` (p95 `{ms(percentile(sampler.rest, 95))}`)",
+            F"**Loop lag** {lag} | max `{ms(max(sampler.loop_lag, default=None))}`",
+            ]
+        
+        if sampler.rss:
+            lines.append(F"**Memory** `{sampler.rss[-1] / 2 ** 20:.1f} MiB` | **CPU** `{sampler.cpu[-1] * 100:.1f}%` "
+                         F"(avg `{sum(sampler.cpu) / len(sampler.cpu) * 100:.1f}%`)")
+            
+        music = self.bot.get_cog("Music")
+        if music is not None:
+            extracting, queued = music.queue_depth()
+            lines.append(F"**Extractor** `{extracting}` waiting | **Queued songs** `{queued}`")
+            connects = music.voice.connect_times
+            lines.append(F"**Voice connects** p50 `{ms(percentile(connects, 50))}` p95 `{ms(percentile(connects, 95))}` | "
+                         F"`{len(self.bot.voice_clients)}` connected")
+            
+        games = [F"{name} `{len(cog.boards)}`" for name, cog in ((name, self.bot.get_cog(name)) for name in GAME_COGS) if cog]
+        if games:
+            lines.append("**Games** " + " | ".join(games))
+            
+        ## Only sharded bots have more than one latency.
+        latencies = getattr(self.bot, "latencies", None) or [(0, self.bot.latency)]
+        if len(latencies) > 1 or sampler.event_rates:
+            shards = []
+            for shard_id, latency in latencies[:20]:
+                rates = sampler.event_rates.get(shard_id)
+                rate = F"{rates[-1]:.0f}/min" if rates else "n/a"
+                shards.append(F"`#{shard_id}` `{ms(latency)}` | `{rate}` events")
+            lines.append("**Shards**\n" + "\n".join(shards))
+            
+        embed = discord.Embed(title="Diagnostics", description="\n".join(lines))
+        for guild_id, latencies in list(sampler.voice.items())[:10]:
+            guild = self.bot.get_guild(guild_id)
+            embed.add_field(name=guild.name if guild else str(guild_id),
+                            value=F"Voice `{ms(latencies[-1])}` (p95 `{ms(percentile(latencies, 95))}`)")
+        
+        uptime = int(time.monotonic() - sampler.started)
+        embed.set_footer(text=F"Sampling for {uptime // 3600}h {uptime % 3600 // 60}m")
+        await ctx.send(embed=embed)
+        
+    @commands.command(name="metrics")
+    @commands.is_owner()
+    async def show_metrics(self, ctx, *, cog: str=None):
+        """Shows how often each command runs, how often it fails, and how long it takes.
+        
+        Args:
+            cog [str]: Only show the commands of this cog, e.g. Music
+        """
+        snapshot = metrics.snapshot()
+        embed = discord.Embed(title="Command Metrics")
+        for cog_name, commands_ in sorted(snapshot["cogs"].items()):
+            if cog is not None and cog_name.lower() != cog.lower():
+                continue
+            ranked = sorted(commands_.items(), key=lambda item: -item[1]["count"])
+            lines = [F"`{name}` {stats['count']}x, {stats['errors']} err | "
+                     F"p50 `{stats['p50_ms']:.0f}` p95 `{stats['p95_ms']:.0f}` p99 `{stats['p99_ms']:.0f}` ms"
+                     for name, stats in ranked]
+            embed.add_field(name=cog_name, value="\n".join(lines)[:1024], inline=False)
+            
+        if not embed.fields:
+            return await ctx.send("No commands have been run yet." if cog is None else F"No commands from {cog} have been run yet.")
+        embed.set_footer(text=F"Since {snapshot['uptime'] // 3600}h {snapshot['uptime'] % 3600 // 60}m ago")
+        await ctx.send(embed=embed)
+        
     @commands.command(name="avatar")
-    async def get_avatar(self, ctx):
-        author = ctx.message.author
-        filename = F"{author}_avatar.jpg"
+    async def get_avatar(self, ctx, member: typing.Optional[discord.Member]=None, size: typing.Optional[int]=None, format: str=None):
+        """Sends a member's profile picture. e.g. !avatar, !avatar @someone 256 png
+        
+        Discord does any resizing and converting, so the image is never touched here.
+        
+        Args:
+            member [discord.Member]: Whose avatar to send, defaults to you
+            size [int]: Width in pixels, a power of 2 from 16 to 4096
+            format [str]: png, jpg, webp or gif, defaults to gif for animated avatars and png otherwise
+        """
+        member = member or ctx.author
+        if size is not None and size not in AVATAR_SIZES:
+            return await ctx.send(F"The size has to be one of {', '.join(map(str, AVATAR_SIZES))}.")
+        if format is not None:
+            format = format.lower()
+            if format not in AVATAR_FORMATS:
+                return await ctx.send(F"The format has to be one of {', '.join(AVATAR_FORMATS)}.")
+            if format == "gif" and not member.is_avatar_animated():
+                return await ctx.send("Only animated avatars can be sent as a gif.")
         
-        await ctx.author.avatar_url.save(filename)
-        file = discord.File(fp=filename)
+        extension = format or ("gif" if member.is_avatar_animated() else "png")
+        ## The hash changes whenever the avatar does, so old images just age out of the cache.
+        key = (member.id, member.avatar, extension, size)
+        data = self.avatars.get(key)
+        if data is None:
+            asset = member.avatar_url_as(format=format, static_format="png", size=size or 1024)
+            try:
+                data = await asset.read()
+            except discord.HTTPException:
+                return await ctx.send("Couldn't get that avatar, try again later.")
+            self.avatars.put(key, data)
         
-        await ctx.send("Here is your pfp =>", file=file)
+        file = discord.File(io.BytesIO(data), filename=F"avatar.{extension}")
+        await ctx.send("Here is your pfp =>" if member == ctx.author else F"Here is {member.display_name}'s pfp =>", file=file)
         
 def setup(bot):
-    bot.add_cog(Utilities(bot))
\ No newline at end of file
+    bot.add_cog(Utilities(bot))
@@ -2,17 +2,30 @@ import aiohttp
 import asyncio
 import discord
 import datetime
-import itertools
+import os
 import pytube
 import time
 import typing
 
-from async_timeout import timeout
 from discord.ext import commands
 from functools import partial
-from random import shuffle
 from youtube_dl import YoutubeDL
 
+from utils.audio import build_filters, loudness
+from utils.games import NUMBER_EMOJIS
+from utils.search import SearchCache
+from utils.songqueue import SongQueue, duration
+from utils.voice import VOICE_EMPTY_TIMEOUT, VoiceManager
+
+## Gateway intents this cog needs on top of the bot's base ones, read by bot.py.
+## Needed to join voice channels and see who is in them, and to see the reactions
+## picking a song from !search's results.
+REQUIRED_INTENTS = ("voice_states", "guild_reactions")
+
+## How long stream data extracted ahead of time, while measuring a queued song's loudness,
+## is trusted for. The stream URLs it has in it stop working after a while.
+STREAM_REUSE_SECONDS = 30 * 60
+
 YTDL_FORMATS = {
     'format' : 'bestaudio/best',
     'outtmpl' : 'downloads/%(extractor)s-%(id)s-%(title)s.%(ext)s',
@@ -27,6 +40,7 @@ YTDL_FORMATS = {
     'source_address' : '0.0.0.0'
 }
 
+## Each stream also gets its own -af filter graph, from utils.audio.build_filters.
 FFMPEG_OPTIONS = {
     'before_options': '-nostdin',
     'options': '-vn'
@@ -35,6 +49,18 @@ FFMPEG_OPTIONS = {
 LYRICS_URL = "https://some-random-api.ml/lyrics?title="
 
 ytdl = YoutubeDL(YTDL_FORMATS)
+## Searches only need each video's title and length, not its formats, which makes them much faster.
+ytdl_search = YoutubeDL({**YTDL_FORMATS, 'extract_flat': 'in_playlist'})
+
+## Songs shown on each page of !queue.
+QUEUE_PAGE_SIZE = 10
+
+## Whether new players take turns between requesters by default, instead of first come first served.
+FAIR_QUEUE = os.getenv("FAIR_QUEUE", "").lower() in ("1", "true", "yes", "on")
+
+## Results fetched by each !search, and how many of them are shown.
+SEARCH_FETCH = 10
+SEARCH_SHOWN = 5
 
 class VoiceConnectionError(commands.CommandError):
     """Custom Exception class for connection errors."""
@@ -89,6 +115,7 @@ class YTDLSource(discord.PCMVolumeTransformer):
         duration (int): The video duration.
         title (str): The video title.
         web_url (str): The video url.
+        stream_url (str): The url FFmpeg reads the audio from.
     """
     def __init__(self, source, *, data, requester, duration: int):
         super().__init__(source)
@@ -96,19 +123,45 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.duration = duration
         self.title = data.get('title')
         self.web_url = data.get('webpage_url')
+        self.stream_url = data.get('url')
+
+    ## How many extractions are running or waiting for a thread, shown by !diag.
+    pending = 0
 
     def __getitem__(self, item: str):
         """Allows access to attributes similar to a dict."""
         return self.__getattribute__(item)
     
+    @classmethod
+    async def extract(cls, url: str, *, loop, download=False, extractor=ytdl):
+        """Runs the extractor in another thread, keeping count of how many extractions are waiting."""
+        cls.pending += 1
+        try:
+            return await loop.run_in_executor(None, partial(extractor.extract_info, url=url, download=download))
+        finally:
+            cls.pending -= 1
+            
+    @classmethod
+    async def search(cls, query: str, *, loop, count: int=SEARCH_FETCH):
+        """Searches YouTube, getting the top results in a single request.
+        
+        @return:
+            A list of dicts with each video's title, url and duration.
+        """
+        data = await cls.extract(F"ytsearch{count}:{query}", loop=loop, extractor=ytdl_search)
+        return [{
+            'title': entry.get('title') or "Unknown title",
+            'webpage_url': F"https://www.youtube.com/watch?v={entry['id']}",
+            'duration': entry.get('duration') or 0}
+            for entry in data.get('entries') or [] if entry.get('id')]
+    
     @classmethod
     async def get_source_playlist(cls, ctx, song_link: str, *, loop, download=False):
         pass
     
         loop = loop or asyncio.get_event_loop()
         
-        to_run = partial(ytdl.extract_info, url=song_link, download=download)
-        data = await loop.run_in_executor(None, to_run)
+        data = await cls.extract(song_link, loop=loop, download=download)
         
         if 'entries' in data:
             data = data['entries'][0]
@@ -136,8 +189,7 @@ class YTDLSource(discord.PCMVolumeTransformer):
         """
         loop = loop or asyncio.get_event_loop()
 
-        to_run = partial(ytdl.extract_info, url=search, download=download)
-        data = await loop.run_in_executor(None, to_run)
+        data = await cls.extract(search, loop=loop, download=download)
 
         if 'entries' in data:
             data = data['entries'][0]
@@ -159,14 +211,27 @@ class YTDLSource(discord.PCMVolumeTransformer):
 
     @classmethod
     async def prepare_stream(cls, data, *, loop):
-        """Prepares a stream, instead of downloading."""
+        """Prepares a stream, instead of downloading.
+        
+        Normalizing and fading are done by FFmpeg's filter graph, using the track's
+        loudness if it was measured ahead of time. Stream data extracted back then is
+        used again, if it's recent enough.
+        """
         loop = loop or asyncio.get_event_loop()
         requester = data['requester']
         duration = data['duration']
-        to_run = partial(ytdl.extract_info, url=data['webpage_url'], download=False)
-        data = await loop.run_in_executor(None, to_run)
+        extracted = data.get('extracted')
+        if extracted and time.monotonic() - extracted[0] < STREAM_REUSE_SECONDS:
+            data = extracted[1]
+        else:
+            data = await cls.extract(data['webpage_url'], loop=loop)
 
-        return cls(discord.FFmpegPCMAudio(data['url']), data=data, requester=requester, duration=duration)
+        options = FFMPEG_OPTIONS['options']
+        filters = build_filters(duration, loudness.get(data['webpage_url']))
+        if filters:
+            options += F" -af {filters}"
+        audio = discord.FFmpegPCMAudio(data['url'], before_options=FFMPEG_OPTIONS['before_options'], options=options)
+        return cls(audio, data=data, requester=requester, duration=duration)
 
 
 class MusicPlayer:
@@ -183,15 +248,16 @@ class MusicPlayer:
         _guild (discord.guild): The current discord guild.
         next (asyncio.Event): The next event (song) to be played from the queue.
         np (YTDLSource): The current source.
-        queue (asyncio.Queue): A container of all queued songs.
+        queue (SongQueue): A container of all queued songs.
         start_time (float): The start time of the currently playing song.
         delta_time (float): The elapsed time in the song.
         volume (float): The current volume of the video player, represented as
         as a value from 0 to 1.
+        task (asyncio.Task): The running player loop.
     """
     
     __slots__ = ('bot', '_guild', '_channel', '_cog', 'queue', 'next',
-                'current', 'np', 'volume', 'start_time', 'loop', 'delta_time', 'song_embed')
+                'current', 'np', 'volume', 'start_time', 'loop', 'delta_time', 'song_embed', 'task')
     
     def __init__(self, ctx):
         self._channel = ctx.channel
@@ -202,13 +268,13 @@ class MusicPlayer:
         self.loop = False
         self.next = asyncio.Event()
         self.np = None
-        self.queue = asyncio.Queue()
+        self.queue = SongQueue(fair=FAIR_QUEUE)
         self.song_embed = None
         self.start_time = time.perf_counter()
         self.delta_time = 0.0
         self.volume = .5
         
-        ctx.bot.loop.create_task(self.player_loop())
+        self.task = ctx.bot.loop.create_task(self.player_loop())
         
     async def timer(self):
         """Keeps track of the song's runtime, and resets the runtime
@@ -233,13 +299,12 @@ class MusicPlayer:
         while not self.bot.is_closed():
             self.next.clear()
 
-            try:
-                ## Wait for the next song.
-                ## If it times out (10 min) then disconnect.
-                async with timeout(600):
-                    source = await self.queue.get()
-            except asyncio.TimeoutError:
-                return self.destroy(self._guild)
+            ## Wait for the next song.
+            ## If nothing gets queued for a while, the voice manager disconnects.
+            if self.queue.empty():
+                self._cog.voice.schedule_idle(self._guild)
+            source = await self.queue.get()
+            self._cog.voice.cancel_idle(self._guild.id)
 
             if not isinstance(source, YTDLSource):
                 try:
@@ -253,6 +318,7 @@ class MusicPlayer:
             source.volume = self.volume
             self.current = source
             self._guild.voice_client.play(source, after=lambda song: self.bot.loop.call_soon_threadsafe(self.next.set))
+            self.measure_upcoming()
         
             ## Get the url for the video thumbnail.
             video_id = source.web_url.split("=", 1)[1]
@@ -288,6 +354,26 @@ class MusicPlayer:
             except discord.HTTPException:
                 pass
 
+    def measure_upcoming(self):
+        """Measures the loudness of the next song in the background, so it's normalized evenly from its start.
+        
+        The stream data extracted for it is kept with the queued song, so it isn't
+        extracted a second time when it's played.
+        """
+        upcoming = next(iter(self.queue), None)
+        if upcoming is None:
+            return
+        async def upcoming_url():
+            if isinstance(upcoming, YTDLSource):
+                return upcoming.stream_url
+            data = await YTDLSource.extract(upcoming['webpage_url'], loop=self.bot.loop)
+            if 'entries' in data:
+                data = data['entries'][0]
+            upcoming['extracted'] = (time.monotonic(), data)
+            return data['url']
+        loudness.prefetch(upcoming['webpage_url'] if isinstance(upcoming, dict) else upcoming.web_url,
+                          upcoming['duration'] or 0, upcoming_url)
+
     def destroy(self, guild):
         """Disconnects and cleans the player.
         Useful if there is a timeout, or if the bot is no longer playing.
@@ -298,27 +384,54 @@ class MusicPlayer:
 class Music(commands.Cog):
     """Music related commands."""
 
-    __slots__ = ('bot', 'players')
+    __slots__ = ('bot', 'players', 'voice', 'searches')
 
     def __init__(self, bot):
         self.bot = bot
         self.players = {}
+        self.voice = VoiceManager(bot, on_idle=self.cleanup)
+        self.searches = SearchCache()
 
-    async def cleanup(self, guild, ctx):
+    async def cleanup(self, guild):
         """Cleans up the bot's player and the FFMPEG client."""
-        player = self.get_player(ctx)
-        player.loop = False
-        player.queue._queue = []
+        player = self.players.pop(guild.id, None)
+        if player is not None:
+            player.loop = False
+            player.queue.clear()
+            player.task.cancel()
         
-        try:
+        self.voice.forget(guild.id)
+        if guild.voice_client is not None:
             await guild.voice_client.disconnect()
-        except AttributeError:
-            pass
+            
+    @commands.Cog.listener()
+    async def on_resumed(self):
+        """Brings back any voice connections that dropped while the gateway was away."""
+        await self.voice.reconnect_all()
         
-        try:
-            del self.players[guild.id]
-        except KeyError:
-            pass
+    @commands.Cog.listener()
+    async def on_shard_resumed(self, shard_id):
+        await self.voice.reconnect_all()
+        
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        """Leaves voice channels soon after everyone else has left them."""
+        guild = member.guild
+        voice_client = guild.voice_client
+        if member.id == self.bot.user.id:
+            ## Disconnected by someone else, so don't try to come back.
+            if after.channel is None:
+                self.voice.forget(guild.id)
+            return
+        
+        if voice_client is None or voice_client.channel not in (before.channel, after.channel):
+            return
+        if not any(not listener.bot for listener in voice_client.channel.members):
+            self.voice.schedule_idle(guild, VOICE_EMPTY_TIMEOUT, force=True)
+        elif voice_client.is_playing():
+            self.voice.cancel_idle(guild.id)
+        else:
+            self.voice.schedule_idle(guild)
         
     def in_channel(self, ctx):
         """Checks if the message author is in the bot's voice channel."""
@@ -350,6 +463,10 @@ class Music(commands.Cog):
     def reset_np(self, ctx):
         pass
     
+    def queue_depth(self):
+        """Gets how many extractions are waiting, and how many songs are queued across every guild."""
+        return YTDLSource.pending, sum(player.queue.qsize() for player in self.players.values())
+    
     @commands.command(name='join', aliases=['connect'])
     async def connect_(self, ctx, *, channel: discord.VoiceChannel=None):
         """Connects the bot to a voice channel, or switches voice channels.
@@ -364,21 +481,11 @@ class Music(commands.Cog):
             except AttributeError:
                 raise InvalidVoiceChannel("No channel to join. Please either specify a valid channel or join one.")
 
-        vc = ctx.voice_client
-        if vc:
-            if vc.channel.id == channel.id:
-                return
-            try:
-                await vc.move_to(channel)
-            except asyncio.TimeoutError:
-                raise VoiceConnectionError(F"Moving to channel: <{channel}> timed out.")
-            
-        ## If channel is not provided, connect to the author's current channel.
-        else:
-            try:
-                await channel.connect()
-            except asyncio.TimeoutError:
-                raise VoiceConnectionError(F"Connecting to channel: <{channel}> timed out.")
+        ## Reuses the current connection if the bot is already there, and moves it if it's elsewhere.
+        try:
+            await self.voice.connect(channel)
+        except asyncio.TimeoutError:
+            raise VoiceConnectionError(F"Connecting to channel: <{channel}> timed out.")
     
     @commands.command(name='loop')
     async def loop_(self, ctx):
@@ -393,7 +500,7 @@ class Music(commands.Cog):
         
         while player.loop:
             try:
-                if source not in player.queue._queue:
+                if source not in player.queue:
                     await self.play_(ctx=ctx, song_search=source.title)
                     await asyncio.sleep(source.duration)
             except:
@@ -473,6 +580,50 @@ class Music(commands.Cog):
             
             await player.queue.put(source)
         
+    @commands.command(name='search', aliases=['find'])
+    async def search_(self, ctx, *, query: str):
+        """Searches for a song, and lets you pick which result to queue.
+        
+        React with the number of the result you want within 30 seconds.
+        
+        @param:
+            query [str]: What to search for.
+        """
+        results = self.searches.get(query)
+        if results is None:
+            async with ctx.typing():
+                results = await YTDLSource.search(query, loop=self.bot.loop)
+            self.searches.put(query, results)
+            
+        results = results[:SEARCH_SHOWN]
+        if not results:
+            return await ctx.send("No results found.", delete_after=15)
+        
+        lines = [F"{NUMBER_EMOJIS[i]} **{song['title']}** | `{datetime.timedelta(seconds=song['duration'])}`"
+                 for i, song in enumerate(results)]
+        search_embed = discord.Embed(title=F"Results for {query[:200]}", description="\n".join(lines), color=0x206694)
+        search_embed.set_footer(text="React with a number to queue that song.")
+        picker = await ctx.send(embed=search_embed)
+        for emoji in NUMBER_EMOJIS[:len(results)]:
+            await picker.add_reaction(emoji)
+            
+        def check(payload):
+            return (payload.message_id == picker.id and payload.user_id == ctx.author.id
+                    and str(payload.emoji) in NUMBER_EMOJIS[:len(results)])
+        try:
+            payload = await self.bot.wait_for('raw_reaction_add', check=check, timeout=30)
+        except asyncio.TimeoutError:
+            return await picker.delete()
+        
+        song = dict(results[NUMBER_EMOJIS.index(str(payload.emoji))], requester=ctx.author)
+        await picker.delete()
+        if not ctx.voice_client:
+            await ctx.invoke(self.connect_)
+            
+        player = self.get_player(ctx)
+        await player.queue.put(song)
+        await ctx.send(F"\nAdded **{song['title']}** to the Queue.", delete_after=15)
+        
     @commands.command(name='np')
     async def now_playing(self, ctx):
         """Gets the currently playing song and its timestamp."""
@@ -555,8 +706,12 @@ class Music(commands.Cog):
         return await ctx.send(F"**`{ctx.author}`** Paused the song!", delete_after=10)
 
     @commands.command(name='queue', aliases=['q', 'playlist'])
-    async def get_queue(self, ctx):
-        """Gets up to seven upcoming songs."""
+    async def get_queue(self, ctx, page: int=1):
+        """Gets a page of ten upcoming songs, and how long the rest of the queue will take.
+        
+        @param:
+            page [int]: Which page of the queue to show.
+        """
         vc = ctx.voice_client
         if not vc or not vc.is_connected():
             return await ctx.send("I am not currently connected to voice!", delete_after=10)
@@ -565,41 +720,113 @@ class Music(commands.Cog):
         if player.queue.empty():
             return await ctx.send("There are no more queued songs.")
 
-        upcoming = list(itertools.islice(player.queue._queue, 0, 10))
-        song_names = '\n'.join(F"**{song['title']}** | `{datetime.timedelta(seconds=song['duration'])}`" for song in upcoming)
+        pages = (len(player.queue) - 1) // QUEUE_PAGE_SIZE + 1
+        page = min(max(page, 1), pages)
+        start = (page - 1) * QUEUE_PAGE_SIZE
+        upcoming = player.queue.page(start, QUEUE_PAGE_SIZE)
+        song_names = '\n'.join(F"`{start + i}.` **{song['title']}** | `{datetime.timedelta(seconds=duration(song))}`"
+                                for i, song in enumerate(upcoming, start=1))
         queue_embed = discord.Embed(
-            title=F"Upcoming - Next {len(upcoming)}",
+            title=F"Upcoming - Page {page}/{pages}",
             description=song_names,
             color=0x206694
             )
         
-        await ctx.send(embed=queue_embed, delete_after=15)
+        ## What's left of the current song, plus everything queued after it.
+        remaining = player.queue.total_duration
+        if player.current is not None:
+            remaining += max(0, duration(player.current) - round(player.delta_time))
+        mode = " | Taking turns" if player.queue.fair else ""
+        queue_embed.set_footer(text=F"{len(player.queue)} songs | {datetime.timedelta(seconds=remaining)} remaining{mode}")
+        await ctx.send(embed=queue_embed, delete_after=30)
         
     @commands.command(name='removesong', aliases=['r'])
-    async def remove_song(self, ctx, *, spot: int):
-        """Removes a song at the given spot in the queue.
+    async def remove_song(self, ctx, *, spot: str):
+        """Removes the song at the given spot in the queue, or every song in a range of spots.
+        
+        e.g. !r 3, !r 5-40
         
         @param:
-            spot (int): The index to remove a video from.
+            spot (str): The spot to remove a video from, or a range like 5-40.
         """
         player = self.get_player(ctx)
-        songs_queue = player.queue._queue
         try:
-            song_title = songs_queue[spot - 1]['title']
-            del songs_queue[spot - 1]
-        except IndexError:
+            first, _, last = spot.partition("-")
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            return await ctx.send("Give a spot in the queue, or a range of spots like `5-40`.")
+        
+        if not 1 <= first <= last or first > len(player.queue):
             return await ctx.send("There is no song at the spot in the queue.")
         
-        await ctx.send(F"Removed `{song_title}` from the queue.")
+        removed = player.queue.remove_range(first - 1, last)
+        if len(removed) == 1:
+            return await ctx.send(F"Removed `{removed[0]['title']}` from the queue.")
+        await ctx.send(F"Removed `{len(removed)}` songs from the queue.")
+        
+    @commands.command(name='move', aliases=['mv'])
+    async def move_song(self, ctx, spot: int, new_spot: int):
+        """Moves a song to a different spot in the queue.
+        
+        When the queue takes turns, the song can only move within its requester's songs,
+        so it may land near the spot instead of on it.
+        
+        @param:
+            spot (int): The spot of the song to move.
+            new_spot (int): The spot to move it to.
+        """
+        player = self.get_player(ctx)
+        if not 1 <= spot <= len(player.queue) or not 1 <= new_spot <= len(player.queue):
+            return await ctx.send("There is no song at the spot in the queue.")
+        
+        song = player.queue.move(spot - 1, new_spot - 1)
+        if player.queue.fair:
+            new_spot = next(i for i, queued in enumerate(player.queue, start=1) if queued is song)
+        await ctx.send(F"Moved `{song['title']}` to spot {new_spot}.", delete_after=15)
+        
+    @commands.command(name='dedupe')
+    async def dedupe_(self, ctx):
+        """Removes songs that are already in the queue, keeping the first of each."""
+        player = self.get_player(ctx)
+        removed = player.queue.dedupe()
+        await ctx.send(F"Removed `{len(removed)}` duplicate songs from the queue.", delete_after=15)
+        
+    @commands.command(name='removeuser', aliases=['ru'])
+    async def remove_user(self, ctx, member: discord.Member):
+        """Removes every song a member queued.
+        
+        @param:
+            member (discord.Member): Whose songs to remove.
+        """
+        player = self.get_player(ctx)
+        removed = player.queue.remove_user(member.id)
+        await ctx.send(F"Removed `{len(removed)}` songs queued by {member.display_name}.", delete_after=15)
         
     @commands.command(name='shuffle')
     async def shuffle_(self, ctx):
         """Shuffles the queue."""
         player = self.get_player(ctx)
-        songs = player.queue._queue
-        shuffle(songs)
+        player.queue.shuffle()
         await ctx.send("Shuffled the queue.", delete_after=10)
         
+    @commands.command(name='fairqueue', aliases=['fq'])
+    async def fair_queue(self, ctx, mode: typing.Optional[bool]=None):
+        """Switches the queue between taking turns and first come first served.
+        
+        When taking turns, each member who queued songs gets one played in turn, so one big
+        playlist can't hold up everyone else. e.g. !fairqueue on, !fairqueue off
+        
+        @param:
+            mode (bool): on or off. Flips the current mode if left out.
+        """
+        player = self.get_player(ctx)
+        fair = not player.queue.fair if mode is None else mode
+        player.queue.set_fair(fair)
+        if fair:
+            return await ctx.send("The queue now takes turns between members.", delete_after=15)
+        await ctx.send("The queue now plays songs in the order they were added.", delete_after=15)
+        
     @commands.command(name='skip')
     async def skip_(self, ctx):
         """Skips the currently playing song."""
@@ -621,7 +848,7 @@ class Music(commands.Cog):
             return await ctx.send("I am not currently playing anything!", delete_after=10)
 
         ## Call cleanup and get rid of the player
-        await self.cleanup(ctx.guild, ctx)
+        await self.cleanup(ctx.guild)
         
     @commands.command(name='volume', aliases=['vol'])
     async def change_volume(self, ctx, *, vol: int):
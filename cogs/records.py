@@ -0,0 +1,129 @@
+import discord
+from discord.ext import commands
+
+from utils.history import history
+from utils.leaderboard import IDLE_EVICT, leaderboards
+from utils.scheduler import scheduler
+
+## Gateway intents this cog needs on top of the bot's base ones, read by bot.py.
+REQUIRED_INTENTS = ()
+
+## Which cog can replay each kind of recorded game.
+REPLAY_COGS = {"connectfour": "ConnectFour", "tictactoe": "TicTacToe"}
+
+## How each game is shown in the stats embed.
+GAME_NAMES = {"connectfour": "Connect Four", "tictactoe": "Tic-Tac-Toe"}
+
+## Players shown on each page of the leaderboard.
+PAGE_SIZE = 10
+
+class Records(commands.Cog):
+    """Replays, stats and leaderboards for finished games."""
+    
+    def __init__(self, bot):
+        self.bot = bot
+        history.open()
+        scheduler.every("leaderboard-evict", IDLE_EVICT / 4, leaderboards.evict)
+        
+    def cog_unload(self):
+        """Makes sure that no finished games or scores are lost when the cog is unloaded."""
+        scheduler.cancel("leaderboard-evict")
+        history.flush_now()
+        leaderboards.flush_now()
+        
+    def get_name(self, guild, user_id):
+        """Gets a player's display name, or a mention if they can't be found."""
+        member = guild.get_member(user_id) if guild else None
+        if member is None:
+            member = self.bot.get_user(user_id)
+        return member.display_name if member else F"<@{user_id}>"
+    
+    @commands.command(name="replay")
+    @commands.guild_only()
+    async def replay(self, ctx, game_id: int):
+        """Shows the final board and every move of a finished game.
+        
+        Args:
+            game_id (int): The number of the game, shown when it ended
+        """
+        record = await history.get_game(game_id)
+        ## Game numbers are shared by every guild, so only this guild's games can be replayed here.
+        if record is None or record.guild_id != ctx.guild.id:
+            return await ctx.send(F"There is no game #{game_id}.")
+        
+        cog = self.bot.get_cog(REPLAY_COGS.get(record.game, ""))
+        if cog is None:
+            return await ctx.send("I can't replay that kind of game right now.")
+        
+        first = self.get_name(ctx.guild, record.first_id)
+        second = self.get_name(ctx.guild, record.second_id)
+        winner = self.get_name(ctx.guild, record.winner_id) if record.winner_id else None
+        await ctx.send(embed=cog.replay_embed(record, first, second, winner))
+        
+    @commands.command(name="gamestats")
+    async def game_stats(self, ctx, member: discord.Member=None):
+        """Shows a player's wins, losses and ties in every game.
+        
+        Args:
+            member (discord.Member): The player to get stats for, defaults to the author
+        """
+        member = member or ctx.author
+        stats = await history.get_stats(member.id)
+        if not stats:
+            return await ctx.send(F"{member.display_name} hasn't finished any games yet.")
+        
+        lines = []
+        for game, (wins, losses, ties) in sorted(stats.items()):
+            lines.append(F"**{GAME_NAMES.get(game, game)}**: `{wins}` W | `{losses}` L | `{ties}` T")
+            
+        stats_embed = discord.Embed(title=F"Stats for {member.display_name}", description="\n".join(lines))
+        await ctx.send(embed=stats_embed)
+
+    @commands.command(name="leaderboard", aliases=["lb"])
+    @commands.guild_only()
+    async def leaderboard(self, ctx, page: int=1):
+        """Shows the guild's top players across every game, and the author's rank.
+        
+        Wins are worth 3 points and ties are worth 1.
+        
+        Args:
+            page (int): Which page of the leaderboard to show
+        """
+        board = await leaderboards.get(ctx.guild.id)
+        if not len(board):
+            return await ctx.send("No one has finished a game here yet.")
+        
+        pages = (len(board) - 1) // PAGE_SIZE + 1
+        page = min(max(page, 1), pages)
+        lines = []
+        for rank, user_id, (points, wins, losses, ties) in board.top(PAGE_SIZE, start=(page - 1) * PAGE_SIZE):
+            lines.append(F"`#{rank}` **{self.get_name(ctx.guild, user_id)}** - "
+                         F"`{points}` pts | `{wins}` W | `{losses}` L | `{ties}` T")
+            
+        lb_embed = discord.Embed(title=F"Leaderboard for {ctx.guild.name}", description="\n".join(lines))
+        author_rank = board.rank(ctx.author.id)
+        rank_text = F"Your rank: #{author_rank} of {len(board)}" if author_rank else "You haven't finished a game here yet."
+        lb_embed.set_footer(text=F"Page {page}/{pages} | {rank_text}")
+        await ctx.send(embed=lb_embed)
+        
+    @commands.command(name="rank")
+    @commands.guild_only()
+    async def rank(self, ctx, member: discord.Member=None):
+        """Shows a player's place on the guild's leaderboard.
+        
+        Args:
+            member (discord.Member): The player to get the rank of, defaults to the author
+        """
+        member = member or ctx.author
+        board = await leaderboards.get(ctx.guild.id)
+        rank = board.rank(member.id)
+        if rank is None:
+            return await ctx.send(F"{member.display_name} hasn't finished a game here yet.")
+        
+        points, wins, losses, ties = board.scores[member.id]
+        await ctx.send(F"**{member.display_name}** is ranked `#{rank}` of `{len(board)}` with `{points}` points "
+                       F"(`{wins}` W | `{losses}` L | `{ties}` T).")
+
+## Adds cog to the bot.
+def setup(bot):
+    bot.add_cog(Records(bot))
@@ -1,58 +1,296 @@
-from random import randint
+import asyncio
+import discord
+
+from discord import Embed
 from discord.ext import commands
 
+from utils.leaderboard import leaderboards
+from utils.rng import rng
+
+## Gateway intents this cog needs on top of the bot's base ones, read by bot.py.
+## Tournament signups and throws are reactions.
+REQUIRED_INTENTS = ("guild_reactions",)
+
+ROCK, PAPER, SCISSORS, NO_THROW = 0, 1, 2, 3
+
+## OUTCOMES[a][b] is how a throw of a against a throw of b goes: 0 for a tie, 1 if a wins, 2 if b wins.
+## Throwing anything beats not throwing, and two missing throws are a tie that gets settled by a coin flip.
+OUTCOMES = tuple(
+    tuple(0 if a == b else 2 if a == NO_THROW else 1 if b == NO_THROW else (a - b) % 3 for b in range(4))
+    for a in range(4))
+
+## Reactions used to join a tournament, and to throw rock, paper or scissors in one.
+JOIN_EMOJI = "✅"
+THROW_EMOJIS = ("\U0001faa8", "\U0001f4c4", "✂️")
+## Shown in the round summary for a player who didn't throw in time.
+NO_THROW_EMOJI = "❔"
+
+## Limits for a single tournament.
+MAX_PLAYERS = 64
+MAX_SIGNUP_TIME = 300
+MAX_ROUND_TIME = 120
+## Tied matches are thrown again this many times before a coin flip decides them.
+MAX_REPLAYS = 3
+
+class Tournament:
+    """A knockout rock paper scissors bracket running in one channel.
+
+    The bracket only ever has one message taking reactions: the signup message, then each
+    round's throw message. Throws are stored as they come in and the whole round is
+    resolved at once when everyone has thrown or time runs out.
+
+    Attributes:
+        channel (discord.TextChannel): The channel the tournament is running in.
+        host (discord.Member): Who started the tournament.
+        entrants (dict): IDs of the members who signed up, in the order they joined.
+        message (discord.Message): The message currently taking reactions.
+        waiting (set): IDs of the players who still need to throw this round.
+        throws (dict): Each player's throw this round.
+        done (asyncio.Event): Set once every player has thrown.
+    """
+    def __init__(self, channel, host):
+        self.channel = channel
+        self.host = host
+        self.entrants = {}
+        self.message = None
+        self.waiting = set()
+        self.throws = {}
+        self.done = asyncio.Event()
+
+    def react(self, user_id: int, emoji: str):
+        """Handles a reaction to the tournament's current message.
+
+        Returns:
+            (bool): If the reaction was a throw, and should be taken back off to keep it hidden.
+        """
+        if not self.waiting and emoji == JOIN_EMOJI and len(self.entrants) < MAX_PLAYERS:
+            self.entrants[user_id] = None
+            return False
+
+        if user_id not in self.throws and user_id not in self.waiting or emoji not in THROW_EMOJIS:
+            return False
+
+        ## Players can change their mind until the round is over.
+        self.throws[user_id] = THROW_EMOJIS.index(emoji)
+        self.waiting.discard(user_id)
+        if not self.waiting:
+            self.done.set()
+        return True
+
+    def start_throws(self, matches):
+        """Gets ready to take throws from everyone playing in the given matches."""
+        self.throws = {}
+        self.waiting = {player for match in matches for player in match}
+        self.done.clear()
+
+def resolve(matches, throws):
+    """Works out every match in a round in one pass over the outcome table.
+
+    Args:
+        matches (list): (first, second) pairs of player IDs
+        throws (dict): Each player's throw, players who didn't throw are missing
+
+    Returns:
+        (list): A (first throw, second throw, outcome) tuple for each match
+    """
+    results = []
+    for first, second in matches:
+        a, b = throws.get(first, NO_THROW), throws.get(second, NO_THROW)
+        results.append((a, b, OUTCOMES[a][b]))
+    return results
+
+
 class RockPaperScissors(commands.Cog):
-    """Cog to play rock paper scissors with the computer"""
+    """Cog to play rock paper scissors with the computer, or in tournaments"""
     def __init__(self, bot):
         self.bot = bot
-        self.ROCK, self.PAPER, self.SCISSORS = 0, 1, 2
+        self.ROCK, self.PAPER, self.SCISSORS = ROCK, PAPER, SCISSORS
         
         self.user_input_dict = {
             'rock': self.ROCK, 'paper': self.PAPER, 'scissors': self.SCISSORS
         }
 
         self.actions = ["smashes", "covers", "cuts"]
-        
-        ## List of tuples with the outcomes that result in either party winning.
-        self.win_cond = [(self.ROCK, self.SCISSORS), (self.PAPER, self.ROCK), (self.SCISSORS, self.PAPER)]
 
         self.winner_results = ('rock', 'paper', 'scissors')
         self.winner_emojis = (':rock:', ':roll_of_paper:', ':scissors:')
+        
+        ## Running tournaments, by channel ID and by the ID of the message taking their reactions.
+        self.tourneys = {}
+        self.tourney_messages = {}
     
     @commands.command(name = 'rps')
-    async def rockPaperScissors(self, ctx: commands.Context):
+    async def rockPaperScissors(self, ctx: commands.Context, choice: str = ""):
         """A true test of skill. (!rps rock, !rps paper, !rps scissors)"""
         
-        get_message = ctx.message.content[5:]
-        user_choice = self.user_input_dict.get(get_message)
-        comp_choice = randint(0, 2)
+        user_choice = self.user_input_dict.get(choice.lower())
         
         ## If user does not enter rock, paper, scissors.
-        if get_message not in self.winner_results:
+        if user_choice is None:
             await ctx.send('Please choose rock, paper, or scissors')
             return
         
-        await ctx.send(F'I choose {self.winner_emojis[comp_choice]}')
+        ## Games against the bot don't count towards the leaderboard, only tournament matches do.
+        comp_choice = rng.randint(0, 2)
+        outcome = OUTCOMES[user_choice][comp_choice]
         
         ## If player and computer throw the same choice.
-        if user_choice == comp_choice:
-            await ctx.send(F'A tie!')
-        else:
-            user_wins = (user_choice, comp_choice) in self.win_cond
-            
-            ## Assigns the 'winning choice' to the user's choice and 'losing choice' to the computer's if the user wins,
-            ## otherwise the computer's choice is the winning choice.
-            winner, loser = (user_choice, comp_choice) if user_wins else (comp_choice, user_choice)
-            
-            if user_wins:
-                ## If the user won.
-                win_or_lose = 'win'
-            else:
-                ## If the computer won.
-                win_or_lose = 'lose'
+        if outcome == 0:
+            await ctx.send(F'I choose {self.winner_emojis[comp_choice]} - A tie!')
+            return
+        
+        user_wins = outcome == 1
+            
+        ## Assigns the 'winning choice' to the user's choice and 'losing choice' to the computer's if the user wins,
+        ## otherwise the computer's choice is the winning choice.
+        winner, loser = (user_choice, comp_choice) if user_wins else (comp_choice, user_choice)
+        win_or_lose = 'win' if user_wins else 'lose'
+            
+        await ctx.send(F"I choose {self.winner_emojis[comp_choice]} - You {win_or_lose}! - "
+                       F"{self.winner_emojis[winner]} {self.actions[winner]} {self.winner_emojis[loser]}")
+                
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        """Takes signups and throws for tournaments."""
+        tourney = self.tourney_messages.get(payload.message_id)
+        if tourney is None or payload.user_id == self.bot.user.id:
+            return
+        
+        ## Take throws back off straight away, so the other player can't see them.
+        ## This needs the Manage Messages permission, throws still count without it.
+        if tourney.react(payload.user_id, str(payload.emoji)):
+            try:
+                await tourney.message.remove_reaction(payload.emoji, payload.member)
+            except discord.HTTPException:
+                pass
+            
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload):
+        """Lets members leave a tournament before it starts."""
+        tourney = self.tourney_messages.get(payload.message_id)
+        if tourney is not None and not tourney.waiting and str(payload.emoji) == JOIN_EMOJI:
+            tourney.entrants.pop(payload.user_id, None)
+            
+    async def take_reactions(self, tourney: Tournament, message, emojis, seconds: int):
+        """Opens a message up for reactions until time runs out, or everyone has thrown."""
+        tourney.message = message
+        self.tourney_messages[message.id] = tourney
+        try:
+            for emoji in emojis:
+                await message.add_reaction(emoji)
+            await asyncio.wait_for(tourney.done.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            del self.tourney_messages[message.id]
+            
+    async def play_round(self, tourney: Tournament, number: int, players: list, seconds: int):
+        """Plays one round of the bracket, replaying tied matches, and posts its summary.
+
+        Returns:
+            (list): The players going through to the next round
+        """
+        bye = players.pop() if len(players) % 2 else None
+        matches = list(zip(players[::2], players[1::2]))
+        guild = tourney.channel.guild
+        def name(user_id):
+            return getattr(guild.get_member(user_id), "display_name", F"<@{user_id}>")
+        
+        winners = [None] * len(matches)
+        lines = [None] * len(matches)
+        pending = list(range(len(matches)))
+        for replay in range(MAX_REPLAYS + 1):
+            playing = [matches[index] for index in pending]
+            tourney.start_throws(playing)
+            
+            title = F"Round {number}" if not replay else F"Round {number} - Replay {replay}"
+            description = "\n".join(F"{name(first)} vs {name(second)}" for first, second in playing)
+            embed = Embed(title=F"**{title}**", description=description[:4000])
+            embed.set_footer(text=F"React with your throw within {seconds} seconds. Your reaction will be hidden.")
+            mentions = " ".join(F"<@{player}>" for match in playing for player in match)
+            message = await tourney.channel.send(mentions if len(mentions) <= 2000 else None, embed=embed)
+            await self.take_reactions(tourney, message, THROW_EMOJIS, seconds)
+            
+            tied = []
+            for index, (a, b, outcome) in zip(pending, resolve(playing, tourney.throws)):
+                if outcome == 0:
+                    ## No point waiting on a replay if neither player showed up.
+                    if replay < MAX_REPLAYS and a != NO_THROW:
+                        tied.append(index)
+                        continue
+                    outcome = rng.randint(1, 2)
+                    
+                first, second = matches[index]
+                winners[index] = first if outcome == 1 else second
+                emojis = [THROW_EMOJIS[throw] if throw != NO_THROW else NO_THROW_EMOJI for throw in (a, b)]
+                lines[index] = (F"{name(first)} {emojis[0]} vs {emojis[1]} {name(second)} - "
+                                F"**{name(winners[index])}** wins" + (" (coin flip)" if a == b else ""))
+            
+            pending = tied
+            if not pending:
+                break
+            
+        if bye is not None:
+            lines.append(F"{name(bye)} gets a bye")
+            
+        summary = "\n".join(lines)
+        if len(summary) > 4000:
+            summary = summary[:4000] + "..."
+        await tourney.channel.send(embed=Embed(title=F"**Round {number} Results**", description=summary))
+        
+        await leaderboards.record(
+            guild.id,
+            wins=winners,
+            losses=[second if winner == first else first for (first, second), winner in zip(matches, winners)]
+            )
+        return winners + ([bye] if bye is not None else [])
+                
+    @commands.command(name = 'rpstourney')
+    @commands.guild_only()
+    async def rps_tournament(self, ctx: commands.Context, signup_time: int = 60, round_time: int = 30):
+        """Runs a knockout rock paper scissors tournament. e.g. !rpstourney, !rpstourney 120 20
+        
+        Members join by reacting to the signup message. Each round, everyone throws by
+        reacting to the round's message, and all of the matches are settled at once.
+        Ties are thrown again, and players left over in odd rounds get a bye.
+        
+        Args:
+            signup_time [int]: Seconds to wait for players to join, up to 300
+            round_time [int]: Seconds each round waits for throws, up to 120
+        """
+        if ctx.channel.id in self.tourneys:
+            await ctx.send("There is already a tournament running in this channel.")
+            return
+        
+        signup_time = max(10, min(signup_time, MAX_SIGNUP_TIME))
+        round_time = max(10, min(round_time, MAX_ROUND_TIME))
+        
+        tourney = Tournament(ctx.channel, ctx.author)
+        self.tourneys[ctx.channel.id] = tourney
+        try:
+            embed = Embed(
+                title="**Rock Paper Scissors Tournament**",
+                description=F"React with {JOIN_EMOJI} within {signup_time} seconds to join, up to {MAX_PLAYERS} players!"
+                )
+            embed.set_footer(text=F"Hosted by {ctx.author.display_name}")
+            message = await ctx.send(embed=embed)
+            await self.take_reactions(tourney, message, [JOIN_EMOJI], signup_time)
+            
+            players = list(tourney.entrants)
+            if len(players) < 2:
+                await ctx.send("Not enough players joined the tournament.")
+                return
+            
+            rng.shuffle(players)
+            number = 1
+            while len(players) > 1:
+                players = await self.play_round(tourney, number, players, round_time)
+                number += 1
                 
-            await ctx.send(F"You {win_or_lose}! - {self.winner_emojis[winner]} {self.actions[winner]} {self.winner_emojis[loser]}")
+            await ctx.send(F"<@{players[0]}> wins the tournament! :trophy:")
+        finally:
+            del self.tourneys[ctx.channel.id]
 
 ## Adds cog to the bot.
 def setup(bot):
-    bot.add_cog(RockPaperScissors(bot))
\ No newline at end of file
+    bot.add_cog(RockPaperScissors(bot))
@@ -1,8 +1,15 @@
 import discord
-from random import SystemRandom
 import re
 
 from discord.ext import commands
+from utils.games import NUMBER_EMOJIS, BoardMessage, GameRegistry
+from utils.history import history, pack_nibbles, unpack_nibbles
+from utils.leaderboard import leaderboards
+from utils.rng import rng
+
+## Gateway intents this cog needs on top of the bot's base ones, read by bot.py.
+## Reactions are used to play moves in react mode.
+REQUIRED_INTENTS = ("guild_reactions",)
 
 ## Discord's black square emoji. Represents an open space.
 square = ":black_large_square:"
@@ -16,12 +23,24 @@ class GameBoard:
 
         ## Randomize who goes first. Whoever gets ":x:" goes first.
         ## ":x:" is a red X, and ":o:" is a red O
-        if SystemRandom().randint(0, 1):
+        if rng.randint(0, 1):
             self.players = {":x:": p1, ":o:": p2}
         else:
             self.players = {":x:": p2, ":o:": p1}
 
         self.X_turn = True
+        ## Set by the GameRegistry once the game is registered.
+        self.key = None
+        ## The message showing this game's board, set by the cog.
+        self.message = None
+        ## Every space played, numbered 0 to 8, for the game history.
+        self.moves = []
+
+        ## Cached string for each row, so a move only rebuilds the row the letter went in.
+        self.rows = ["".join(row) for row in self.board]
+        self.rendered = None
+        ## Reused for every message about this game, only the text gets swapped out.
+        self.embed = discord.Embed()
 
     def check_all_space(self):
         """Checks all locations on the board for empty spaces.
@@ -76,6 +95,11 @@ class GameBoard:
         else:
             return False
 
+        ## Only the row that the letter went in needs to be rendered again.
+        self.rows[x] = "".join(self.board[x])
+        self.rendered = None
+        self.moves.append(x * 3 + y)
+
         ## If placing piece was sucessful, changes whose turn it is.
         self.X_turn = not self.X_turn
         return True
@@ -143,36 +167,128 @@ class GameBoard:
 
     def __str__(self):
         """Returns string representation of the current game board."""
-        ## Creates the board, with open spaces denoted by a black square.
-        _board = (
-        (F"{self.board[0][0]}{self.board[0][1]}{self.board[0][2]}\n") + 
+        if self.rendered is None:
+            self.rendered = "\n" + "\n".join(self.rows)
+        return self.rendered
 
-        (F"{self.board[1][0]}{self.board[1][1]}{self.board[1][2]}\n") +
-
-        (F"{self.board[2][0]}{self.board[2][1]}{self.board[2][2]}")
-        )
-        return (F"\n{_board}")
+    @classmethod
+    def from_moves(cls, first, second, moves):
+        """Rebuilds a board by playing back a recorded game.
+        
+        Args:
+            first: The player who went first, i.e. was ":x:".
+            second: The other player.
+            moves (list): Every space played, in order, numbered 0 to 8.
+            
+        Returns:
+            board (GameBoard): The board after the last move.
+        """
+        board = cls(first, second)
+        board.players = {":x:": first, ":o:": second}
+        for cell in moves:
+            board.update_board(*divmod(cell, 3))
+        return board
+
+    def to_embed(self, title, footer=None, note=None):
+        """Updates the board's embed with the current board.
+        
+        Args:
+            title (str): Title of the embed.
+            footer (str): Footer of the embed, if any.
+            note (str): Text to show below the board, if any.
+            
+        Returns:
+            embed (discord.Embed): The board's embed.
+        """
+        self.embed.title = title
+        self.embed.description = F"{self}\n{note}" if note else str(self)
+        if footer:
+            self.embed.set_footer(text=footer)
+        else:
+            self.embed.set_footer()
+        return self.embed
 
 
 class TicTacToe(commands.Cog):
-    ## Dictionary to store all running instances of the game, from different guilds.
-    boards = {}
+    ## Registry of all running instances of the game, from different guilds and channels.
+    boards = GameRegistry()
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.boards.on_expire = self.game_timed_out
 
-    def create(self, server_id, p1, p2):
+    def create(self, ctx, p1, p2):
         """Creates an instance of the GameBoard class.
         
         Args: 
-            server_id (int): ID of the guild that is running on.
-            p1 (int): ID of player 1, who started the game.
-            p2 (int): ID of player 2, who was challenged to play.
+            ctx (commands.Context): Context of the command that started the game.
+            p1 (discord.Member): Player 1, who started the game.
+            p2 (discord.Member): Player 2, who was challenged to play.
             
         Returns:
-            first_turn: The player whose letter will be ":x:". This player always goes first.
+            board: The new game board.
         """
-        self.boards[server_id] = GameBoard(p1, p2)
-        ## Return who is ":x:", i.e. who is going first.
-        first_turn = self.boards[server_id].players[":x:"]
-        return first_turn
+        board = GameBoard(p1, p2)
+        board.message = BoardMessage(ctx.channel)
+        self.boards.add(ctx.guild.id, ctx.channel.id, p1, p2, board)
+        return board
+
+    async def finish(self, board, winner):
+        """Ends a game, saving it to the game history and the guild's leaderboard.
+        
+        Args:
+            board (GameBoard): The board of the finished game.
+            winner (discord.Member): The winner, or None for a tie.
+            
+        Returns:
+            game_id (int): The game's number in the history.
+        """
+        self.boards.remove(board.key)
+        first, second = board.players[":x:"], board.players[":o:"]
+        game_id = history.record("tictactoe", board.key, first, second, winner, pack_nibbles(board.moves))
+
+        guild_id = board.key[0]
+        if winner is None:
+            await leaderboards.record(guild_id, ties=[first.id, second.id])
+        else:
+            loser = second if winner == first else first
+            await leaderboards.record(guild_id, wins=[winner.id], losses=[loser.id])
+        return game_id
+
+    def replay_embed(self, record, first, second, winner):
+        """Rebuilds a finished game from the history.
+        
+        Args:
+            record (GameRecord): The recorded game.
+            first (str): Name of the player who went first.
+            second (str): Name of the other player.
+            winner (str): Name of the winner, or None for a tie.
+            
+        Returns:
+            embed (discord.Embed): The final board and every space played.
+        """
+        moves = unpack_nibbles(record.moves)
+        board = GameBoard.from_moves(first, second, moves)
+        result = F"{winner} won" if winner else "A tie"
+        title = F"Game #{record.id}: {first} vs. {second} - {result}"
+        spaces = " ".join(str(cell + 1) for cell in moves)
+        return board.to_embed(title, footer=F"Spaces played (1-9, left to right, top to bottom): {spaces}")
+
+    async def game_timed_out(self, key, board):
+        """Lets the players know that their game was stopped for going idle.
+        
+        Args:
+            key (tuple): The key of the game in the registry
+            board (GameBoard): The board of the game that timed out
+        """
+        channel = self.bot.get_channel(key[1])
+        if channel is None:
+            return
+        
+        p1, p2 = board.players.values()
+        minutes = round(self.boards.idle_timeout / 60)
+        await channel.send(F"The game of tic-tac-toe between {p1.display_name} and {p2.display_name} "
+                           F"timed out after {minutes} minutes without a move.")
 
     @commands.group(aliases=["tic", "tac", "toe", "ttt"], invoke_without_command=True)
     @commands.guild_only()
@@ -196,18 +312,11 @@ class TicTacToe(commands.Cog):
             None: If an occupied, or non-existent space is given.
         """
         player = ctx.message.author
-        board = self.boards.get(ctx.message.guild.id)
+        board = self.boards.find(ctx.guild.id, ctx.channel.id, player.id)
 
-        ## Make sure that the board exists, i.e. a game is running on that guild.
+        ## Make sure that the board exists, i.e. the player has a game running in this channel.
         if not board:
-            await ctx.send("There are currently no game running!")
-            return
-
-        ## Make sure that it is that player's turn.
-        ## Prevent player ":x:" from going during ":x:"s turn, and the reverse.
-        ## Also stop any random member from messing with the game.
-        if not board.can_play(player):
-            await ctx.send("You cannot play right now!")
+            await ctx.send("You don't have a game running here!")
             return
 
         ## Search the player's message for these options, just checks if it exists.
@@ -259,10 +368,30 @@ class TicTacToe(commands.Cog):
         elif (left or right) and not (top or bottom):
             x = 1
 
+        await self.play(board, ctx.channel, player, x, y)
+
+    async def play(self, board, channel, player, x, y):
+        """Plays a move, from either a command or a reaction on the board message.
+        
+        Args:
+            board (GameBoard): The board of the player's game.
+            channel (discord.TextChannel): The channel the game is running in.
+            player (discord.Member): The player making the move.
+            x (int): Row to place the letter in.
+            y (int): Column to place the letter in.
+        """
+        ## Make sure that it is that player's turn.
+        ## Prevent player ":x:" from going during ":o:"s turn, and the reverse.
+        ## Also stop any random member from messing with the game.
+        if not board.can_play(player):
+            await channel.send("You cannot play right now!")
+            return
+
         ## If that space already has a letter, does nothing.
         if not board.update_board(x, y):
-            await ctx.send("Someone has already played a piece there!")
+            await channel.send("Someone has already played a piece there!")
             return
+        self.boards.touch(board.key)
 
         ## Check if there is a winner yet.
         winner = board.check_board()
@@ -275,24 +404,17 @@ class TicTacToe(commands.Cog):
             
             winner_msg = (F"{winner.display_name} has won!")
             loser_msg = (F"\nSounds like {loser.display_name} has a skill issue.")
-            done_embed = discord.Embed(title=winner_msg, description=(F"{str(board)}\n{loser_msg}"))
-            await ctx.send(embed=done_embed)
             ## End the game, so a new one can start
-            try:
-                del self.boards[ctx.message.guild.id]
-            except KeyError:
-                pass
+            game_id = await self.finish(board, winner)
+            done_embed = board.to_embed(winner_msg, footer=F"Game #{game_id}", note=loser_msg)
+            await board.message.update(done_embed)
             
         else:
             ## If all spaces are full, and there are no winning combinations, it's a tie.
             if board.check_all_space():
-                tie_embed = discord.Embed(title="A tie!\n", description=str(board))
-                tie_embed.set_footer(text="I suppose you both are equally bad.")
-                await ctx.send(embed=tie_embed)
-                try:
-                    del self.boards[ctx.message.guild.id]
-                except KeyError:
-                    pass
+                game_id = await self.finish(board, None)
+                tie_embed = board.to_embed("A tie!\n", footer=F"I suppose you both are equally bad. | Game #{game_id}")
+                await board.message.update(tie_embed)
             else:
                 ## If no one has won yet, then alert whose turn it is and keep going.
                 if board.X_turn:
@@ -301,16 +423,43 @@ class TicTacToe(commands.Cog):
                     player_turn = board.players.get(":o:")
                     
                 turn_msg = (F"{player_turn.display_name}, it's now your turn!\n")
-                turn_embed = discord.Embed(title=turn_msg, description=str(board))
-                await ctx.send(embed=turn_embed)
+                await board.message.update(board.to_embed(turn_msg))
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        """Plays a move when a player reacts to their board message with a space number.
+        
+        Spaces are numbered from one to nine, left to right and top to bottom.
+        """
+        board = self.boards.find_by_message(payload.message_id)
+        if board is None or payload.user_id == self.bot.user.id:
+            return
+
+        emoji = str(payload.emoji)
+        if emoji not in NUMBER_EMOJIS:
+            return
+
+        ## Take the reaction back off, to keep the board message tidy.
+        message = board.message.message
+        try:
+            await message.remove_reaction(payload.emoji, payload.member)
+        except discord.HTTPException:
+            pass
+
+        x, y = divmod(NUMBER_EMOJIS.index(emoji), 3)
+        await self.play(board, message.channel, payload.member, x, y)
 
     @commands.command(name="starttic", aliases=["challenge", "create"])
     @commands.guild_only()
-    async def start_game(self, ctx, p2: discord.Member):
+    async def start_game(self, ctx, p2: discord.Member, mode: str=None):
         """Starts a game of Tic-Tac-Toe.
         
+        The board is kept in one message, which gets edited after every move.
+        
         Args:
             p2 (discord.Member): The member of the guild who was challenged to play
+            mode (str): "react" to play moves by reacting to the board with a space number,
+            instead of using the tictactoe command
         
         @return:
             None: If there is already a running game, or if there is an
@@ -318,10 +467,11 @@ class TicTacToe(commands.Cog):
         """
         p1 = ctx.message.author
         
-        ## Only one game per server, else things would get pretty complicated.
-        if self.boards.get(ctx.message.guild.id) is not None:
-            await ctx.send("Only one game can run at a time!")
-            return
+        ## Each player can only be in one game per channel, else things would get pretty complicated.
+        for player in (p1, p2):
+            if self.boards.find(ctx.guild.id, ctx.channel.id, player.id) is not None:
+                await ctx.send(F"{player.display_name} is already playing in this channel!")
+                return
 
         ## If the member challenges the bot. Very offensive.
         if p2 == ctx.message.guild.me:
@@ -334,24 +484,29 @@ class TicTacToe(commands.Cog):
         ##    return
         
         ## Create the board and return who is ":x:", and will go first.
-        x_player = self.create(ctx.message.guild.id, p1, p2)
+        board = self.create(ctx, p1, p2)
+        x_player = board.players[":x:"]
         
         ## Announce that the game has started, print the board and who goes first.
         start_msg = (F"A game of tic-tac-toe has started between {p1.display_name} and {p2.display_name}!\n")
-        start_board = str(self.boards[ctx.message.guild.id])
-        start_embed = discord.Embed(title=start_msg, description=start_board)
-        start_embed.set_footer(text=(F"\nBy pure skill, I have decided that {x_player.display_name} will go first!"))
-        await ctx.send(embed=start_embed)
+        start_footer = (F"\nBy pure skill, I have decided that {x_player.display_name} will go first!")
+        start_embed = board.to_embed(start_msg, footer=start_footer)
+        await board.message.update(start_embed)
+
+        if mode == "react":
+            self.boards.bind_message(board.key, board.message.message.id)
+            await board.message.add_reactions(NUMBER_EMOJIS)
 
     @tictactoe.command(name="stopttt", aliases=["remove", "end"])
     @commands.guild_only()
     async def stop_game(self, ctx):
-        """Stops the currently running game, if there is one."""
-        if self.boards.get(ctx.message.guild.id) is None:
-            await ctx.send("There are no games running right now.")
+        """Stops the author's game in this channel, if there is one."""
+        board = self.boards.find(ctx.guild.id, ctx.channel.id, ctx.author.id)
+        if board is None:
+            await ctx.send("You don't have a game running here.")
             return
         
-        del self.boards[ctx.message.guild.id]
+        self.boards.remove(board.key)
         await ctx.send("Looks like tic-tac-toe has become tic-tac-no")
 
 ## Add cog to the bot.
@@ -0,0 +1,78 @@
+import asyncio
+import re
+import unittest
+
+from types import SimpleNamespace
+
+from cogs.dndrolls import RollTypes
+from utils.dice import OFFLOAD_THRESHOLD
+
+## How many rolls are fired at once.
+ROLLS = 5000
+
+DESCRIPTION_RE = re.compile(r"\*\*Rolled\*\* (.*) for `(.*)`!", re.S)
+
+class FakeContext:
+    """Stands in for commands.Context, keeping every embed sent through it.
+
+    send yields to the event loop before keeping the embed, so every roll in flight
+    gets a chance to run in between, the way they would while waiting on Discord.
+    """
+    def __init__(self, number: int):
+        self.message = SimpleNamespace(author=SimpleNamespace(display_name=F"roller-{number}"))
+        self.sent = []
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        await asyncio.sleep(0)
+        self.sent.append(embed or content)
+
+
+class ConcurrentRollTest(unittest.IsolatedAsyncioTestCase):
+    """Fires thousands of rolls at once, and checks each reply only has its own roll in it."""
+
+    async def asyncSetUp(self):
+        self.cog = RollTypes(SimpleNamespace(loop=asyncio.get_running_loop()))
+
+    async def test_rolls_do_not_interleave(self):
+        ## Each kind of roll, with the title it should get, how many numbers its reply shows,
+        ## and how its result follows from them.
+        kinds = [
+            (RollTypes.ability_roll, "Ability Roll", 4, lambda dice: sum(sorted(dice)[1:])),
+            (RollTypes.advantage_roll, "Advantage Roll", 2, max),
+            (RollTypes.disadvantage_roll, "Disadvantage Roll", 2, min),
+        ]
+        ## Enough one-sided dice to be rolled on another thread, so other rolls run while it waits.
+        big = OFFLOAD_THRESHOLD + 1
+        contexts, calls, expected = [], [], []
+        for number in range(ROLLS):
+            ctx = FakeContext(number)
+            ## A different modifier for every !roll, so mixed up replies can't match by chance.
+            if number % 8 == 7:
+                calls.append(RollTypes.standard_roll.callback(self.cog, ctx, expression=F"{big}d1+{number}"))
+                expected.append((F"Standard Roll - {big}d1 + {number}", None, lambda dice, number=number: big + number))
+            elif number % 8 == 3:
+                calls.append(RollTypes.standard_roll.callback(self.cog, ctx, expression=F"1d20+{number}"))
+                expected.append((F"Standard Roll - 1d20 + {number}", 2, lambda dice, number=number: dice[0] + number))
+            else:
+                command, title, shown, result = kinds[number % 4]
+                calls.append(command.callback(self.cog, ctx))
+                expected.append((title, shown, result))
+            contexts.append(ctx)
+
+        await asyncio.gather(*calls)
+
+        for number, (ctx, (title, shown, result)) in enumerate(zip(contexts, expected)):
+            self.assertEqual(len(ctx.sent), 1)
+            embed = ctx.sent[0]
+            self.assertEqual(embed.title, F"**{title}**")
+            self.assertEqual(embed.footer.text, F"Rolled by roller-{number}")
+            rolled, final = DESCRIPTION_RE.fullmatch(embed.description).groups()
+            dice = [int(die) for die in re.findall(r"\d+", rolled.replace(",", ""))]
+            ## Summaries of big rolls show a histogram, instead of one number per die.
+            if shown is not None:
+                self.assertEqual(len(dice), shown)
+            self.assertEqual(int(final), result(dice))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,4 @@
+"""Shared helpers used by the bot's cogs.
+
+These live outside of ./cogs, since bot.py loads every module in there as an extension.
+"""
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import math
+import os
+import tempfile
+
+from utils.cache import LRUCache
+
+## Loudness every track is brought to, as EBU R128 targets: integrated loudness in LUFS,
+## true peak in dBTP and loudness range in LU. AUDIO_NORMALIZE=off plays tracks as they are.
+AUDIO_NORMALIZE = os.getenv("AUDIO_NORMALIZE", "on").lower() not in ("0", "false", "no", "off")
+TARGET_LOUDNESS = float(os.getenv("AUDIO_TARGET_LOUDNESS", -16))
+TARGET_PEAK = -1.5
+TARGET_RANGE = 11
+
+## Seconds each track fades in and out over, so one track runs into the next. 0 turns it off.
+AUDIO_FADE = float(os.getenv("AUDIO_FADE", 0))
+
+## Measuring decodes the whole track, so only so many run at once, and long tracks are skipped.
+MEASURE_WORKERS = 2
+MEASURE_MAX_DURATION = 20 * 60
+
+## How many tracks' measurements are kept, and where they're saved between restarts.
+LOUDNESS_CACHE_SIZE = 5000
+LOUDNESS_PATH = os.path.join("data", "loudness.json")
+
+## The loudnorm first pass values that the second pass takes back in.
+MEASURED_KEYS = {
+    "input_i": "measured_I",
+    "input_tp": "measured_TP",
+    "input_lra": "measured_LRA",
+    "input_thresh": "measured_thresh",
+    "target_offset": "offset",
+}
+
+def build_filters(duration: int, measured: dict=None):
+    """Builds the FFmpeg audio filter graph for a track, so FFmpeg does the processing while decoding.
+
+    Args:
+        duration (int): The track's length in seconds, used to time the fade out. None for
+        live streams, which don't get fades.
+        measured (dict): The track's loudnorm measurements, if it's been measured.
+
+    Returns:
+        (str): The filters to give to -af, or an empty string when there are none.
+    """
+    filters = []
+    if AUDIO_NORMALIZE:
+        target = F"loudnorm=I={TARGET_LOUDNESS}:TP={TARGET_PEAK}:LRA={TARGET_RANGE}"
+        if measured:
+            ## Knowing the track's loudness up front lets loudnorm apply one steady gain,
+            ## instead of adjusting as it goes, which keeps the track's dynamics intact.
+            values = ":".join(F"{MEASURED_KEYS[key]}={value}" for key, value in measured.items())
+            target += F":{values}:linear=true"
+        filters.append(target)
+
+    ## Fades are left off tracks too short for them to sound right.
+    if AUDIO_FADE and duration and duration > 4 * AUDIO_FADE:
+        filters.append(F"afade=t=in:d={AUDIO_FADE}")
+        filters.append(F"afade=t=out:st={duration - AUDIO_FADE}:d={AUDIO_FADE}")
+    return ",".join(filters)
+
+def parse_measurements(output: str):
+    """Reads the stats loudnorm prints at the end of a first pass.
+
+    Returns:
+        (dict): The values the second pass needs, or None if the track couldn't be measured.
+    """
+    try:
+        stats = json.loads(output[output.rindex("{"):output.rindex("}") + 1])
+        measured = {key: float(stats[key]) for key in MEASURED_KEYS}
+    except (ValueError, KeyError):
+        return None
+    ## Silent tracks measure as -inf, which the second pass can't use.
+    if not all(math.isfinite(value) for value in measured.values()):
+        return None
+    return measured
+
+
+class LoudnessCache:
+    """Measures how loud tracks are ahead of time, and remembers the results.
+
+    Tracks are measured in the background with a loudnorm first pass, usually while the
+    track before them is playing, so by the time they play they can be normalized with a
+    single steady gain. Tracks that haven't been measured yet are still normalized, just
+    on the fly.
+
+    Attributes:
+        path (str): Path of the JSON file the measurements are saved to.
+        cache (LRUCache): Maps a track's URL to its measurements.
+        measuring (dict): Maps the URL of each track being measured to its task.
+        semaphore (asyncio.Semaphore): Limits how many tracks are measured at once.
+        loaded (bool): Whether the saved measurements have been read yet.
+    """
+    def __init__(self, path: str=LOUDNESS_PATH, max_size: int=LOUDNESS_CACHE_SIZE):
+        self.path = path
+        self.cache = LRUCache(max_size)
+        self.measuring = {}
+        self.semaphore = None
+        self.loaded = False
+
+    def load(self):
+        """Reads the saved measurements, the first time they're needed."""
+        if self.loaded:
+            return
+        self.loaded = True
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                for url, measured in json.load(file).items():
+                    self.cache.put(url, measured)
+
+    async def save(self):
+        """Saves the measurements on another thread, so the event loop isn't held up by the write."""
+        entries = dict(self.cache.entries)
+        await asyncio.get_event_loop().run_in_executor(None, self._write, entries)
+
+    def _write(self, entries):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        ## Other processes may have saved tracks of their own since this one read the file.
+        try:
+            with open(self.path) as file:
+                entries = {**json.load(file), **entries}
+        except (OSError, ValueError):
+            pass
+        entries = dict(list(entries.items())[-self.cache.max_size:])
+        ## Write to a temporary file first, so a crash can't leave the file half written. Each
+        ## write gets its own file, so processes for other shards can't write over each other's.
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(entries, file)
+            os.replace(temp_path, self.path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+
+    def get(self, url: str):
+        """Gets a track's measurements, or None if it hasn't been measured."""
+        self.load()
+        return self.cache.get(url)
+
+    def prefetch(self, url: str, duration: int, get_stream_url):
+        """Starts measuring a track in the background, unless it's known, already being measured, or too long.
+
+        Args:
+            url (str): The track's page URL, which the measurements are saved under.
+            duration (int): The track's length in seconds.
+            get_stream_url (coroutine function): Gets the URL FFmpeg can read the audio from.
+        """
+        self.load()
+        if (not AUDIO_NORMALIZE or url in self.cache or url in self.measuring
+                or not 0 < (duration or 0) <= MEASURE_MAX_DURATION):
+            return
+        task = asyncio.ensure_future(self.measure(url, get_stream_url))
+        self.measuring[url] = task
+        task.add_done_callback(lambda _: self.measuring.pop(url, None))
+
+    async def measure(self, url: str, get_stream_url):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(MEASURE_WORKERS)
+
+        async with self.semaphore:
+            try:
+                stream_url = await get_stream_url()
+                process = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-nostdin", "-hide_banner", "-i", stream_url, "-vn",
+                    "-af", F"loudnorm=I={TARGET_LOUDNESS}:TP={TARGET_PEAK}:LRA={TARGET_RANGE}:print_format=json",
+                    "-f", "null", "-",
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                _, output = await process.communicate()
+
+                measured = parse_measurements(output.decode(errors="replace"))
+                if measured is not None:
+                    self.cache.put(url, measured)
+                    await self.save()
+            except Exception as e:
+                print(F"Error measuring loudness of {url}: {e}")
+
+
+loudness = LoudnessCache()
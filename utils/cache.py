@@ -0,0 +1,69 @@
+from collections import OrderedDict
+
+class LRUCache:
+    """A dict that throws out the least recently used entries once it gets too big.
+
+    How big each entry counts as is up to sizeof, so the same cache can be capped by
+    entry count (the default) or by something like total bytes, with sizeof=len.
+
+    Attributes:
+        max_size (int): The most the entries can add up to.
+        sizeof (function): Gets the size of a value.
+        entries (OrderedDict): The cached values, least recently used first.
+        size (int): What the entries add up to right now.
+        hits (int): How many lookups found their value.
+        misses (int): How many lookups didn't.
+    """
+    def __init__(self, max_size: int, sizeof=lambda value: 1):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """Gets a value, marking it as just used."""
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Adds a value, throwing out old entries to make room.
+
+        Values bigger than the whole cache aren't stored at all.
+        """
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.max_size:
+            _, old = self.entries.popitem(last=False)
+            self.size -= self.sizeof(old)
+
+    def pop(self, key, default=None):
+        """Removes a value, returning it."""
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.size -= self.sizeof(value)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
@@ -0,0 +1,107 @@
+from utils.dice import DiceError, roll_dice
+
+## Point-buy cost of each score. 8 to 15 are the standard costs, the rest extend the same curve.
+POINT_BUY_COSTS = {
+    3: -9, 4: -6, 5: -4, 6: -2, 7: -1, 8: 0, 9: 1, 10: 2,
+    11: 3, 12: 4, 13: 5, 14: 7, 15: 9, 16: 12, 17: 15, 18: 19
+}
+
+## How many dice each method rolls per score, and how many of the highest it keeps.
+METHODS = {"4d6": (4, 3), "3d6": (3, 3)}
+
+## Most arrays in a single command, and most times a failed array is rolled again.
+MAX_ARRAYS = 20
+MAX_REROLLS = 50
+
+def modifier(score: int):
+    """Gets the ability modifier for a score."""
+    return (score - 10) // 2
+
+
+class StatArray:
+    """Six ability scores, rolled together.
+
+    Attributes:
+        scores (list): The six scores, from highest to lowest.
+        total (int): The sum of the scores.
+        modifiers (int): The sum of the scores' modifiers.
+        point_buy (int): What the array would cost with point-buy.
+    """
+    def __init__(self, scores):
+        self.scores = sorted(scores, reverse=True)
+        self.total = sum(self.scores)
+        self.modifiers = sum(modifier(score) for score in self.scores)
+        self.point_buy = sum(POINT_BUY_COSTS[score] for score in self.scores)
+
+    def __str__(self):
+        return " ".join(F"{score}({modifier(score):+})" for score in self.scores)
+
+
+def roll_arrays(count: int, method: str="4d6", reroll_ones: bool=False, minimum: int=0):
+    """Rolls any number of six-stat arrays, all in one batch.
+
+    Args:
+        count (int): How many arrays to roll
+        method (str): "4d6" to drop the lowest of four dice, or "3d6" to keep all three
+        reroll_ones (bool): Roll every 1 again, once
+        minimum (int): Roll arrays again until their scores add up to at least this
+
+    Returns:
+        arrays (list): A StatArray for each array.
+
+    Raises:
+        DiceError: If the options aren't valid.
+    """
+    if not 1 <= count <= MAX_ARRAYS:
+        raise DiceError(F"You can roll from 1 to {MAX_ARRAYS} arrays at a time.")
+    if method not in METHODS:
+        raise DiceError(F"The method has to be one of: {', '.join(METHODS)}.")
+
+    dice, keep = METHODS[method]
+    if minimum > 18 * 6:
+        raise DiceError("No array can add up to that much.")
+
+    arrays = []
+    needed = count
+    for _ in range(MAX_REROLLS):
+        ## Every die for every score of every array we still need, in one call.
+        rolls = roll_dice(needed * 6 * dice, 6)
+        if reroll_ones:
+            ones = [i for i, value in enumerate(rolls) if value == 1]
+            for i, value in zip(ones, roll_dice(len(ones), 6)):
+                rolls[i] = value
+
+        for start in range(0, len(rolls), 6 * dice):
+            block = rolls[start:start + 6 * dice]
+            scores = [sum(sorted(block[i:i + dice], reverse=True)[:keep]) for i in range(0, len(block), dice)]
+            array = StatArray(scores)
+            if array.total >= minimum:
+                arrays.append(array)
+
+        needed = count - len(arrays)
+        if not needed:
+            return arrays
+
+    raise DiceError(F"Couldn't roll arrays adding up to {minimum} after {MAX_REROLLS} tries. Try a lower minimum.")
+
+def parse_options(options):
+    """Reads the options given to the stat block commands.
+
+    Options are "3d6" or "4d6" for the method, "r1" to reroll ones,
+    and "min=N" for the lowest total an array can have.
+
+    Returns:
+        (dict): Keyword arguments for roll_arrays.
+    """
+    parsed = {}
+    for option in options:
+        option = option.lower()
+        if option in METHODS:
+            parsed["method"] = option
+        elif option == "r1":
+            parsed["reroll_ones"] = True
+        elif option.startswith("min=") and option[4:].isdigit():
+            parsed["minimum"] = int(option[4:])
+        else:
+            raise DiceError(F"I don't know the option `{option}`.")
+    return parsed
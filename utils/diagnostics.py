@@ -0,0 +1,139 @@
+import asyncio
+import os
+import time
+import traceback
+
+from collections import Counter, deque
+
+from utils.sharding import shard_for
+
+## How often each measurement is taken, in seconds.
+LAG_INTERVAL = 0.5
+PROCESS_INTERVAL = 5
+REST_INTERVAL = 60
+
+## Samples kept for each measurement, so memory use never grows.
+LAG_SAMPLES = 240
+PROCESS_SAMPLES = 120
+REST_SAMPLES = 30
+VOICE_SAMPLES = 24
+
+def percentile(samples, p: float):
+    """Gets the pth percentile of some samples, or None if there aren't any."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def read_rss():
+    """Gets how much memory the process is using, in bytes, or None if it can't be read."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Sampler:
+    """Takes regular measurements of how the bot is doing, for !diag.
+
+    Each measurement is kept in a fixed-size deque, so only the most recent window is
+    kept, and the sampler's memory and CPU use stay the same however long the bot runs.
+
+    Attributes:
+        bot (commands.Bot): The bot being measured.
+        loop_lag (deque): How late the sampler woke up, in seconds, a measure of how busy the event loop is.
+        rest (deque): Round trip times of a small REST request, in seconds.
+        voice (dict): Maps a guild's ID to a deque of its voice connection's latency, in seconds.
+        rss (deque): Memory used by the process, in bytes.
+        cpu (deque): Share of one CPU used by the process since the last sample, from 0 to 1.
+        events (Counter): Events counted on each shard since the last sample.
+        event_rates (dict): Maps a shard's ID to a deque of its events per minute.
+        started (float): When the sampler started, by time.monotonic.
+        task (asyncio.Task): The running sampler.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.loop_lag = deque(maxlen=LAG_SAMPLES)
+        self.rest = deque(maxlen=REST_SAMPLES)
+        self.voice = {}
+        self.rss = deque(maxlen=PROCESS_SAMPLES)
+        self.cpu = deque(maxlen=PROCESS_SAMPLES)
+        self.events = Counter()
+        self.event_rates = {}
+        self.started = time.monotonic()
+        self.task = None
+
+    def start(self):
+        """Starts sampling, unless it's already running."""
+        if self.task is None or self.task.done():
+            self.task = self.bot.loop.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        """Measures loop lag on every tick, and everything else on slower intervals."""
+        await self.bot.wait_until_ready()
+        last_process = last_rest = 0.0
+        last_cpu, last_wall = time.process_time(), time.monotonic()
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(LAG_INTERVAL)
+            now = time.monotonic()
+            self.loop_lag.append(max(0.0, now - before - LAG_INTERVAL))
+
+            try:
+                if now - last_process >= PROCESS_INTERVAL:
+                    last_process = now
+                    cpu = time.process_time()
+                    elapsed = now - last_wall
+                    self.cpu.append((cpu - last_cpu) / elapsed)
+                    last_cpu, last_wall = cpu, now
+                    rss = read_rss()
+                    if rss is not None:
+                        self.rss.append(rss)
+                    self.sample_voice()
+                    self.sample_events(elapsed)
+
+                if now - last_rest >= REST_INTERVAL:
+                    last_rest = now
+                    ## Run the request on its own, so a slow response doesn't hold up the other samples.
+                    self.bot.loop.create_task(self.sample_rest())
+            except Exception:
+                print(traceback.format_exc())
+
+    def sample_voice(self):
+        """Records the latency of every voice connection, forgetting guilds that have disconnected."""
+        connected = set()
+        for voice_client in self.bot.voice_clients:
+            latency = getattr(voice_client, "latency", None)
+            if voice_client.guild is None or latency is None or latency == float("inf"):
+                continue
+            connected.add(voice_client.guild.id)
+            self.voice.setdefault(voice_client.guild.id, deque(maxlen=VOICE_SAMPLES)).append(latency)
+
+        for guild_id in set(self.voice) - connected:
+            del self.voice[guild_id]
+
+    def count_event(self, guild_id: int):
+        """Counts an event against the shard the guild is on. Cheap enough to call on every message."""
+        self.events[shard_for(guild_id, self.bot.shard_count)] += 1
+
+    def sample_events(self, elapsed: float):
+        """Turns the events counted since the last sample into a rate for each shard."""
+        shards = set(self.events) | set(self.event_rates)
+        for shard_id in shards:
+            rate = self.events.get(shard_id, 0) * 60 / elapsed
+            self.event_rates.setdefault(shard_id, deque(maxlen=PROCESS_SAMPLES)).append(rate)
+        self.events.clear()
+
+    async def sample_rest(self):
+        """Times a request to the gateway endpoint, the cheapest request the API has."""
+        before = time.monotonic()
+        try:
+            await self.bot.http.get_gateway()
+        except Exception:
+            return
+        self.rest.append(time.monotonic() - before)
@@ -0,0 +1,413 @@
+import os
+import re
+
+from functools import lru_cache
+
+from utils.rng import rng
+
+## Limits, so that a single roll can't tie up the bot. Can be changed in the .env file.
+MAX_DICE = int(os.getenv("DICE_MAX_DICE", 10_000_000))
+MAX_SIDES = int(os.getenv("DICE_MAX_SIDES", 1000))
+MAX_REPEATS = int(os.getenv("DICE_MAX_REPEATS", 20))
+MAX_EXPLOSIONS = 100
+
+## Most operators, negatives and parentheses in one expression, which also bounds how deeply
+## it can nest, and most digits in a number, so totals stay small enough to print.
+MAX_PARTS = 100
+MAX_DIGITS = 9
+
+## Groups with more dice than this are shown as a summary, instead of every roll.
+DISPLAY_LIMIT = 100
+
+## Rolls with more dice than this should be run off of the event loop.
+OFFLOAD_THRESHOLD = 10_000
+
+## Faces shown in a summary's histogram, bigger dice are grouped into ranges.
+HISTOGRAM_BARS = 10
+
+## Numbers, then the two letter operators before the one letter ones.
+TOKEN_RE = re.compile(r"(\d+)|(kh|kl|dh|dl|k|d|%|!|[-+*/()#])")
+
+class DiceError(ValueError):
+    """Raised for dice expressions that can't be parsed or rolled."""
+
+
+def roll_dice(count: int, sides: int):
+    """Rolls a handful of dice in one call.
+
+    Returns:
+        rolls (list): The value of each die.
+    """
+    return rng.randints(count, 1, sides)
+
+def roll_faces(count: int, sides: int):
+    """Rolls any number of dice, counting how many landed on each face.
+
+    The dice come from the shared random service in batches, with the rejection and
+    counting done in C, so even millions of dice are rolled without a Python loop per die.
+
+    Returns:
+        faces (list): How many dice landed on each face, where faces[0] is always 0.
+    """
+    return [0] + rng.counts(count, 1, sides)
+
+def format_histogram(faces):
+    """Shows how many dice landed on each face, grouping faces into ranges for big dice."""
+    sides = len(faces) - 1
+    width = -(-sides // HISTOGRAM_BARS)
+    bars = []
+    for start in range(1, sides + 1, width):
+        end = min(start + width - 1, sides)
+        label = str(start) if start == end else F"{start}-{end}"
+        bars.append(F"{label}: {sum(faces[start:end + 1]):,}")
+    return ", ".join(bars)
+
+
+class Number:
+    """A plain number in a dice expression."""
+    def __init__(self, value: int):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+    def roll(self):
+        return self.value, str(self.value)
+
+
+class Dice:
+    """A group of dice, like 4d6kh3 or 1d20!.
+
+    Attributes:
+        count (int): How many dice to roll.
+        sides (int): How many sides each die has.
+        keep (tuple): ("h" or "l", n) to keep only the n highest or lowest dice, or None.
+        explode (bool): If a die that rolls its highest side is rolled again and added.
+    """
+    def __init__(self, count: int, sides: int, keep=None, explode: bool=False):
+        if not 1 <= count <= MAX_DICE:
+            raise DiceError(F"You can roll from 1 to {MAX_DICE:,} dice at a time.")
+        if not 1 <= sides <= MAX_SIDES:
+            raise DiceError(F"Dice can have from 1 to {MAX_SIDES} sides.")
+        if explode and sides == 1:
+            raise DiceError("A one-sided die would explode forever.")
+
+        self.count = count
+        self.sides = sides
+        self.keep = keep
+        self.explode = explode
+
+    def __str__(self):
+        text = F"{self.count}d{self.sides}"
+        if self.explode:
+            text += "!"
+        if self.keep:
+            text += F"k{self.keep[0]}{self.keep[1]}"
+        return text
+
+    def roll(self):
+        if self.count > DISPLAY_LIMIT:
+            return self.roll_summary()
+
+        rolls = roll_dice(self.count, self.sides)
+
+        if self.explode:
+            explosions = 0
+            i = 0
+            while i < len(rolls) and explosions < MAX_EXPLOSIONS:
+                if rolls[i] == self.sides:
+                    rolls.extend(roll_dice(1, self.sides))
+                    explosions += 1
+                i += 1
+
+        kept = range(len(rolls))
+        if self.keep:
+            direction, n = self.keep
+            highest = direction == "h"
+            order = sorted(range(len(rolls)), key=rolls.__getitem__, reverse=highest)
+            kept = set(order[:n])
+
+        total = sum(rolls[i] for i in kept)
+        shown = ", ".join(str(value) if i in kept else F"~~{value}~~" for i, value in enumerate(rolls))
+        return total, F"[{shown}]"
+
+    def roll_summary(self):
+        """Rolls a large group of dice by counting faces, instead of keeping every roll.
+
+        Returns:
+            (tuple): The total, and a summary with a histogram instead of every roll.
+        """
+        faces = roll_faces(self.count, self.sides)
+        rolled = self.count
+
+        ## Explode in batches: every die on the highest side rolls one more die.
+        if self.explode:
+            ## Exploding can add at most as many dice as were rolled in the first place.
+            budget = max(self.count, MAX_EXPLOSIONS)
+            exploding = faces[self.sides]
+            while exploding and budget:
+                batch = min(exploding, budget)
+                extra = roll_faces(batch, self.sides)
+                faces = [a + b for a, b in zip(faces, extra)]
+                rolled += batch
+                budget -= batch
+                exploding = extra[self.sides]
+
+        ## Keeping the highest or lowest dice just means taking faces from one end.
+        if self.keep:
+            direction, remaining = self.keep
+            order = range(self.sides, 0, -1) if direction == "h" else range(1, self.sides + 1)
+            total = 0
+            for face in order:
+                taken = min(faces[face], remaining)
+                total += face * taken
+                remaining -= taken
+                if not remaining:
+                    break
+            kept = F", kept {self.keep[1]:,} {'highest' if direction == 'h' else 'lowest'}"
+        else:
+            total = sum(face * count for face, count in enumerate(faces))
+            kept = ""
+
+        return total, F"[{rolled:,} dice{kept} | {format_histogram(faces)}]"
+
+
+class BinaryOp:
+    """Two parts of an expression joined with +, -, * or /."""
+    OPERATIONS = {
+        "+": lambda a, b: a + b,
+        "-": lambda a, b: a - b,
+        "*": lambda a, b: a * b,
+        "/": lambda a, b: a // b,
+    }
+
+    def __init__(self, op: str, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def __str__(self):
+        return F"{self.left} {self.op} {self.right}"
+
+    def roll(self):
+        left, left_text = self.left.roll()
+        right, right_text = self.right.roll()
+        if self.op == "/" and right == 0:
+            raise DiceError("Can't divide by zero.")
+        return self.OPERATIONS[self.op](left, right), F"{left_text} {self.op} {right_text}"
+
+
+class Negate:
+    """A negative part of an expression, like -1d4."""
+    def __init__(self, operand):
+        self.operand = operand
+
+    def __str__(self):
+        return F"-{self.operand}"
+
+    def roll(self):
+        value, text = self.operand.roll()
+        return -value, F"-{text}"
+
+
+class Group:
+    """A part of an expression in parentheses."""
+    def __init__(self, inner):
+        self.inner = inner
+
+    def __str__(self):
+        return F"({self.inner})"
+
+    def roll(self):
+        value, text = self.inner.roll()
+        return value, F"({text})"
+
+
+class Expression:
+    """A compiled dice expression, which can be rolled any number of times.
+
+    Attributes:
+        tree: The root of the parsed expression.
+        repeats (int): How many times the expression is rolled, from a leading "N#".
+        dice_count (int): How many dice a roll of the expression needs, not counting explosions.
+    """
+    def __init__(self, tree, repeats: int=1, dice_count: int=0):
+        self.tree = tree
+        self.repeats = repeats
+        self.dice_count = dice_count
+
+    def __str__(self):
+        if self.repeats > 1:
+            return F"{self.repeats}#{self.tree}"
+        return str(self.tree)
+
+    def roll(self):
+        """Rolls the expression.
+
+        Returns:
+            (list): A (total, breakdown) pair for each repeat.
+        """
+        return [self.tree.roll() for _ in range(self.repeats)]
+
+
+class Parser:
+    """Turns a list of tokens into an expression tree, by recursive descent.
+
+    Grammar:
+        roll   := [INT "#"] expr
+        expr   := term (("+" | "-") term)*
+        term   := unary (("*" | "/") unary)*
+        unary  := "-" unary | atom
+        atom   := dice | INT | "(" expr ")"
+        dice   := [INT] "d" (INT | "%") ["!"] [("k" | "kh" | "kl" | "dh" | "dl") INT]
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.dice_count = 0
+        self.parts = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise DiceError(F"Expected `{expected or 'more'}` in the roll.")
+        self.pos += 1
+        return token
+
+    def take_part(self):
+        """Takes an operator, negative or parenthesis, counting it towards MAX_PARTS."""
+        self.parts += 1
+        if self.parts > MAX_PARTS:
+            raise DiceError(F"Rolls can have up to {MAX_PARTS} operators and parentheses.")
+        return self.take()
+
+    def take_int(self):
+        token = self.take()
+        if not token.isdigit():
+            raise DiceError(F"Expected a number, but got `{token}`.")
+        if len(token.lstrip("0")) > MAX_DIGITS:
+            raise DiceError(F"Numbers in a roll can have up to {MAX_DIGITS} digits.")
+        return int(token)
+
+    def parse(self):
+        repeats = 1
+        if len(self.tokens) > 1 and self.tokens[0].isdigit() and self.tokens[1] == "#":
+            repeats = self.take_int()
+            self.take("#")
+            if not 1 <= repeats <= MAX_REPEATS:
+                raise DiceError(F"You can repeat a roll from 1 to {MAX_REPEATS} times.")
+
+        tree = self.expr()
+        if self.peek() is not None:
+            raise DiceError(F"Unexpected `{self.peek()}` in the roll.")
+        
+        dice_count = self.dice_count * repeats
+        if dice_count > MAX_DICE:
+            raise DiceError(F"You can roll up to {MAX_DICE:,} dice at a time.")
+        return Expression(tree, repeats, dice_count)
+
+    def expr(self):
+        node = self.term()
+        while self.peek() in ("+", "-"):
+            node = BinaryOp(self.take_part(), node, self.term())
+        return node
+
+    def term(self):
+        node = self.unary()
+        while self.peek() in ("*", "/"):
+            node = BinaryOp(self.take_part(), node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek() == "-":
+            self.take_part()
+            return Negate(self.unary())
+        return self.atom()
+
+    def atom(self):
+        token = self.peek()
+        if token == "(":
+            self.take_part()
+            inner = self.expr()
+            self.take(")")
+            return Group(inner)
+
+        count = None
+        if token is not None and token.isdigit():
+            count = self.take_int()
+            if self.peek() != "d":
+                return Number(count)
+
+        if self.peek() != "d":
+            raise DiceError("Expected a number or some dice.")
+        return self.dice(1 if count is None else count)
+
+    def dice(self, count: int):
+        self.take("d")
+        if self.peek() == "%":
+            self.take()
+            sides = 100
+        else:
+            sides = self.take_int()
+
+        explode = False
+        if self.peek() == "!":
+            self.take()
+            explode = True
+
+        keep = None
+        if self.peek() in ("k", "kh", "kl", "dh", "dl"):
+            op = self.take()
+            n = self.take_int()
+            ## Dropping the lowest n is the same as keeping the highest count - n, and the reverse.
+            if op in ("k", "kh"):
+                keep = ("h", n)
+            elif op == "kl":
+                keep = ("l", n)
+            elif op == "dl":
+                keep = ("h", count - n)
+            else:
+                keep = ("l", count - n)
+
+            if not 0 <= keep[1] <= count:
+                raise DiceError(F"Can't keep or drop {n} of {count} dice.")
+
+        self.dice_count += count
+        return Dice(count, sides, keep=keep, explode=explode)
+
+
+def tokenize(text: str):
+    """Splits an expression into tokens.
+
+    Raises:
+        DiceError: If there is anything that isn't part of a dice expression.
+    """
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = TOKEN_RE.match(text, pos)
+        if match is None:
+            raise DiceError(F"I don't know what `{text[pos]}` means in a roll.")
+        tokens.append(match.group())
+        pos = match.end()
+    return tokens
+
+@lru_cache(maxsize=512)
+def _compile(text: str):
+    return Parser(tokenize(text)).parse()
+
+def compile_expression(text: str):
+    """Compiles a dice expression, like "4d6kh3+2" or "6#4d6kh3".
+
+    Compiled expressions are cached, so rolling the same expression again skips parsing.
+
+    Returns:
+        expression (Expression): The compiled expression.
+
+    Raises:
+        DiceError: If the expression isn't valid.
+    """
+    return _compile("".join(text.lower().split()))
@@ -0,0 +1,236 @@
+import asyncio
+import discord
+import time
+
+from utils.scheduler import scheduler
+
+## Games with no moves for this many seconds are considered abandoned.
+IDLE_TIMEOUT = 600
+
+## Minimum seconds between edits of a game's message, so fast moves don't hit the rate limit.
+EDIT_INTERVAL = 1.0
+
+## Keycap emojis for 1 through 9, used to play moves with reactions.
+NUMBER_EMOJIS = [F"{number}\ufe0f\u20e3" for number in range(1, 10)]
+
+class BoardMessage:
+    """The single message showing a game's board, which is edited after every move.
+
+    Edits are debounced: if moves come in faster than EDIT_INTERVAL, only the latest
+    board gets sent once the interval is up. If the message can't be edited, a new one
+    is sent in its place.
+
+    Attributes:
+        channel (discord.TextChannel): The channel the game is running in.
+        message (discord.Message): The board message, None until it is first sent.
+        embed (discord.Embed): The latest embed to show.
+        last_edit (float): When the message was last sent or edited.
+        flush_task (asyncio.Task): The pending delayed edit, if any.
+        send_lock (asyncio.Lock): Held while the message is first sent, so it's only sent once.
+        reactions (list): The reactions used to play moves, added again to a new message.
+        on_replace (function): Called with the old and new message when the message is sent again.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.message = None
+        self.embed = None
+        self.last_edit = 0.0
+        self.flush_task = None
+        self.send_lock = asyncio.Lock()
+        self.reactions = []
+        self.on_replace = None
+
+    async def update(self, embed):
+        """Shows a new embed, sending the message the first time and editing it after.
+
+        Args:
+            embed (discord.Embed): The embed to show
+        """
+        self.embed = embed
+        if self.message is None:
+            async with self.send_lock:
+                ## Updates made while the first send was on its way edit that message instead.
+                if self.message is None:
+                    self.message = await self.channel.send(embed=embed)
+                    self.last_edit = time.monotonic()
+                    return
+
+        ## An edit is already on the way, and will pick up the new embed.
+        if self.flush_task is not None and not self.flush_task.done():
+            return
+
+        wait = self.last_edit + EDIT_INTERVAL - time.monotonic()
+        if wait <= 0:
+            await self.flush()
+        else:
+            self.flush_task = asyncio.get_event_loop().create_task(self.flush(delay=wait))
+
+    async def flush(self, delay: float=0):
+        """Edits the message to show the latest embed."""
+        if delay:
+            await asyncio.sleep(delay)
+
+        self.last_edit = time.monotonic()
+        try:
+            await self.message.edit(embed=self.embed)
+        except discord.HTTPException:
+            ## The message was probably deleted, so send a new one instead. This often runs
+            ## as a background task, so a failure is reported here instead of being lost.
+            try:
+                await self.replace()
+            except discord.HTTPException as e:
+                print(F"Error sending a new game board to {self.channel}: {e}")
+
+    async def replace(self):
+        """Sends the latest embed as a new message, and carries the game over to it."""
+        old = self.message
+        self.message = await self.channel.send(embed=self.embed)
+        if self.on_replace is not None:
+            self.on_replace(old, self.message)
+        for emoji in self.reactions:
+            await self.message.add_reaction(emoji)
+
+    async def add_reactions(self, emojis):
+        """Adds the reactions used to play moves to the message."""
+        self.reactions = list(emojis)
+        for emoji in emojis:
+            await self.message.add_reaction(emoji)
+
+class GameReaper:
+    """Removes abandoned games from every GameRegistry.
+
+    Each running game has an idle timer on the shared scheduler's wheel, so there is
+    no extra background task no matter how many games are running.
+    """
+    def schedule(self, registry, key):
+        """Restarts the idle timer for a game."""
+        scheduler.call_later(("reap", registry, key), registry.idle_timeout, registry.expire, key)
+
+    def cancel(self, registry, key):
+        """Stops the idle timer for a game."""
+        scheduler.cancel(("reap", registry, key))
+
+## Shared by the registries of all the game cogs.
+reaper = GameReaper()
+
+class GameRegistry:
+    """Keeps track of every running game for one of the game cogs.
+
+    Games are keyed by guild, channel and the pair of players, so any number of games
+    can run in a guild at once. Each player can only be in one game per channel, which
+    lets us find a player's game from just the message author.
+
+    Attributes:
+        games (dict): Maps a game key to its board.
+        players (dict): Maps (guild ID, channel ID, player ID) to the key of that player's game.
+        messages (dict): Maps the ID of a game's board message to the game's key, for reaction input.
+        idle_timeout (float): Seconds without a move before a game gets reaped.
+        on_expire (coroutine function): Called with (key, board) when a game is reaped.
+    """
+    def __init__(self, idle_timeout: float=IDLE_TIMEOUT, on_expire=None):
+        self.games = {}
+        self.players = {}
+        self.messages = {}
+        self.idle_timeout = idle_timeout
+        self.on_expire = on_expire
+
+    def __len__(self):
+        """Returns the number of active games."""
+        return len(self.games)
+
+    @staticmethod
+    def make_key(guild_id: int, channel_id: int, p1_id: int, p2_id: int):
+        """Returns the key for a game between two players in a channel."""
+        return (guild_id, channel_id, frozenset((p1_id, p2_id)))
+
+    def add(self, guild_id: int, channel_id: int, p1, p2, board):
+        """Registers a new game.
+
+        Args:
+            guild_id (int): ID of the guild the game is running in
+            channel_id (int): ID of the channel the game is running in
+            p1 (discord.Member): The player who started the game
+            p2 (discord.Member): The player who was challenged to play
+            board: The game's board
+
+        Returns:
+            key (tuple): The key of the new game.
+        """
+        key = self.make_key(guild_id, channel_id, p1.id, p2.id)
+        board.key = key
+        self.games[key] = board
+        for player in (p1, p2):
+            self.players[(guild_id, channel_id, player.id)] = key
+
+        reaper.schedule(self, key)
+        return key
+
+    def find(self, guild_id: int, channel_id: int, player_id: int):
+        """Gets the game that a player is in.
+
+        Returns:
+            The player's board, or None if they are not playing in that channel.
+        """
+        key = self.players.get((guild_id, channel_id, player_id))
+        if key is None:
+            return None
+        return self.games.get(key)
+
+    def find_by_message(self, message_id: int):
+        """Gets the game that a board message belongs to.
+
+        Returns:
+            The game's board, or None if the message isn't a board message.
+        """
+        key = self.messages.get(message_id)
+        if key is None:
+            return None
+        return self.games.get(key)
+
+    def bind_message(self, key, message_id: int):
+        """Lets the game's moves be played by reacting to its board message.
+
+        If the board message is ever sent again, the new message takes over.
+        """
+        board = self.games.get(key)
+        if board is None:
+            return
+        self.messages[message_id] = key
+        board.message.on_replace = lambda old, new: self.rebind_message(key, old.id, new.id)
+
+    def rebind_message(self, key, old_id: int, new_id: int):
+        """Moves a game's reaction input from its old board message to a new one."""
+        self.messages.pop(old_id, None)
+        if key in self.games:
+            self.messages[new_id] = key
+
+    def touch(self, key):
+        """Marks a game as just played, so it doesn't get reaped."""
+        if key in self.games:
+            reaper.schedule(self, key)
+
+    def remove(self, key):
+        """Removes a game, if it is still running.
+
+        Returns:
+            The removed board, or None if there was no such game.
+        """
+        board = self.games.pop(key, None)
+        if board is None:
+            return None
+
+        reaper.cancel(self, key)
+        if board.message is not None and board.message.message is not None:
+            self.messages.pop(board.message.message.id, None)
+
+        guild_id, channel_id, player_ids = key
+        for player_id in player_ids:
+            self.players.pop((guild_id, channel_id, player_id), None)
+
+        return board
+
+    async def expire(self, key):
+        """Removes a game that went idle for too long, and lets the cog know."""
+        board = self.remove(key)
+        if board is not None and self.on_expire is not None:
+            await self.on_expire(key, board)
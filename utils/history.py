@@ -0,0 +1,276 @@
+import asyncio
+import os
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.sharding import sharding
+
+## Where finished games and player stats are stored.
+DB_PATH = os.path.join("data", "games.db")
+
+## Finished games are written once this many are waiting, or after FLUSH_INTERVAL seconds.
+BATCH_SIZE = 50
+FLUSH_INTERVAL = 30
+
+def pack_nibbles(cells):
+    """Packs a list of numbers from 0 to 15 into bytes, two to a byte.
+
+    The high nibble holds the earlier move. An odd number of moves is padded with 0xF.
+    """
+    packed = bytearray()
+    for i in range(0, len(cells), 2):
+        low = cells[i + 1] if i + 1 < len(cells) else 0xF
+        packed.append((cells[i] << 4) | low)
+    return bytes(packed)
+
+def unpack_nibbles(packed):
+    """Reverses pack_nibbles, dropping the padding."""
+    cells = []
+    for byte in packed:
+        cells.append(byte >> 4)
+        if byte & 0xF != 0xF:
+            cells.append(byte & 0xF)
+    return cells
+
+
+class GameRecord:
+    """A finished game, as stored in the history.
+
+    Moves are stored as one byte per Connect Four column, and one nibble
+    per Tic-Tac-Toe cell.
+
+    Attributes:
+        id (int): The game's number, used with !replay.
+        game (str): Which game was played, e.g. "connectfour".
+        guild_id (int): ID of the guild the game was played in.
+        channel_id (int): ID of the channel the game was played in.
+        first_id (int): ID of the player who moved first.
+        second_id (int): ID of the other player.
+        winner_id (int): ID of the winner, or None for a tie.
+        moves (bytes): The packed move sequence.
+        ended_at (float): Unix time that the game ended at.
+    """
+    __slots__ = ('id', 'game', 'guild_id', 'channel_id', 'first_id', 'second_id',
+                 'winner_id', 'moves', 'ended_at')
+
+    def __init__(self, id, game, guild_id, channel_id, first_id, second_id, winner_id, moves, ended_at):
+        self.id = id
+        self.game = game
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.first_id = first_id
+        self.second_id = second_id
+        self.winner_id = winner_id
+        self.moves = moves
+        self.ended_at = ended_at
+
+    def as_row(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+
+class MatchHistory:
+    """Append-only log of finished games, with win/loss/tie totals per player.
+
+    Finished games are buffered and written in batches on a single worker thread,
+    so the event loop never waits on the disk. Totals for every player are kept in
+    memory and updated as games finish, so stats never need to rescan the log.
+
+    When the bot's shards are split across processes, they all share the database.
+    Each process hands out its own interleaved game numbers, totals are written as
+    changes rather than overwritten, and stats are read back from the database.
+
+    Attributes:
+        path (str): Path of the SQLite database.
+        db (sqlite3.Connection): The database connection, only used on the worker thread.
+        executor (ThreadPoolExecutor): The worker thread that runs every query.
+        pending (list): Finished games that haven't been written yet.
+        stats (dict): Maps a player's ID to a dict of game -> [wins, losses, ties].
+        changes (dict): Maps (player ID, game) to the [wins, losses, ties] added since the last write.
+        next_id (int): The number the next finished game will get.
+        id_step (int): How much next_id goes up by, one for each process sharing the database.
+        flush_task (asyncio.Task): The pending delayed flush, if any.
+    """
+    def __init__(self, path: str=DB_PATH):
+        self.path = path
+        self.db = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.stats = {}
+        self.changes = {}
+        self.next_id = 1
+        self.id_step = sharding.process_count
+        self.flush_task = None
+
+    def open(self):
+        """Opens the database, creating it if needed, and loads every player's totals."""
+        if self.db is not None:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        ## WAL lets other processes keep reading while one of them writes.
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS games (
+                id INTEGER PRIMARY KEY,
+                game TEXT NOT NULL,
+                guild_id INTEGER,
+                channel_id INTEGER,
+                first_id INTEGER NOT NULL,
+                second_id INTEGER NOT NULL,
+                winner_id INTEGER,
+                moves BLOB NOT NULL,
+                ended_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS stats (
+                player_id INTEGER NOT NULL,
+                game TEXT NOT NULL,
+                wins INTEGER NOT NULL,
+                losses INTEGER NOT NULL,
+                ties INTEGER NOT NULL,
+                PRIMARY KEY (player_id, game)
+            );
+        """)
+
+        for player_id, game, wins, losses, ties in self.db.execute("SELECT * FROM stats"):
+            self.stats.setdefault(player_id, {})[game] = [wins, losses, ties]
+        next_id = self.db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM games").fetchone()[0]
+        ## Each process only uses the numbers that leave its own remainder, so none of them clash.
+        self.next_id = next_id + (sharding.process_index - (next_id - 1)) % self.id_step
+
+    def record(self, game: str, key, first, second, winner, moves):
+        """Adds a finished game to the history.
+
+        Args:
+            game (str): Which game was played
+            key (tuple): The game's key in its GameRegistry
+            first (discord.Member): The player who moved first
+            second (discord.Member): The other player
+            winner (discord.Member): The winner, or None for a tie
+            moves (bytes): The packed move sequence
+
+        Returns:
+            game_id (int): The number of the game, for !replay.
+        """
+        self.open()
+        guild_id, channel_id, _ = key
+        winner_id = winner.id if winner else None
+        record = GameRecord(self.next_id, game, guild_id, channel_id, first.id, second.id,
+                            winner_id, bytes(moves), time.time())
+        self.next_id += self.id_step
+        self.pending.append(record)
+
+        for player in {first, second}:
+            result = 2 if winner is None else 0 if player.id == winner_id else 1
+            self.stats.setdefault(player.id, {}).setdefault(game, [0, 0, 0])[result] += 1
+            self.changes.setdefault((player.id, game), [0, 0, 0])[result] += 1
+
+        if len(self.pending) >= BATCH_SIZE:
+            self.schedule_flush(0)
+        else:
+            self.schedule_flush(FLUSH_INTERVAL)
+
+        return record.id
+
+    async def get_stats(self, player_id: int):
+        """Gets a player's totals for every game they've played.
+
+        Returns:
+            stats (dict): Maps the game to (wins, losses, ties).
+        """
+        self.open()
+        ## Other processes may have added games, so write ours and read the totals back.
+        if self.id_step > 1:
+            await self.flush()
+            loop = asyncio.get_event_loop()
+            rows = await loop.run_in_executor(self.executor, self._select_stats, player_id)
+            self.stats[player_id] = {game: [wins, losses, ties] for game, wins, losses, ties in rows}
+        return {game: tuple(totals) for game, totals in self.stats.get(player_id, {}).items()}
+
+    def _select_stats(self, player_id: int):
+        return self.db.execute("SELECT game, wins, losses, ties FROM stats WHERE player_id = ?", (player_id,)).fetchall()
+
+    async def get_game(self, game_id: int):
+        """Gets a finished game by its number.
+
+        Returns:
+            The game's GameRecord, or None if there is no such game.
+        """
+        self.open()
+        for record in self.pending:
+            if record.id == game_id:
+                return record
+
+        loop = asyncio.get_event_loop()
+        row = await loop.run_in_executor(self.executor, self._select_game, game_id)
+        return GameRecord(*row) if row else None
+
+    def _select_game(self, game_id: int):
+        return self.db.execute("SELECT * FROM games WHERE id = ?", (game_id,)).fetchone()
+
+    def schedule_flush(self, delay: float):
+        """Writes the pending games after a delay, unless a flush is already on the way."""
+        if self.flush_task is not None and not self.flush_task.done():
+            if delay:
+                return
+            self.flush_task.cancel()
+        self.flush_task = asyncio.get_event_loop().create_task(self.flush(delay))
+
+    async def flush(self, delay: float=0):
+        """Writes the pending games and changed totals in one transaction.
+
+        If the write fails, the batch is put back, and tried again after a while.
+        """
+        if delay:
+            await asyncio.sleep(delay)
+
+        pending, changes = self._take_batch()
+        if pending or changes:
+            loop = asyncio.get_event_loop()
+            try:
+                await loop.run_in_executor(self.executor, self._write, pending, changes)
+            except Exception as e:
+                print(F"Error writing the match history: {e}")
+                self._requeue(pending, changes)
+                ## This task is still the flush task until it returns, so schedule the retry after.
+                loop.call_soon(self.schedule_flush, FLUSH_INTERVAL)
+
+    def flush_now(self):
+        """Writes the pending games right away, blocking until done. Used on unload and on close."""
+        pending, changes = self._take_batch()
+        if pending or changes:
+            try:
+                self.executor.submit(self._write, pending, changes).result()
+            except Exception as e:
+                print(F"Error writing the match history: {e}")
+                self._requeue(pending, changes)
+
+    def _take_batch(self):
+        pending, changes = self.pending, self.changes
+        self.pending = []
+        self.changes = {}
+        return pending, changes
+
+    def _requeue(self, pending, changes):
+        """Puts a batch that couldn't be written back in front of anything recorded since."""
+        self.pending = pending + self.pending
+        for key, totals in changes.items():
+            merged = self.changes.setdefault(key, [0, 0, 0])
+            for result, count in enumerate(totals):
+                merged[result] += count
+
+    def _write(self, pending, changes):
+        games = [record.as_row() for record in pending]
+        rows = [(player_id, game, *totals) for (player_id, game), totals in changes.items()]
+        with self.db:
+            self.db.executemany("INSERT INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", games)
+            self.db.executemany("""
+                INSERT INTO stats VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (player_id, game) DO UPDATE SET
+                    wins = wins + excluded.wins, losses = losses + excluded.losses, ties = ties + excluded.ties
+            """, rows)
+
+## Shared by all of the game cogs.
+history = MatchHistory()
@@ -0,0 +1,56 @@
+import ast
+import discord
+import os
+
+## Every cog needs to see guilds and commands, in servers and in DMs.
+BASE_INTENTS = ("guilds", "guild_messages", "dm_messages")
+
+def read_required_intents(path: str):
+    """Gets the intents a cog declares in its REQUIRED_INTENTS, without importing it.
+
+    Reading the file instead of importing it means a cog with a missing dependency
+    can't stop the bot from starting, and it still gets reported when it's loaded.
+    """
+    with open(path, encoding="utf-8") as file:
+        tree = ast.parse(file.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(target, "id", None) == "REQUIRED_INTENTS" for target in node.targets):
+            return tuple(ast.literal_eval(node.value))
+    return ()
+
+def build_profile(cog_paths, profile: str=None):
+    """Gets the intents and caches to create the bot with.
+
+    The "default" profile keeps discord.py's defaults. The "lean" profile only turns on
+    the intents that the cogs ask for, caches members only where the intents allow it
+    (e.g. members in voice channels), and keeps no message cache, since every reaction
+    handler uses the raw events. Set INTENTS_PROFILE and MAX_MESSAGES in the .env file.
+
+    Args:
+        cog_paths (list): Paths of the cogs that will be loaded
+        profile (str): "lean" or "default", defaults to INTENTS_PROFILE
+
+    Returns:
+        (dict): Keyword arguments for the bot.
+    """
+    profile = (profile or os.getenv("INTENTS_PROFILE", "default")).lower()
+    if profile != "lean":
+        return {"intents": discord.Intents.default()}
+
+    names = set(BASE_INTENTS)
+    for path in cog_paths:
+        try:
+            names.update(read_required_intents(path))
+        except (OSError, SyntaxError, ValueError):
+            pass
+
+    intents = discord.Intents.none()
+    for name in names:
+        setattr(intents, name, True)
+
+    max_messages = os.getenv("MAX_MESSAGES")
+    return {
+        "intents": intents,
+        "member_cache_flags": discord.MemberCacheFlags.from_intents(intents),
+        "max_messages": int(max_messages) if max_messages else None,
+        }
@@ -0,0 +1,338 @@
+import asyncio
+import os
+import random
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+## Where the leaderboards are stored.
+DB_PATH = os.path.join("data", "leaderboard.db")
+
+## Changed scores are written after this many seconds.
+FLUSH_INTERVAL = 30
+
+## Leaderboards that haven't been used for this many seconds are dropped from memory.
+IDLE_EVICT = 3600
+
+## Points given for each result.
+POINTS = {"win": 3, "tie": 1, "loss": 0}
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        ## How many places each link skips over.
+        self.width = [1] * level
+
+
+class RankedSkipList:
+    """A sorted collection of keys that can also look keys up by rank.
+
+    Every link in the skip list remembers how many nodes it skips, so inserting,
+    removing, ranking a key and jumping to a rank are all O(log n).
+
+    Attributes:
+        head (_Node): The first node of every level. Holds no key.
+        size (int): The number of keys.
+        max_level (int): The most levels a node can have.
+    """
+    def __init__(self, max_level: int=24):
+        self.max_level = max_level
+        self.head = _Node(None, max_level)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_sorted(cls, keys, max_level: int=24):
+        """Builds a skip list from keys that are already in order, in O(n)."""
+        skiplist = cls(max_level)
+        last = [skiplist.head] * max_level
+        last_ranks = [0] * max_level
+        for rank, key in enumerate(keys, start=1):
+            node = _Node(key, skiplist._random_level())
+            for i in range(len(node.next)):
+                last[i].next[i] = node
+                last[i].width[i] = rank - last_ranks[i]
+                last[i], last_ranks[i] = node, rank
+            skiplist.size = rank
+
+        ## The last node on each level points past the end of the list.
+        for i in range(max_level):
+            last[i].width[i] = skiplist.size + 1 - last_ranks[i]
+        return skiplist
+
+    def _random_level(self):
+        level = 1
+        while level < self.max_level and random.random() < 0.5:
+            level += 1
+        return level
+
+    def _find_chain(self, key):
+        """Gets the last node before the key on every level, and the rank of each one."""
+        chain = [None] * self.max_level
+        ranks = [0] * self.max_level
+        node, rank = self.head, 0
+        for level in reversed(range(self.max_level)):
+            while node.next[level] is not None and node.next[level].key < key:
+                rank += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+            ranks[level] = rank
+        return chain, ranks
+
+    def insert(self, key):
+        """Adds a key, keeping everything in order."""
+        chain, ranks = self._find_chain(key)
+        level = self._random_level()
+
+        node = _Node(key, level)
+        ## Rank the new node will have, counting the head as rank 0.
+        rank = ranks[0] + 1
+        for i in range(level):
+            prev = chain[i]
+            node.next[i] = prev.next[i]
+            prev.next[i] = node
+            node.width[i] = prev.width[i] - (rank - ranks[i]) + 1
+            prev.width[i] = rank - ranks[i]
+        for i in range(level, self.max_level):
+            chain[i].width[i] += 1
+        self.size += 1
+
+    def remove(self, key):
+        """Removes a key.
+
+        Raises:
+            KeyError: If the key isn't in the list.
+        """
+        chain, _ = self._find_chain(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+
+        for i in range(len(node.next)):
+            prev = chain[i]
+            prev.width[i] += node.width[i] - 1
+            prev.next[i] = node.next[i]
+        for i in range(len(node.next), self.max_level):
+            chain[i].width[i] -= 1
+        self.size -= 1
+
+    def rank(self, key):
+        """Gets the position of a key, starting from 0.
+
+        Returns:
+            rank (int): The key's position, or None if it isn't in the list.
+        """
+        chain, ranks = self._find_chain(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            return None
+        return ranks[0]
+
+    def slice(self, start: int, count: int):
+        """Gets up to count keys, starting from the one at position start."""
+        if start >= self.size or count <= 0:
+            return []
+
+        ## Walk down the levels to the node at the starting position.
+        node, remaining = self.head, start + 1
+        for level in reversed(range(self.max_level)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+
+        keys = []
+        while node is not None and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class Leaderboard:
+    """The scores of everyone who has finished a game in one guild.
+
+    Attributes:
+        scores (dict): Maps a user's ID to [points, wins, losses, ties].
+        ranking (RankedSkipList): Everyone's sort key, from first place to last.
+    """
+    def __init__(self, rows=()):
+        self.scores = {user_id: [points, wins, losses, ties] for user_id, points, wins, losses, ties in rows}
+        self.ranking = RankedSkipList.from_sorted(sorted(self.sort_key(user_id) for user_id in self.scores))
+
+    def __len__(self):
+        return len(self.scores)
+
+    def sort_key(self, user_id: int):
+        """Most points first, then most wins, then the user's ID to break ties."""
+        points, wins, _, _ = self.scores[user_id]
+        return (-points, -wins, user_id)
+
+    def add_result(self, user_id: int, result: str):
+        """Adds a win, loss or tie to a user's score, and moves them to their new place."""
+        if user_id in self.scores:
+            self.ranking.remove(self.sort_key(user_id))
+        else:
+            self.scores[user_id] = [0, 0, 0, 0]
+
+        score = self.scores[user_id]
+        score[0] += POINTS[result]
+        score[("win", "loss", "tie").index(result) + 1] += 1
+        self.ranking.insert(self.sort_key(user_id))
+
+    def top(self, count: int, start: int=0):
+        """Gets a page of the leaderboard.
+
+        Returns:
+            (list): (rank, user ID, [points, wins, losses, ties]) for each user, with ranks starting from 1.
+        """
+        keys = self.ranking.slice(start, count)
+        return [(start + i + 1, key[2], self.scores[key[2]]) for i, key in enumerate(keys)]
+
+    def rank(self, user_id: int):
+        """Gets a user's place on the leaderboard, starting from 1, or None if they haven't played."""
+        if user_id not in self.scores:
+            return None
+        return self.ranking.rank(self.sort_key(user_id)) + 1
+
+
+class LeaderboardService:
+    """Per-guild leaderboards for all of the game cogs.
+
+    Each guild's leaderboard is loaded the first time it's needed and then kept in memory.
+    Score changes are written behind, in batches, on a single worker thread.
+
+    Attributes:
+        path (str): Path of the SQLite database.
+        db (sqlite3.Connection): The database connection, only used on the worker thread.
+        executor (ThreadPoolExecutor): The worker thread that runs every query.
+        boards (dict): Maps a guild's ID to its Leaderboard.
+        loading (dict): Maps a guild's ID to the task loading its Leaderboard.
+        dirty (set): (guild ID, user ID) of every score that changed since the last write.
+        last_used (dict): Maps a guild's ID to when its Leaderboard was last used, by time.monotonic.
+        flush_task (asyncio.Task): The pending delayed flush, if any.
+    """
+    def __init__(self, path: str=DB_PATH):
+        self.path = path
+        self.db = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.boards = {}
+        self.loading = {}
+        self.dirty = set()
+        self.last_used = {}
+        self.flush_task = None
+
+    def _open(self):
+        if self.db is not None:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        ## WAL lets other processes keep reading while one of them writes.
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS scores (
+                guild_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                points INTEGER NOT NULL,
+                wins INTEGER NOT NULL,
+                losses INTEGER NOT NULL,
+                ties INTEGER NOT NULL,
+                PRIMARY KEY (guild_id, user_id)
+            )
+        """)
+
+    def _load_guild(self, guild_id: int):
+        self._open()
+        query = "SELECT user_id, points, wins, losses, ties FROM scores WHERE guild_id = ?"
+        return Leaderboard(self.db.execute(query, (guild_id,)))
+
+    async def get(self, guild_id: int):
+        """Gets a guild's leaderboard, loading it from disk if needed."""
+        self.last_used[guild_id] = time.monotonic()
+        board = self.boards.get(guild_id)
+        if board is not None:
+            return board
+
+        ## Only load each guild once, even if several games finish at the same time.
+        task = self.loading.get(guild_id)
+        if task is None:
+            loop = asyncio.get_event_loop()
+            task = loop.run_in_executor(self.executor, self._load_guild, guild_id)
+            self.loading[guild_id] = task
+
+        try:
+            board = await task
+        except Exception:
+            ## Forget the failed load, so the next call tries again instead of getting the same error.
+            if self.loading.get(guild_id) is task:
+                del self.loading[guild_id]
+            raise
+        if guild_id not in self.boards:
+            self.boards[guild_id] = board
+            self.loading.pop(guild_id, None)
+        return self.boards[guild_id]
+
+    async def record(self, guild_id: int, wins=(), losses=(), ties=()):
+        """Adds the results of a finished game to a guild's leaderboard.
+
+        Args:
+            guild_id (int): ID of the guild the game was played in
+            wins (iterable): IDs of the users who won
+            losses (iterable): IDs of the users who lost
+            ties (iterable): IDs of the users who tied
+        """
+        board = await self.get(guild_id)
+        for result, user_ids in (("win", wins), ("loss", losses), ("tie", ties)):
+            for user_id in user_ids:
+                board.add_result(user_id, result)
+                self.dirty.add((guild_id, user_id))
+
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.get_event_loop().create_task(self.flush(FLUSH_INTERVAL))
+
+    async def evict(self):
+        """Drops the leaderboards of guilds that haven't played in a while. They're loaded again when needed.
+
+        Leaderboards with scores that haven't been written yet are kept.
+        """
+        cutoff = time.monotonic() - IDLE_EVICT
+        unsaved = {guild_id for guild_id, _ in self.dirty}
+        for guild_id, used in list(self.last_used.items()):
+            if used < cutoff and guild_id not in unsaved and guild_id not in self.loading:
+                self.boards.pop(guild_id, None)
+                del self.last_used[guild_id]
+
+    async def flush(self, delay: float=0):
+        """Writes every changed score in one transaction."""
+        if delay:
+            await asyncio.sleep(delay)
+
+        rows = self._take_batch()
+        if rows:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self.executor, self._write, rows)
+
+    def flush_now(self):
+        """Writes every changed score right away, blocking until done. Used on unload."""
+        rows = self._take_batch()
+        if rows:
+            self.executor.submit(self._write, rows).result()
+
+    def _take_batch(self):
+        rows = [(guild_id, user_id, *self.boards[guild_id].scores[user_id])
+                for guild_id, user_id in self.dirty]
+        self.dirty = set()
+        return rows
+
+    def _write(self, rows):
+        self._open()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+## Shared by all of the game cogs.
+leaderboards = LeaderboardService()
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import sys
+import time
+import traceback
+
+from array import array
+
+from utils.scheduler import scheduler
+from utils.sharding import sharding
+
+## Where the metrics snapshot is written, and how often. Each process gets its own file.
+SNAPSHOT_PATH = os.path.join("data", "metrics.json" if sharding.process_count == 1 else F"metrics-{sharding.process_index}.json")
+SNAPSHOT_INTERVAL = 300
+
+## Each power of two is split into this many buckets, so recorded times are within about 6%.
+SUB_BUCKETS = 16
+## Times are recorded in microseconds, up to about 38 hours.
+MAX_MICROS = (1 << 37) - 1
+
+def bucket_index(micros: int):
+    """Gets the bucket a time in microseconds falls in.
+
+    Times under 32 us get a bucket each. Above that, each power of two gets
+    SUB_BUCKETS buckets, by the top five bits of the time.
+    """
+    micros = min(max(micros, 0), MAX_MICROS)
+    if micros < 2 * SUB_BUCKETS:
+        return micros
+    shift = micros.bit_length() - 5
+    return 2 * SUB_BUCKETS + (shift - 1) * SUB_BUCKETS + (micros >> shift) - SUB_BUCKETS
+
+def bucket_value(index: int):
+    """Gets the time in the middle of a bucket, in microseconds."""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = (index - 2 * SUB_BUCKETS) // SUB_BUCKETS + 1
+    low = ((index - 2 * SUB_BUCKETS) % SUB_BUCKETS + SUB_BUCKETS) << shift
+    return low + (1 << shift) // 2
+
+BUCKETS = bucket_index(MAX_MICROS) + 1
+
+
+class LatencyHistogram:
+    """Counts how long something took, in log-spaced buckets like an HDR histogram.
+
+    Memory use is fixed no matter how many times are recorded, and any percentile
+    can be read back to within a few percent.
+
+    Attributes:
+        counts (array): How many times fell in each bucket.
+        count (int): How many times were recorded.
+        total (float): All of the recorded times added up, in seconds.
+        max (float): The longest recorded time, in seconds.
+    """
+    def __init__(self):
+        self.counts = array("I", bytes(4 * BUCKETS))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bucket_index(int(seconds * 1_000_000))] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p: float):
+        """Gets the pth percentile in seconds, or 0 if nothing was recorded."""
+        if not self.count:
+            return 0.0
+        target = max(1, -(-self.count * p // 100))
+        seen = 0
+        for index, hits in enumerate(self.counts):
+            seen += hits
+            if seen >= target:
+                return min(bucket_value(index) / 1_000_000, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class CommandStats:
+    """How many times a command ran, how many times it failed, and how long it took."""
+    __slots__ = ('count', 'errors', 'latency')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.latency = LatencyHistogram()
+
+    def as_dict(self, minutes: float):
+        latency = self.latency
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "per_minute": round(self.count / minutes, 3) if minutes else 0,
+            "mean_ms": round(latency.mean * 1000, 2),
+            "p50_ms": round(latency.percentile(50) * 1000, 2),
+            "p95_ms": round(latency.percentile(95) * 1000, 2),
+            "p99_ms": round(latency.percentile(99) * 1000, 2),
+            "max_ms": round(latency.max * 1000, 2),
+            }
+
+
+class Metrics:
+    """Times every command the bot runs, through the bot's global invoke hooks.
+
+    Stats are kept per cog and per command. A snapshot of them is written to a JSON
+    file every SNAPSHOT_INTERVAL seconds, and can be viewed with !metrics.
+
+    Attributes:
+        cogs (dict): Maps a cog's name to a dict of command name -> CommandStats.
+        started (float): When the metrics started being collected, by time.time.
+        path (str): Where snapshots are written.
+    """
+    def __init__(self, path: str=SNAPSHOT_PATH):
+        self.cogs = {}
+        self.started = time.time()
+        self.path = path
+
+    def install(self, bot):
+        """Adds the hooks that time every command, and starts writing snapshots."""
+        bot.before_invoke(self.before_invoke)
+        bot.after_invoke(self.after_invoke)
+        bot.add_listener(self.on_command)
+        bot.add_listener(self.on_command_error)
+        scheduler.every("metrics", SNAPSHOT_INTERVAL, self.flush)
+
+    def get(self, ctx):
+        cog = ctx.cog.qualified_name if ctx.cog else "No Category"
+        return self.cogs.setdefault(cog, {}).setdefault(ctx.command.qualified_name, CommandStats())
+
+    async def on_command(self, ctx):
+        """Counts every invocation, including ones that fail their checks or arguments.
+
+        Those never reach the invoke hooks, but still count as errors, so counting them
+        here keeps errors from ever being more than count.
+        """
+        self.get(ctx).count += 1
+
+    async def before_invoke(self, ctx):
+        ctx.invoked_at = time.perf_counter()
+
+    async def after_invoke(self, ctx):
+        """Records how long the command took. Runs whether or not the command failed."""
+        started = getattr(ctx, "invoked_at", None)
+        if started is None:
+            return
+        self.get(ctx).latency.record(time.perf_counter() - started)
+
+    async def on_command_error(self, ctx, error):
+        """Counts the error against its command, and prints its traceback.
+
+        Errors from cogs or commands with their own error handler are left to them.
+        """
+        if ctx.command is not None:
+            self.get(ctx).errors += 1
+
+        if ctx.command is not None and (ctx.command.has_error_handler() or (ctx.cog and ctx.cog.has_error_handler())):
+            return
+        print(F"Ignoring exception in command {ctx.command}:", file=sys.stderr)
+        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+
+    def snapshot(self):
+        """Gets every command's stats, by cog, ready to be written out as JSON."""
+        now = time.time()
+        minutes = (now - self.started) / 60
+        return {
+            "written_at": now,
+            "uptime": round(now - self.started),
+            "cogs": {cog: {name: stats.as_dict(minutes) for name, stats in commands.items()}
+                     for cog, commands in self.cogs.items()},
+            }
+
+    async def flush(self):
+        snapshot = self.snapshot()
+        await asyncio.get_event_loop().run_in_executor(None, self._write, snapshot)
+
+    def _write(self, snapshot):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        ## Write to a temporary file first, so a crash can't leave the snapshot half written.
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(snapshot, file, indent=2)
+        os.replace(temp_path, self.path)
+
+## Shared by the whole bot, installed by bot.py.
+metrics = Metrics()
@@ -0,0 +1,219 @@
+import math
+import threading
+
+from collections import defaultdict
+from itertools import accumulate
+
+from utils.cache import LRUCache
+from utils.dice import BinaryOp, Dice, DiceError, Group, Negate, Number
+
+## Most different totals a distribution can have, to keep the work bounded.
+MAX_OUTCOMES = 10_000
+
+## Most dice a keep/drop or exploding group can have when working out its odds.
+MAX_KEEP_DICE = 30
+
+## Most steps any one distribution can take to work out, checked before starting. This runs on
+## a worker thread, but still holds the GIL, so anything much bigger stalls the whole bot.
+MAX_WORK = 2_000_000
+
+## Exploding dice are followed until the chance of exploding again is below this.
+EXPLODE_CUTOFF = 1e-12
+
+## Recent plain sums, by (count, sides). Each is (lowest total, [chance of each total from the lowest up]).
+SUM_CACHE_SIZE = 64
+_sums = LRUCache(SUM_CACHE_SIZE)
+_sums_lock = threading.Lock()
+
+def sum_distribution(count: int, sides: int):
+    """Gets the chance of every total for count dice with the given sides, added together.
+
+    Each extra die is a convolution with a flat distribution, which is done with a
+    running sum in O(totals) instead of multiplying every pair of totals. Only the
+    requested count is kept, in a small LRU cache, so memory stays bounded.
+
+    Returns:
+        (tuple): The lowest total, and the chance of each total from there up.
+    """
+    ## The k-th die takes k x sides steps to add on.
+    if count * count * sides // 2 > MAX_WORK:
+        raise DiceError("That roll has too many possible totals to work out.")
+
+    with _sums_lock:
+        known = _sums.get((count, sides))
+    if known is not None:
+        return known
+
+    low, chances = 0, [1.0]
+    for _ in range(count):
+        ## Adding a die spreads each total over the next `sides` totals.
+        padded = [0.0] * sides + chances + [0.0] * sides
+        prefix = [0.0] + list(accumulate(padded))
+        width = len(chances) + sides - 1
+        low, chances = low + 1, [(prefix[i + sides + 1] - prefix[i + 1]) / sides for i in range(width)]
+
+    with _sums_lock:
+        _sums.put((count, sides), (low, chances))
+    return low, chances
+
+def to_dict(low: int, chances):
+    return {low + i: chance for i, chance in enumerate(chances) if chance}
+
+def combine(a, b, operation):
+    """Works out the distribution of operation(x, y), for x and y drawn from a and b."""
+    if len(a) * len(b) > MAX_WORK:
+        raise DiceError("That roll has too many possible totals to work out.")
+    result = defaultdict(float)
+    for x, px in a.items():
+        for y, py in b.items():
+            result[operation(x, y)] += px * py
+        if len(result) > MAX_OUTCOMES:
+            raise DiceError("That roll has too many possible totals to work out.")
+    return dict(result)
+
+def keep_distribution(dice: Dice):
+    """Works out the odds for a group of dice where only the highest or lowest few are kept.
+
+    Goes through the faces from the best to the worst. At each face, some number of the
+    dice that are left land on it, and the first ones to land are the ones that are kept.
+    """
+    count, sides = dice.count, dice.sides
+    direction, keep = dice.keep
+    if count > MAX_KEEP_DICE:
+        raise DiceError(F"I can only work out keep/drop odds for up to {MAX_KEEP_DICE} dice.")
+    ## Each face goes through up to count x (keep x sides) states, each split count ways.
+    if sides * count * keep * sides * count > MAX_WORK:
+        raise DiceError("That keep/drop roll has too many possible outcomes to work out.")
+
+    faces = range(sides, 0, -1) if direction == "h" else range(1, sides + 1)
+    ## Maps (dice left, kept total) to its chance.
+    states = {(count, 0): 1.0}
+    for face in faces:
+        ## Chance that one of the dice left lands on this face, given it didn't land on a better one.
+        left_faces = face if direction == "h" else sides - face + 1
+        p = 1 / left_faces
+        new_states = defaultdict(float)
+        for (left, total), chance in states.items():
+            kept_left = max(0, keep - (count - left))
+            for hits in range(left + 1):
+                hit_chance = math.comb(left, hits) * p ** hits * (1 - p) ** (left - hits)
+                if hit_chance:
+                    new_states[(left - hits, total + min(hits, kept_left) * face)] += chance * hit_chance
+        states = new_states
+
+    result = defaultdict(float)
+    for (_, total), chance in states.items():
+        result[total] += chance
+    return dict(result)
+
+def explode_distribution(dice: Dice):
+    """Works out the odds for exploding dice, following explosions until they're negligible."""
+    if dice.count > MAX_KEEP_DICE:
+        raise DiceError(F"I can only work out exploding odds for up to {MAX_KEEP_DICE} dice.")
+
+    sides = dice.sides
+    single = {}
+    chance, base = 1 / sides, 0
+    while chance > EXPLODE_CUTOFF:
+        for face in range(1, sides):
+            single[base + face] = chance
+        base += sides
+        chance /= sides
+    ## Whatever chance is left over goes on the last total we followed.
+    single[base] = chance * sides
+
+    ## The k-th die is combined with up to k times as many totals as one die has.
+    if dice.count * dice.count * len(single) * len(single) // 2 > MAX_WORK:
+        raise DiceError("That exploding roll has too many possible totals to work out.")
+
+    result = {0: 1.0}
+    for _ in range(dice.count):
+        result = combine(result, single, lambda x, y: x + y)
+    return result
+
+def distribution(node):
+    """Works out the chance of every total for part of a dice expression.
+
+    Returns:
+        (dict): Maps each possible total to its chance.
+    """
+    if isinstance(node, Number):
+        return {node.value: 1.0}
+    if isinstance(node, Group):
+        return distribution(node.inner)
+    if isinstance(node, Negate):
+        return {-value: chance for value, chance in distribution(node.operand).items()}
+    if isinstance(node, BinaryOp):
+        left, right = distribution(node.left), distribution(node.right)
+        if node.op == "/" and 0 in right:
+            raise DiceError("That roll could divide by zero.")
+        return combine(left, right, BinaryOp.OPERATIONS[node.op])
+    if isinstance(node, Dice):
+        if node.explode and node.keep:
+            raise DiceError("I can't work out odds for dice that both explode and keep/drop.")
+        if node.explode:
+            return explode_distribution(node)
+        if node.keep:
+            return keep_distribution(node)
+        if node.count * (node.sides - 1) + 1 > MAX_OUTCOMES:
+            raise DiceError("That roll has too many possible totals to work out.")
+        return to_dict(*sum_distribution(node.count, node.sides))
+
+    raise DiceError("I can't work out the odds for that.")
+
+
+class Odds:
+    """The exact distribution of a dice expression.
+
+    Attributes:
+        chances (list): (total, chance) pairs, from the lowest total to the highest.
+        mean (float): The average total.
+        stdev (float): The standard deviation of the total.
+    """
+    def __init__(self, chances):
+        self.chances = sorted((total, chance) for total, chance in chances.items())
+        self.mean = sum(total * chance for total, chance in self.chances)
+        variance = sum((total - self.mean) ** 2 * chance for total, chance in self.chances)
+        self.stdev = math.sqrt(max(variance, 0.0))
+
+    @classmethod
+    def of(cls, expression):
+        """Works out the odds of a compiled Expression. Repeats are ignored."""
+        return cls(distribution(expression.tree))
+
+    @property
+    def lowest(self):
+        return self.chances[0][0]
+
+    @property
+    def highest(self):
+        return self.chances[-1][0]
+
+    def percentile(self, percent: float):
+        """Gets the lowest total that at least percent% of rolls are at or below."""
+        target = percent / 100
+        running = 0.0
+        for total, chance in self.chances:
+            running += chance
+            if running >= target - 1e-12:
+                return total
+        return self.highest
+
+    def at_least(self, value: int):
+        """Gets the chance of rolling the value or higher."""
+        return sum(chance for total, chance in self.chances if total >= value)
+
+    def histogram(self, rows: int=12, width: int=20):
+        """Draws the distribution as a text bar chart, grouping totals into at most `rows` bars."""
+        span = self.highest - self.lowest + 1
+        step = -(-span // rows)
+        bars = []
+        for start in range(self.lowest, self.highest + 1, step):
+            end = min(start + step - 1, self.highest)
+            chance = sum(c for total, c in self.chances if start <= total <= end)
+            bars.append((F"{start}" if start == end else F"{start}-{end}", chance))
+
+        tallest = max(chance for _, chance in bars) or 1
+        label_width = max(len(label) for label, _ in bars)
+        return "\n".join(F"{label:>{label_width}} {'█' * round(chance / tallest * width):<{width}} {chance:6.2%}"
+                         for label, chance in bars)
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import os
+import sqlite3
+
+from concurrent.futures import ThreadPoolExecutor
+
+## Where archived pins, and each guild's archive channel, are stored.
+DB_PATH = os.path.join("data", "pins.db")
+CONFIG_PATH = os.path.join("data", "pin_channels.json")
+
+## Most results shown for a single search.
+SEARCH_LIMIT = 10
+
+def to_query(text: str):
+    """Turns what a user typed into an FTS5 query, matching every word.
+
+    Each word is quoted so that characters like - or * can't break the query, and
+    the last word also matches as a prefix, so searches work while still typing.
+    """
+    words = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+    if words:
+        words[-1] += "*"
+    return " ".join(words)
+
+
+class PinArchive:
+    """Full-text searchable archive of pinned messages, and where each guild forwards them.
+
+    Pins are stored in an SQLite FTS5 table, keyed by message ID, so the same message
+    is never archived twice. Every query runs on a single worker thread.
+
+    Attributes:
+        path (str): Path of the SQLite database.
+        config_path (str): Path of the JSON file mapping guild IDs to archive channel IDs.
+        db (sqlite3.Connection): The database connection, only used on the worker thread.
+        executor (ThreadPoolExecutor): The worker thread that runs every query.
+        channels (dict): Maps a guild's ID to the ID of its archive channel.
+    """
+    def __init__(self, path: str=DB_PATH, config_path: str=CONFIG_PATH):
+        self.path = path
+        self.config_path = config_path
+        self.db = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.channels = {}
+
+    def open(self):
+        """Opens the database and the config, creating them if needed."""
+        if self.db is not None:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        ## WAL lets other processes keep reading while one of them writes.
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        ## Only the text columns are indexed, the rest are just stored alongside them.
+        self.db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS pins USING fts5(
+                content,
+                author_name,
+                guild_id UNINDEXED,
+                channel_id UNINDEXED,
+                author_id UNINDEXED,
+                attachments UNINDEXED,
+                jump_url UNINDEXED,
+                created_at UNINDEXED
+            )
+        """)
+
+        if os.path.exists(self.config_path):
+            with open(self.config_path) as file:
+                self.channels = {int(guild_id): channel_id for guild_id, channel_id in json.load(file).items()}
+
+    def get_channel_id(self, guild_id: int):
+        """Gets the ID of a guild's archive channel, or None if it hasn't been set."""
+        self.open()
+        return self.channels.get(guild_id)
+
+    def set_channel(self, guild_id: int, channel_id: int):
+        """Sets where a guild's pins are forwarded to, and saves the config."""
+        self.open()
+        ## Other processes may have set their own guilds' channels since this one read the file.
+        if os.path.exists(self.config_path):
+            with open(self.config_path) as file:
+                self.channels.update({int(guild_id): channel_id for guild_id, channel_id in json.load(file).items()})
+        self.channels[guild_id] = channel_id
+        ## Write to a temporary file first, so a crash can't leave the config half written.
+        temp_path = self.config_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.channels, file)
+        os.replace(temp_path, self.config_path)
+
+    async def run(self, function, *args):
+        self.open()
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    async def archived(self, message_ids):
+        """Gets which of the given messages are already in the archive.
+
+        Returns:
+            (set): The IDs that are already archived.
+        """
+        return await self.run(self._select_archived, list(message_ids))
+
+    def _select_archived(self, message_ids):
+        found = set()
+        ## Stay well under SQLite's limit on query parameters.
+        for start in range(0, len(message_ids), 500):
+            chunk = message_ids[start:start + 500]
+            marks = ", ".join("?" * len(chunk))
+            found.update(row[0] for row in self.db.execute(F"SELECT rowid FROM pins WHERE rowid IN ({marks})", chunk))
+        return found
+
+    async def add(self, rows):
+        """Adds pins to the archive in one transaction.
+
+        Args:
+            rows (list): (message ID, content, author name, guild ID, channel ID, author ID,
+            attachment URLs, jump URL, created at) tuples
+        """
+        await self.run(self._write, rows)
+
+    def _write(self, rows):
+        ## FTS5 tables can't ignore duplicate rows, so skip any pin archived since it was checked.
+        archived = self._select_archived([row[0] for row in rows])
+        rows = [row for row in rows if row[0] not in archived]
+        with self.db:
+            self.db.executemany("INSERT INTO pins (rowid, content, author_name, guild_id, channel_id, author_id, "
+                                "attachments, jump_url, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    async def search(self, guild_id: int, text: str, limit: int=SEARCH_LIMIT):
+        """Finds a guild's archived pins matching every word of the text, best matches first.
+
+        Returns:
+            (list): (author name, snippet, jump URL) tuples, with the matched words in bold.
+        """
+        query = to_query(text)
+        if not query:
+            return []
+        return await self.run(self._select_matches, guild_id, query, limit)
+
+    def _select_matches(self, guild_id: int, query: str, limit: int):
+        return self.db.execute("""
+            SELECT author_name, snippet(pins, 0, '**', '**', '...', 16), jump_url
+            FROM pins WHERE pins MATCH ? AND guild_id = ?
+            ORDER BY rank LIMIT ?
+        """, (query, guild_id, limit)).fetchall()
+
+    async def count(self, guild_id: int):
+        """Gets how many pins a guild has archived."""
+        return await self.run(self._select_count, guild_id)
+
+    def _select_count(self, guild_id: int):
+        return self.db.execute("SELECT COUNT(*) FROM pins WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+
+## Shared by every guild.
+pins = PinArchive()
@@ -0,0 +1,141 @@
+import os
+import random
+import threading
+
+from array import array
+
+## How many random bytes are fetched from the OS at a time.
+BUFFER_SIZE = 64 * 1024
+
+class RandomService:
+    """Shared source of random numbers for every cog.
+
+    Bytes come from os.urandom, fetched in bulk into a buffer, so most calls don't
+    need a syscall. Numbers in a range are made by rejection sampling, so every
+    value is exactly as likely as every other one. Given a seed, the bytes come from
+    a seeded random.Random instead, so rolls can be repeated for tests and benchmarks.
+
+    Attributes:
+        buffer (bytes): Random bytes that haven't been handed out yet.
+        pos (int): How far into the buffer we are.
+        source (function): Returns n random bytes, either os.urandom or a seeded generator.
+        lock (threading.Lock): Guards the buffer, since rolls can run in executor threads.
+    """
+    def __init__(self, seed=None, buffer_size: int=BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        """Switches to a deterministic stream for the given seed, or back to os.urandom for None."""
+        with self.lock:
+            self.source = os.urandom if seed is None else random.Random(seed).randbytes
+            self.buffer = b""
+            self.pos = 0
+
+    def randbytes(self, n: int):
+        """Gets n random bytes."""
+        with self.lock:
+            if self.pos + n > len(self.buffer):
+                ## Keep whatever is left, and top up with a fresh batch.
+                self.buffer = self.buffer[self.pos:] + self.source(max(n, self.buffer_size))
+                self.pos = 0
+            chunk = self.buffer[self.pos:self.pos + n]
+            self.pos += n
+        return chunk
+
+    def randbelow(self, n: int):
+        """Gets a random number from 0 up to but not including n."""
+        if n <= 0:
+            raise ValueError("n must be positive")
+        bits = (n - 1).bit_length()
+        size = (bits + 7) // 8
+        mask = (1 << bits) - 1
+        ## Only using as many bits as needed means each try succeeds at least half the time.
+        while True:
+            value = int.from_bytes(self.randbytes(size), "little") & mask
+            if value < n:
+                return value
+
+    def randint(self, a: int, b: int):
+        """Gets a random number from a to b, including both."""
+        return a + self.randbelow(b - a + 1)
+
+    def choice(self, sequence):
+        """Gets a random item from a sequence."""
+        return sequence[self.randbelow(len(sequence))]
+
+    def shuffle(self, items):
+        """Shuffles a list in place, using Fisher-Yates."""
+        for i in range(len(items) - 1, 0, -1):
+            j = self.randbelow(i + 1)
+            items[i], items[j] = items[j], items[i]
+
+    def random(self):
+        """Gets a random float from 0 up to but not including 1."""
+        return (int.from_bytes(self.randbytes(7), "little") >> 3) / (1 << 53)
+
+    def _offsets(self, count: int, span: int):
+        """Gets count random numbers below span as bytes or an array, for spans up to 65536.
+
+        Whole batches are rejection sampled at once: bytes.translate drops the rejected
+        bytes and maps the rest in C, and arrays are filtered with a single comprehension.
+        """
+        if span <= 256:
+            limit = 256 - 256 % span
+            table = bytes(byte % span for byte in range(256))
+            rejected = bytes(range(limit, 256))
+            result = b""
+            while len(result) < count:
+                missing = count - len(result)
+                ## Ask for a few extra bytes to make up for the ones that get rejected.
+                result += self.randbytes(missing * 256 // limit + 16).translate(table, rejected)[:missing]
+            return result
+
+        limit = 65536 - 65536 % span
+        result = []
+        while len(result) < count:
+            missing = count - len(result)
+            words = array("H", self.randbytes(2 * (missing * 65536 // limit + 16)))
+            result += [word % span for word in words if word < limit][:missing]
+        return result
+
+    def randints(self, count: int, a: int, b: int):
+        """Gets count random numbers from a to b, including both, in one batch.
+
+        Returns:
+            (list): The random numbers.
+        """
+        span = b - a + 1
+        if span > 65536:
+            return [a + self.randbelow(span) for _ in range(count)]
+        return [a + offset for offset in self._offsets(count, span)]
+
+    def counts(self, count: int, a: int, b: int):
+        """Draws count random numbers from a to b, only counting how often each one came up.
+
+        Much faster than randints for big batches, since the numbers are never turned
+        into a list of Python ints.
+
+        Returns:
+            (list): How many times each number came up, where index 0 is a.
+        """
+        span = b - a + 1
+        if span > 65536:
+            tally = [0] * span
+            for _ in range(count):
+                tally[self.randbelow(span)] += 1
+            return tally
+
+        offsets = self._offsets(count, span)
+        if span <= 32:
+            ## bytes.count runs in C, so one pass per value beats counting in Python.
+            return [offsets.count(offset) for offset in range(span)]
+
+        tally = [0] * span
+        for offset in offsets:
+            tally[offset] += 1
+        return tally
+
+## Shared by all of the cogs. Set RNG_SEED in the .env file for repeatable rolls.
+rng = RandomService(seed=os.getenv("RNG_SEED"))
@@ -0,0 +1,114 @@
+import asyncio
+import traceback
+
+from utils.rng import rng
+from utils.timerwheel import TimerWheel
+
+## Seconds between each turn of the wheel. Jobs run on the first tick after they're due.
+TICK = 1.0
+
+class Job:
+    """A coroutine function that the scheduler runs every so often.
+
+    Attributes:
+        function (coroutine function): What to run. Called with no arguments.
+        interval (float): Seconds between runs.
+        jitter (float): How much each interval can be stretched or shrunk by, as a fraction,
+        so jobs with the same interval don't all land on the same tick.
+        task (asyncio.Task): The job's latest run.
+    """
+    __slots__ = ('function', 'interval', 'jitter', 'task')
+
+    def __init__(self, function, interval: float, jitter: float):
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+        self.task = None
+
+    def next_delay(self):
+        return self.interval * (1 + self.jitter * (2 * rng.random() - 1))
+
+
+class Scheduler:
+    """Runs all of the bot's background work from a single task and timer wheel.
+
+    Periodic jobs are added with every, and one-off calls with call_later. Both are
+    keyed, so adding one again replaces it instead of doubling it up, and starting the
+    scheduler again does nothing, so reconnects can't stack up extra loops.
+
+    Attributes:
+        wheel (TimerWheel): A timer for each job and each pending call.
+        jobs (dict): Maps a periodic job's name to its Job.
+        calls (dict): Maps a one-off call's key to (function, args).
+        task (asyncio.Task): The task turning the wheel.
+    """
+    def __init__(self, tick: float=TICK):
+        self.wheel = TimerWheel(tick=tick)
+        self.jobs = {}
+        self.calls = {}
+        self.task = None
+
+    def __contains__(self, key):
+        return key in self.wheel
+
+    def start(self):
+        """Starts turning the wheel, unless it's already turning."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    def every(self, name: str, interval: float, function, jitter: float=0.1, delay: float=None):
+        """Runs a coroutine function every interval seconds.
+
+        Args:
+            name (str): The job's name, adding a job with the same name replaces it
+            interval (float): Seconds between runs
+            function (coroutine function): What to run
+            jitter (float): How much each interval can vary by, as a fraction of it
+            delay (float): Seconds until the first run, defaults to one interval
+        """
+        job = Job(function, interval, jitter)
+        self.jobs[name] = job
+        self.wheel.schedule(name, job.next_delay() if delay is None else delay)
+
+    def call_later(self, key, delay: float, function, *args):
+        """Runs a coroutine function once, after delay seconds.
+
+        Calling this again with the same key pushes the call back, instead of adding another.
+        """
+        self.calls[key] = (function, args)
+        self.wheel.schedule(key, delay)
+        self.start()
+
+    def cancel(self, key):
+        """Stops a job or a pending call."""
+        self.wheel.cancel(key)
+        self.jobs.pop(key, None)
+        self.calls.pop(key, None)
+
+    async def run(self):
+        """Turns the wheel every tick, running whatever is due."""
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            for key in self.wheel.advance():
+                job = self.jobs.get(key)
+                if job is not None:
+                    self.wheel.schedule(key, job.next_delay())
+                    ## A slow job is skipped for a turn, rather than run twice at once.
+                    if job.task is None or job.task.done():
+                        job.task = asyncio.get_event_loop().create_task(self.guard(key, job.function))
+                    continue
+
+                function, args = self.calls.pop(key, (None, ()))
+                if function is not None:
+                    asyncio.get_event_loop().create_task(self.guard(key, function, *args))
+
+    async def guard(self, key, function, *args):
+        """Runs a job, printing rather than raising its errors, so one bad job can't stop the others."""
+        try:
+            await function(*args)
+        except Exception:
+            print(F"Error in scheduled job {key}")
+            print(traceback.format_exc())
+
+## Shared by the whole bot, started by bot.py once it's ready.
+scheduler = Scheduler()
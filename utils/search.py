@@ -0,0 +1,71 @@
+import bisect
+import re
+
+from utils.cache import LRUCache
+
+## Searches remembered, and the fewest matching results a remembered search needs to answer a new one.
+SEARCH_CACHE_SIZE = 256
+MIN_LOCAL_RESULTS = 2
+
+WORD_RE = re.compile(r"\w+")
+
+def normalize(query: str):
+    """Lowercases a query and keeps only its words, so trivially different queries share a key."""
+    return " ".join(WORD_RE.findall(query.lower()))
+
+
+class SearchCache:
+    """Remembers recent searches, and answers similar ones without searching again.
+
+    A new query is answered from a remembered one when either query's words start
+    with the other's, e.g. "daft punk" and "daft punk around the world". The
+    remembered results are then only kept if their titles have every word of the
+    new query.
+
+    Attributes:
+        results (LRUCache): Maps a normalized query to its results.
+        keys (list): Every remembered query, sorted, for finding longer queries with bisect.
+    """
+    def __init__(self, size: int=SEARCH_CACHE_SIZE):
+        self.results = LRUCache(size)
+        self.keys = []
+
+    def put(self, query: str, results):
+        key = normalize(query)
+        if key not in self.results:
+            bisect.insort(self.keys, key)
+        self.results.put(key, results)
+        ## Keep the sorted keys in step with whatever the LRU threw out.
+        if len(self.keys) > len(self.results):
+            self.keys = [key for key in self.keys if key in self.results]
+
+    def get(self, query: str):
+        """Gets the results for a query, or for a similar remembered query.
+
+        Returns:
+            (list): The results, or None if the query has to be searched.
+        """
+        key = normalize(query)
+        exact = self.results.get(key)
+        if exact is not None:
+            return exact
+
+        words = key.split()
+        candidates = []
+        ## Shorter remembered queries, made of the first few words of this one.
+        for count in range(len(words) - 1, 0, -1):
+            candidates.append(" ".join(words[:count]))
+        ## Longer remembered queries, which start with all of this one's words.
+        start = bisect.bisect_left(self.keys, key + " ")
+        end = bisect.bisect_left(self.keys, key + "!")
+        candidates.extend(self.keys[start:end])
+
+        for candidate in candidates:
+            results = self.results.get(candidate)
+            ## A similar search that found nothing says nothing about this one.
+            if not results:
+                continue
+            matching = [result for result in results if set(words) <= set(WORD_RE.findall(result["title"].lower()))]
+            if len(matching) >= MIN_LOCAL_RESULTS:
+                return matching
+        return None
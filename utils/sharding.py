@@ -0,0 +1,80 @@
+import os
+
+def parse_ids(text: str):
+    """Reads a list of shard IDs like "0,1,4-7"."""
+    ids = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        ids.extend(range(int(start), int(end or start) + 1))
+    return ids
+
+def shard_for(guild_id: int, shard_count: int):
+    """Gets which shard a guild's events come in on, by Discord's formula."""
+    return (guild_id >> 22) % (shard_count or 1)
+
+
+class ShardConfig:
+    """How the bot connects to the gateway, read from the .env file.
+
+    With nothing set the bot runs unsharded, as a plain commands.Bot. Otherwise:
+        SHARD_COUNT: How many shards the bot has in total, or "auto" to ask Discord.
+        SHARD_IDS: Which shards this process runs, e.g. "0-3", defaults to all of them.
+        SHARD_PROCESSES, SHARD_PROCESS: Split the shards evenly across this many processes,
+        and which one this is, counting from 0. Needs SHARD_COUNT.
+
+    Every guild's events come in on exactly one shard, so per-guild state stays in a
+    single process whichever way the shards are split.
+
+    Attributes:
+        sharded (bool): If the bot should use commands.AutoShardedBot.
+        shard_count (int): The total number of shards, None to ask Discord.
+        shard_ids (list): The shards run by this process, None for all of them.
+        process_index (int): Which process this is, counting from 0.
+        process_count (int): How many processes are running the bot.
+    """
+    def __init__(self, sharded=False, shard_count=None, shard_ids=None, process_index=0, process_count=1):
+        self.sharded = sharded
+        self.shard_count = shard_count
+        self.shard_ids = shard_ids
+        self.process_index = process_index
+        self.process_count = process_count
+
+    @classmethod
+    def from_env(cls):
+        count = os.getenv("SHARD_COUNT", "").strip().lower()
+        ids = os.getenv("SHARD_IDS", "").strip()
+        process_count = int(os.getenv("SHARD_PROCESSES", 1))
+        process_index = int(os.getenv("SHARD_PROCESS", 0))
+
+        if not count and not ids and process_count == 1:
+            return cls()
+
+        shard_count = None if count in ("", "auto") else int(count)
+        shard_ids = parse_ids(ids) if ids else None
+        if process_count > 1:
+            if shard_count is None:
+                raise ValueError("SHARD_COUNT has to be set to split shards across processes.")
+            if not 0 <= process_index < process_count:
+                raise ValueError(F"SHARD_PROCESS has to be from 0 to {process_count - 1}.")
+            shard_ids = shard_ids or list(range(process_index, shard_count, process_count))
+        if shard_ids is not None and shard_count is None:
+            raise ValueError("SHARD_COUNT has to be set when picking SHARD_IDS.")
+
+        return cls(True, shard_count, shard_ids, process_index, process_count)
+
+    def bot_kwargs(self):
+        """Gets the keyword arguments to create the bot with."""
+        if not self.sharded:
+            return {}
+        kwargs = {}
+        if self.shard_count is not None:
+            kwargs["shard_count"] = self.shard_count
+        if self.shard_ids is not None:
+            kwargs["shard_ids"] = self.shard_ids
+        return kwargs
+
+## Read once, so the bot and the shared stores agree on how they're split.
+sharding = ShardConfig.from_env()
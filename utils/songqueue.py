@@ -0,0 +1,177 @@
+import asyncio
+
+from collections import OrderedDict, deque
+from itertools import islice
+
+from utils.rng import rng
+
+def duration(song):
+    """Gets a song's length in seconds, for queued dicts and sources alike."""
+    return song['duration'] or 0
+
+
+class RoundRobin:
+    """Holds songs in one line per requester, and plays a song from each requester in turn.
+
+    A drop-in for the deque behind SongQueue, so one big playlist can't hold up everyone
+    else's songs. Requesters take turns in the order they first queued, and adding or
+    taking the next song are both O(1).
+    """
+    def __init__(self, songs=()):
+        self._lines = OrderedDict()
+        self._len = 0
+        for song in songs:
+            self.append(song)
+
+    def append(self, song):
+        line = self._lines.get(song['requester'].id)
+        if line is None:
+            line = self._lines[song['requester'].id] = deque()
+        line.append(song)
+        self._len += 1
+
+    def popleft(self):
+        if not self._lines:
+            raise IndexError("pop from an empty queue")
+        requester, line = next(iter(self._lines.items()))
+        song = line.popleft()
+        self._len -= 1
+        ## Their next song waits for everyone else's turn, or they leave the rotation.
+        if line:
+            self._lines.move_to_end(requester)
+        else:
+            del self._lines[requester]
+        return song
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        """Goes through the songs in the order popleft will give them."""
+        turns = deque(iter(line) for line in self._lines.values())
+        while turns:
+            line = turns.popleft()
+            for song in line:
+                yield song
+                turns.append(line)
+                break
+
+
+class SongQueue(asyncio.Queue):
+    """A guild's upcoming songs, with bulk edits and a running total of their length.
+
+    Works like an asyncio.Queue for the player loop, which waits on get. Every edit
+    adjusts total_duration by just the songs that were added or removed, and each bulk
+    edit is a single pass over the queue.
+
+    Args:
+        fair (bool): Takes turns between requesters instead of playing songs in the order
+        they were queued.
+
+    Attributes:
+        total_duration (int): Seconds of music left in the queue.
+    """
+    def __init__(self, *, fair: bool=False):
+        super().__init__()
+        if fair:
+            self.set_fair(True)
+
+    def _init(self, maxsize):
+        self._queue = deque()
+        self.total_duration = 0
+
+    @property
+    def fair(self):
+        return isinstance(self._queue, RoundRobin)
+
+    def set_fair(self, fair: bool):
+        """Switches between first come first served and taking turns, keeping every song."""
+        if fair != self.fair:
+            self._queue = (RoundRobin if fair else deque)(self._queue)
+
+    def _put(self, song):
+        self._queue.append(song)
+        self.total_duration += duration(song)
+
+    def _get(self):
+        song = self._queue.popleft()
+        self.total_duration -= duration(song)
+        return song
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __iter__(self):
+        """Goes through the songs in the order they'll play."""
+        return iter(self._queue)
+
+    def page(self, start: int, count: int):
+        """Gets count songs, starting from the one at index start."""
+        return list(islice(self, start, start + count))
+
+    def _replace(self, songs):
+        """Swaps in a new order of the same songs, or a subset of them.
+
+        In fair mode each requester keeps their songs in the given order, and requesters
+        take turns in the order their first song appears.
+        """
+        self._queue = type(self._queue)(songs)
+
+    def remove_where(self, predicate):
+        """Removes every song that predicate returns True for.
+
+        Returns:
+            (list): The removed songs, in queue order.
+        """
+        kept, removed = [], []
+        for song in self:
+            (removed if predicate(song) else kept).append(song)
+        if removed:
+            self._replace(kept)
+            self.total_duration -= sum(duration(song) for song in removed)
+        return removed
+
+    def remove_range(self, start: int, end: int):
+        """Removes the songs from index start up to but not including end.
+
+        Returns:
+            (list): The removed songs.
+        """
+        positions = iter(range(len(self)))
+        return self.remove_where(lambda song: start <= next(positions) < end)
+
+    def remove_user(self, user_id: int):
+        """Removes every song that a user requested."""
+        return self.remove_where(lambda song: song['requester'].id == user_id)
+
+    def dedupe(self):
+        """Removes every song that's already earlier in the queue, by URL."""
+        seen = set()
+        def repeated(song):
+            url = song['web_url'] if not isinstance(song, dict) else song['webpage_url']
+            if url in seen:
+                return True
+            seen.add(url)
+            return False
+        return self.remove_where(repeated)
+
+    def move(self, source: int, destination: int):
+        """Moves the song at index source to index destination, shifting the songs in between.
+
+        Returns:
+            The moved song.
+        """
+        songs = list(self)
+        song = songs.pop(source)
+        songs.insert(destination, song)
+        self._replace(songs)
+        return song
+
+    def shuffle(self):
+        songs = list(self)
+        rng.shuffle(songs)
+        self._replace(songs)
+
+    def clear(self):
+        self._replace([])
+        self.total_duration = 0
@@ -0,0 +1,81 @@
+import math
+import time
+
+class TimerWheel:
+    """A hashed timer wheel, for keeping track of lots of deadlines at once.
+
+    Each timer lives in the slot for the tick it expires on, so scheduling, rescheduling
+    and cancelling a timer are all O(1), and advancing the wheel only looks at the slots
+    for the ticks that have passed.
+
+    Attributes:
+        tick (float): Seconds covered by each slot.
+        slots (list): The wheel itself. Each slot maps a timer's key to its deadline tick.
+        timers (dict): Maps a timer's key to the index of the slot it's in.
+        current (int): The last tick that the wheel was advanced to.
+    """
+    def __init__(self, tick: float=1.0, size: int=1024):
+        self.tick = tick
+        self.slots = [{} for _ in range(size)]
+        self.timers = {}
+        self.current = self.to_tick(time.monotonic())
+
+    def __len__(self):
+        """Returns the number of pending timers."""
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def to_tick(self, when: float):
+        """Converts a time from time.monotonic() into a tick."""
+        return math.floor(when / self.tick)
+
+    def schedule(self, key, delay: float, now: float=None):
+        """Sets a timer to go off after some delay, replacing any existing timer with the same key.
+
+        Args:
+            key: Anything hashable, which is handed back once the timer expires
+            delay (float): Seconds until the timer expires
+            now (float): The current time, defaults to time.monotonic()
+        """
+        now = time.monotonic() if now is None else now
+        self.cancel(key)
+
+        ## Always land at least one tick ahead, so the timer can't be skipped over.
+        deadline = max(math.ceil((now + delay) / self.tick), self.current + 1)
+        index = deadline % len(self.slots)
+        self.slots[index][key] = deadline
+        self.timers[key] = index
+
+    def cancel(self, key):
+        """Removes a timer, if it exists."""
+        index = self.timers.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now: float=None):
+        """Moves the wheel forward to the current time.
+
+        Returns:
+            expired (list): Keys of all the timers that went off.
+        """
+        now = time.monotonic() if now is None else now
+        target = self.to_tick(now)
+        if target <= self.current:
+            return []
+
+        ## If we fell a whole rotation behind, every slot needs to be checked once.
+        steps = min(target - self.current, len(self.slots))
+        expired = []
+        for step in range(1, steps + 1):
+            slot = self.slots[(self.current + step) % len(self.slots)]
+            ## Timers more than a rotation away share the slot, but haven't expired yet.
+            due = [key for key, deadline in slot.items() if deadline <= target]
+            for key in due:
+                del slot[key]
+                del self.timers[key]
+            expired.extend(due)
+
+        self.current = target
+        return expired
@@ -0,0 +1,144 @@
+import asyncio
+import discord
+import os
+import time
+
+from collections import deque
+
+from utils.rng import rng
+from utils.scheduler import scheduler
+
+## Seconds before leaving a voice channel with nothing queued, or with no one left listening.
+## Can be changed in the .env file, lower values free up connections faster on busy bots.
+VOICE_IDLE_TIMEOUT = int(os.getenv("VOICE_IDLE_TIMEOUT", 600))
+VOICE_EMPTY_TIMEOUT = int(os.getenv("VOICE_EMPTY_TIMEOUT", 60))
+
+## Seconds to wait for a voice connection, and how many times to try again after a resume.
+CONNECT_TIMEOUT = 15
+RECONNECT_ATTEMPTS = 4
+
+## Longest to wait for discord.py to bring back a dropped connection by itself, before replacing it.
+LIBRARY_RECONNECT_WAIT = 60
+
+## Connection times kept for !diag.
+CONNECT_SAMPLES = 100
+
+class VoiceManager:
+    """Owns the bot's voice connections, one per guild.
+
+    An existing connection is reused when it's already in the right channel, and moved
+    rather than reconnected when it isn't. Every guild's channel is remembered, so after
+    the gateway resumes, any dropped connections are brought back all at once. Guilds
+    that go idle are disconnected by a timer on the shared scheduler.
+
+    Attributes:
+        bot (commands.Bot): The bot the connections belong to.
+        on_idle (coroutine function): Called with the guild when its connection is evicted.
+        channels (dict): Maps a guild's ID to the ID of the voice channel it should be in.
+        connect_times (deque): How long recent connects and moves took, in seconds.
+    """
+    def __init__(self, bot, on_idle):
+        self.bot = bot
+        self.on_idle = on_idle
+        self.channels = {}
+        self.connect_times = deque(maxlen=CONNECT_SAMPLES)
+
+    async def connect(self, channel: discord.VoiceChannel):
+        """Connects to a voice channel, reusing or moving the guild's connection when there is one.
+
+        Returns:
+            (discord.VoiceClient): The guild's connection.
+        """
+        guild = channel.guild
+        voice_client = guild.voice_client
+        if voice_client is not None and not voice_client.is_connected():
+            voice_client = await self.wait_for_reconnect(voice_client)
+        if voice_client is not None and voice_client.is_connected() and voice_client.channel.id == channel.id:
+            return voice_client
+
+        before = time.monotonic()
+        if voice_client is not None and voice_client.is_connected():
+            await voice_client.move_to(channel)
+        else:
+            ## A connection that stayed down without cleaning up has to go before a new one can be made.
+            if voice_client is not None:
+                await voice_client.disconnect(force=True)
+            voice_client = await channel.connect(timeout=CONNECT_TIMEOUT)
+
+        self.connect_times.append(time.monotonic() - before)
+        self.channels[guild.id] = channel.id
+        return guild.voice_client or voice_client
+
+    async def wait_for_reconnect(self, voice_client):
+        """Waits for discord.py to finish reconnecting a dropped connection by itself.
+
+        Voice clients retry on their own, and aren't connected while they do, so tearing
+        one down too early would stop whatever it's playing and race the library's retry.
+
+        Returns:
+            (discord.VoiceClient): The guild's connection afterwards, or None if the library gave up on it.
+        """
+        guild = voice_client.guild
+        deadline = time.monotonic() + LIBRARY_RECONNECT_WAIT
+        while guild.voice_client is voice_client and not voice_client.is_connected() and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        return guild.voice_client
+
+    def forget(self, guild_id: int):
+        """Stops looking after a guild's connection, so it isn't brought back or evicted."""
+        self.channels.pop(guild_id, None)
+        self.cancel_idle(guild_id)
+
+    def schedule_idle(self, guild, delay: float=VOICE_IDLE_TIMEOUT, force: bool=False):
+        """Disconnects from a guild after a delay, unless something cancels it first.
+
+        Args:
+            guild (discord.Guild): The guild to disconnect from
+            delay (float): Seconds to wait
+            force (bool): Disconnect even if something is still playing
+        """
+        scheduler.call_later(("voice-idle", guild.id), delay, self.evict, guild, force)
+
+    def cancel_idle(self, guild_id: int):
+        scheduler.cancel(("voice-idle", guild_id))
+
+    async def evict(self, guild, force: bool=False):
+        voice_client = guild.voice_client
+        if not force and voice_client is not None and voice_client.is_playing():
+            return
+        self.forget(guild.id)
+        await self.on_idle(guild)
+
+    async def reconnect_all(self):
+        """Brings back every connection that dropped, all at the same time.
+
+        Only guilds whose connection is gone altogether are reconnected. Ones that still have
+        a voice client are left to discord.py, which reconnects them by itself.
+        """
+        dropped = []
+        for guild_id, channel_id in list(self.channels.items()):
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                self.forget(guild_id)
+                continue
+            if guild.voice_client is None:
+                dropped.append(guild.get_channel(channel_id))
+
+        await asyncio.gather(*(self.reconnect(channel) for channel in dropped if channel is not None))
+
+    async def reconnect(self, channel: discord.VoiceChannel):
+        """Tries to connect again a few times, backing off a little more after each failure."""
+        for attempt in range(RECONNECT_ATTEMPTS):
+            ## Something else, like !join, may have brought the connection back in the meantime.
+            if channel.guild.voice_client is not None and channel.guild.voice_client.is_connected():
+                return
+            try:
+                await self.connect(channel)
+                return
+            except (asyncio.TimeoutError, discord.ClientException, discord.HTTPException):
+                ## Jitter keeps a busy bot from retrying every guild at the same instant.
+                await asyncio.sleep(2 ** attempt + rng.random())
+
+        print(F"Couldn't reconnect to voice in {channel.guild}, giving up.")
+        self.forget(channel.guild.id)
+        await self.on_idle(channel.guild)